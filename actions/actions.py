@@ -14,8 +14,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
 import sys
+import time
 
 _path = os.path.dirname(os.path.realpath(__file__))
 _root = os.path.abspath(os.path.join(_path, '..'))
@@ -28,8 +30,15 @@ def _add_path(path):
 
 _add_path(_root)
 
-from charmhelpers.core.hookenv import action_fail
+from charmhelpers.contrib.openstack import templating
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import (
+    action_fail,
+    action_get,
+    action_set,
+)
 
+from hooks import tracing, unit_state
 from hooks.horizon_utils import (
     pause_unit_helper,
     resume_unit_helper,
@@ -50,9 +59,107 @@ def resume(args):
     resume_unit_helper(register_configs())
 
 
+def hook_profile(args):
+    """Report the timings recorded for the last hooks by hook-tracing.
+    :raises: Exception if no matching profile was recorded."""
+    profiles = tracing.load_profiles()
+    hook = action_get('hook')
+    if hook:
+        profiles = [p for p in profiles if p['hook'] == hook]
+    if not profiles:
+        raise Exception("No hook profiles recorded; enable the hook-tracing "
+                        "option and run some hooks first.")
+    profiles = profiles[-max(action_get('count') or 1, 1):]
+    min_ms = action_get('min-ms')
+    output = {}
+    for i, profile in enumerate(reversed(profiles)):
+        summary = '\n'.join(
+            '{:>10.1f}ms self {:>10.1f}ms total {:>4}x {}'.format(
+                own, total, calls, name)
+            for name, calls, total, own in tracing.summarize(profile))
+        key = 'profile-{}'.format(i)
+        output.update({
+            key + '.hook': profile['hook'],
+            key + '.duration-ms': profile['duration'],
+            key + '.summary': summary,
+            key + '.spans': tracing.format_profile(
+                profile, min_ms=1.0 if min_ms is None else min_ms),
+        })
+    action_set(output)
+
+
+def _format_value(path, value):
+    if value is templating.ABSENT:
+        return '<absent>'
+    if templating.SECRET_KEYS.search(str(path[-1])):
+        return '<redacted>'
+    return json.dumps(value, sort_keys=True)
+
+
+def _format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))
+
+
+def context_diff(args):
+    """Show what changed in the context of each config file the last time
+    its context changed.
+    :raises: Exception if no render was recorded."""
+    records = templating.rendered_contexts()
+    config_file = action_get('file')
+    if config_file:
+        records = {k: v for k, v in records.items() if k == config_file}
+    if not records:
+        raise Exception("No rendered contexts recorded{}.".format(
+            " for {}".format(config_file) if config_file else ""))
+    output = {}
+    changed = [(path, record) for path, record in sorted(records.items())
+               if record.get('previous')]
+    for i, (path, record) in enumerate(changed):
+        previous = record['previous']
+        lines = []
+        for keys, before, after in templating.diff_contexts(
+                previous['context'], record['context']):
+            lines.append('{}: {} -> {}'.format(
+                '.'.join(str(k) for k in keys),
+                _format_value(keys, before), _format_value(keys, after)))
+        key = 'file-{}'.format(i)
+        output.update({
+            key + '.path': path,
+            key + '.changed-by': '{} at {}'.format(
+                record['hook'], _format_time(record['updated'])),
+            key + '.previous': '{} at {}'.format(
+                previous['hook'], _format_time(previous['updated'])),
+            key + '.diff': '\n'.join(lines),
+        })
+    if not output:
+        output['message'] = "No context changes recorded."
+    action_set(output)
+
+
+def kv_stats(args):
+    """Report the size of the unit state database and of its tables,
+    optionally compacting it first."""
+    db = unitdata.kv()
+    if action_get('compact'):
+        revisions, hooks = unit_state.prune(db)
+        unit_state.compact(db, force=True)
+        action_set({'pruned.revisions': revisions, 'pruned.hooks': hooks})
+    stats = unit_state.stats(db)
+    output = {
+        'path': stats['path'],
+        'file-size': stats['file-size'],
+        'free-size': stats['free-pages'] * stats['page-size'],
+    }
+    for table, sizes in stats['tables'].items():
+        output['tables.{}.rows'.format(table)] = sizes['rows']
+        output['tables.{}.bytes'.format(table)] = sizes['bytes']
+    action_set(output)
+
+
 # A dictionary of all the defined actions to callables (which take
 # parsed arguments).
-ACTIONS = {"pause": pause, "resume": resume}
+ACTIONS = {"pause": pause, "resume": resume, "hook-profile": hook_profile,
+           "context-diff": context_diff, "kv-stats": kv_stats}
 
 
 def main(args):
@@ -156,6 +156,14 @@ class OSContextGenerator(object):
     complete = False
     missing_data = []
 
+    def __new__(cls, *args, **kwargs):
+        # Record the constructor arguments so that generators built with the
+        # same arguments can share cached results, see
+        # charmhelpers.contrib.openstack.templating.cached_context()
+        obj = super(OSContextGenerator, cls).__new__(cls)
+        obj._init_args = (args, kwargs)
+        return obj
+
     def __call__(self):
         raise NotImplementedError
 
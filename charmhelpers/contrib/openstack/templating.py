@@ -12,29 +12,356 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
 import os
+import re
+import time
+
+from collections import namedtuple
+from contextlib import contextmanager
 
 from charmhelpers.fetch import apt_install, apt_update
 from charmhelpers.core.hookenv import (
+    atexit,
+    hook_name,
     log,
     ERROR,
     INFO,
     TRACE
 )
+from charmhelpers.core import unitdata
+from charmhelpers.core.host import AtomicWriteBatch
 from charmhelpers.contrib.openstack.utils import OPENSTACK_CODENAMES
 
 try:
-    from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
+    from jinja2 import (
+        FileSystemBytecodeCache, FileSystemLoader, ChoiceLoader, Environment,
+        exceptions)
 except ImportError:
     apt_update(fatal=True)
     apt_install('python3-jinja2', fatal=True)
-    from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
+    from jinja2 import (
+        FileSystemBytecodeCache, FileSystemLoader, ChoiceLoader, Environment,
+        exceptions)
 
 
 class OSConfigException(Exception):
     pass
 
 
+# Directory, relative to the charm directory, persisting compiled templates
+# and resolved loader search paths between hooks.
+TEMPLATE_CACHE_DIR = '.jinja2-cache'
+_LOADER_PATHS_FILE = 'loader-paths.json'
+
+# Loaders and template environments shared by every renderer in the hook,
+# keyed by (templates_dir, os_release), so that each template is compiled at
+# most once per hook.
+_loaders = {}
+_tmpl_envs = {}
+
+
+def template_cache_dir():
+    """Return the template cache directory, or None if there is none.
+
+    :rtype: Optional[str]
+    """
+    charm_dir = os.environ.get('CHARM_DIR')
+    if not charm_dir:
+        return None
+    path = os.path.join(charm_dir, TEMPLATE_CACHE_DIR)
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        return None
+    return path
+
+
+class _BytecodeCache(FileSystemBytecodeCache):
+    """Bytecode cache keyed by template path and OpenStack release.
+
+    jinja2 discards a cached entry whose source checksum no longer matches
+    the template, so edited templates are recompiled.
+    """
+
+    def __init__(self, directory, os_release):
+        super(_BytecodeCache, self).__init__(directory)
+        self.os_release = os_release
+
+    def get_cache_key(self, name, filename=None):
+        return super(_BytecodeCache, self).get_cache_key(
+            '{}|{}'.format(self.os_release, name), filename)
+
+
+def _search_path_state(templates_dir):
+    """Return the mtimes of the directories the search path is read from.
+
+    Adding or removing a release directory under templates_dir, or the
+    templates directory shipped with this module, changes one of them.
+
+    :rtype: Dict[str, Optional[int]]
+    """
+    state = {}
+    for path in (templates_dir, os.path.dirname(__file__)):
+        try:
+            state[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            state[path] = None
+    return state
+
+
+def _load_loader_paths(cache_dir, templates_dir, os_release, state):
+    try:
+        with open(os.path.join(cache_dir, _LOADER_PATHS_FILE)) as f:
+            entry = json.load(f).get(templates_dir)
+    except (IOError, OSError, ValueError):
+        return None
+    if (entry and entry.get('release') == os_release and
+            entry.get('state') == state):
+        return entry['dirs']
+    return None
+
+
+def _save_loader_paths(cache_dir, templates_dir, os_release, state, dirs):
+    path = os.path.join(cache_dir, _LOADER_PATHS_FILE)
+    try:
+        with open(path) as f:
+            paths = json.load(f)
+    except (IOError, OSError, ValueError):
+        paths = {}
+    # One entry per templates_dir: an upgrade to another release replaces
+    # the search path of the previous one.
+    paths[templates_dir] = {'release': os_release, 'state': state,
+                            'dirs': dirs}
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(paths, f)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError):
+        pass
+
+
+# Hook scoped cache of context generator results.  Generators of the same
+# class built with the same constructor arguments share a single entry, so a
+# context attached to several config files is only evaluated once per hook.
+_context_cache = {}
+
+# Generator attributes updated as a side effect of evaluating a context; these
+# are replayed onto other instances that are served from the cache.
+_CONTEXT_STATE_ATTRS = ('complete', 'missing_data', 'related')
+
+
+def context_cache_key(context):
+    """Return the cache key for a context generator.
+
+    :param context: a context generator
+    :type context: Callable[[], Dict]
+    :returns: (module, class name, constructor arguments) or None if the
+        generator does not record its constructor arguments.
+    :rtype: Optional[Tuple[str, str, str]]
+    """
+    init_args = getattr(context, '_init_args', None)
+    if init_args is None:
+        return None
+    cls = context.__class__
+    return (cls.__module__, cls.__name__,
+            json.dumps(init_args, sort_keys=True, default=str))
+
+
+def _evaluate(context):
+    return context()
+
+
+def cached_context(context):
+    """Evaluate a context generator, reusing results from earlier in the hook.
+
+    The cache is flushed automatically when the hook completes.
+
+    :param context: a context generator
+    :type context: Callable[[], Dict]
+    :returns: the generated context
+    :rtype: Dict
+    """
+    key = context_cache_key(context)
+    if key is None:
+        return _evaluate(context)
+    try:
+        ctxt, state = _context_cache[key]
+    except KeyError:
+        pass  # Drop out of the exception handler scope.
+    else:
+        for attr, value in state.items():
+            setattr(context, attr, value)
+        return ctxt
+    ctxt = _evaluate(context)
+    if not _context_cache:
+        atexit(flush_context_cache)
+    _context_cache[key] = (
+        ctxt,
+        {attr: context.__dict__[attr] for attr in _CONTEXT_STATE_ATTRS
+         if attr in context.__dict__})
+    return ctxt
+
+
+# A config file rewritten by OSConfigRenderer.write(); digests are sha256 hex
+# digests of the file content, old_digest is None if the file did not exist.
+ConfigChange = namedtuple('ConfigChange', ['config_file', 'old_digest',
+                                           'new_digest', 'services'])
+
+# Hook scoped record of the config files changed by any OSConfigRenderer.
+_config_changes = []
+
+# Digests of files on disk, keyed by path, with the (st_mtime_ns, st_size) the
+# digest was taken at so that changes made by other tools are noticed.
+_file_digests = {}
+
+
+def config_changes():
+    """Return the config files changed by OSConfigRenderer during this hook.
+
+    :returns: changes in the order they were written
+    :rtype: List[ConfigChange]
+    """
+    return list(_config_changes)
+
+
+def _flush_config_changes():
+    del _config_changes[:]
+
+
+def file_digest(path):
+    """Return the sha256 digest of the file at path, or None if missing.
+
+    Digests are cached and only recomputed when the file's mtime or size
+    changes.
+
+    :param path: the file to digest
+    :type path: str
+    :rtype: Optional[str]
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        _file_digests.pop(path, None)
+        return None
+    stamp = (st.st_mtime_ns, st.st_size)
+    try:
+        cached_stamp, digest = _file_digests[path]
+        if cached_stamp == stamp:
+            return digest
+    except KeyError:
+        pass  # Drop out of the exception handler scope.
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    _file_digests[path] = (stamp, digest)
+    return digest
+
+
+# Unit kv key prefix of the context, template and output each config file was
+# last rendered from, see rendered_context().
+RENDERED_CONTEXT_KV_PREFIX = 'rendered-context.'
+
+# Stands in for a key missing on one side of diff_contexts().
+ABSENT = object()
+
+
+# Context keys whose values are only persisted as a digest, see
+# rendered_context().
+SECRET_KEYS = re.compile(r'password|secret|token|(^|_)key$', re.IGNORECASE)
+REDACTED_PREFIX = '<redacted:'
+
+
+def _redact(value, key=''):
+    if SECRET_KEYS.search(str(key)) and value is not None:
+        if isinstance(value, str) and value.startswith(REDACTED_PREFIX):
+            return value
+        digest = hashlib.sha256(json.dumps(
+            value, sort_keys=True).encode('utf-8')).hexdigest()
+        return '{}{}>'.format(REDACTED_PREFIX, digest[:16])
+    if isinstance(value, dict):
+        return {k: _redact(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_redact(v) for v in value]
+    return value
+
+
+def _json_context(ctxt):
+    """Return ctxt as it is stored in the unit kv store: as it round trips
+    through JSON, with the values of SECRET_KEYS replaced by a digest."""
+    return _redact(json.loads(json.dumps(ctxt, sort_keys=True, default=str)))
+
+
+def rendered_context(config_file):
+    """Return the record of the last render of config_file.
+
+    :returns: {'template': template identity, 'context': Dict,
+        'digest': output digest, 'hook': str, 'updated': timestamp,
+        'previous': {'context', 'hook', 'updated'} of the render before the
+        last context change, if any}, or None if never rendered. Values of
+        SECRET_KEYS are replaced by a digest of the value.
+    :rtype: Optional[Dict]
+    """
+    return unitdata.kv().get(RENDERED_CONTEXT_KV_PREFIX + config_file)
+
+
+def rendered_contexts():
+    """Return the records of the last render of every config file.
+
+    :rtype: Dict[str, Dict]
+    """
+    return unitdata.kv().getrange(RENDERED_CONTEXT_KV_PREFIX, strip=True)
+
+
+def _store_rendered_context(config_file, rendered, stored):
+    record = dict(rendered, hook=hook_name(), updated=time.time())
+    if stored and stored['context'] != rendered['context']:
+        record['previous'] = {k: stored[k]
+                              for k in ('context', 'hook', 'updated')}
+    elif stored and 'previous' in stored:
+        record['previous'] = dict(stored['previous'])
+    if 'previous' in record:
+        # Records stored before secrets were redacted are redacted too.
+        record['previous']['context'] = _redact(
+            record['previous']['context'])
+    unitdata.kv().set(RENDERED_CONTEXT_KV_PREFIX + config_file, record)
+
+
+def diff_contexts(old, new, path=()):
+    """Compare two contexts key by key, descending into nested dicts.
+
+    :returns: [(key path, old value, new value)] for every changed value,
+        with ABSENT for keys only present on one side
+    :rtype: List[Tuple[Tuple[str, ...], Any, Any]]
+    """
+    changes = []
+    for key in sorted(set(old) | set(new), key=str):
+        before, after = old.get(key, ABSENT), new.get(key, ABSENT)
+        if isinstance(before, dict) and isinstance(after, dict):
+            changes.extend(diff_contexts(before, after, path + (key,)))
+        elif before != after:
+            changes.append((path + (key,), before, after))
+    return changes
+
+
+def flush_context_cache(generator=None):
+    """Flush cached context generator results.
+
+    Call this after changing state that context generators read during the
+    hook (e.g. certificates written to disk) so the next render picks it up.
+
+    :param generator: only flush results for this context generator class;
+        flush everything if None.
+    :type generator: Optional[type]
+    """
+    if generator is None:
+        _context_cache.clear()
+        return
+    for key in [k for k in _context_cache
+                if k[:2] == (generator.__module__, generator.__name__)]:
+        del _context_cache[key]
+
+
 def get_loader(templates_dir, os_release):
     """
     Create a jinja2.ChoiceLoader containing template dirs up to
@@ -55,32 +382,59 @@ def get_loader(templates_dir, os_release):
     :returns: jinja2.ChoiceLoader constructed with a list of
         jinja2.FilesystemLoaders, ordered in descending
         order by OpenStack release.
+
+    Loaders are memoised for the hook. The resolved search path is kept in
+    the template cache directory for os_release until one of the template
+    directories it is read from changes, see _search_path_state().
     """
-    tmpl_dirs = [(rel, os.path.join(templates_dir, rel))
-                 for rel in OPENSTACK_CODENAMES.values()]
+    key = (templates_dir, os_release)
+    if key in _loaders:
+        return _loaders[key]
 
     if not os.path.isdir(templates_dir):
         log('Templates directory not found @ %s.' % templates_dir,
             level=ERROR)
         raise OSConfigException
 
+    cache_dir = template_cache_dir()
+    state = _search_path_state(templates_dir)
+    dirs = None
+    if cache_dir:
+        dirs = _load_loader_paths(cache_dir, templates_dir, os_release,
+                                  state)
+    if dirs is None:
+        dirs = _search_path(templates_dir, os_release)
+        if cache_dir:
+            _save_loader_paths(cache_dir, templates_dir, os_release, state,
+                               dirs)
+
+    loaders = [FileSystemLoader(d) for d in dirs]
+    # demote this log to the lowest level; we don't really need to see these
+    # lots in production even when debugging.
+    log('Creating choice loader with dirs: %s' %
+        [l.searchpath for l in loaders], level=TRACE)
+    _loaders[key] = ChoiceLoader(loaders)
+    return _loaders[key]
+
+
+def _search_path(templates_dir, os_release):
+    """Return the template directories get_loader() searches, in order."""
+    tmpl_dirs = [(rel, os.path.join(templates_dir, rel))
+                 for rel in OPENSTACK_CODENAMES.values()]
+
     # the bottom contains tempaltes_dir and possibly a common templates dir
     # shipped with the helper.
-    loaders = [FileSystemLoader(templates_dir)]
+    dirs = [templates_dir]
     helper_templates = os.path.join(os.path.dirname(__file__), 'templates')
     if os.path.isdir(helper_templates):
-        loaders.append(FileSystemLoader(helper_templates))
+        dirs.append(helper_templates)
 
     for rel, tmpl_dir in tmpl_dirs:
         if os.path.isdir(tmpl_dir):
-            loaders.insert(0, FileSystemLoader(tmpl_dir))
+            dirs.insert(0, tmpl_dir)
         if rel == os_release:
             break
-    # demote this log to the lowest level; we don't really need to see these
-    # lots in production even when debugging.
-    log('Creating choice loader with dirs: %s' %
-        [l.searchpath for l in loaders], level=TRACE)
-    return ChoiceLoader(loaders)
+    return dirs
 
 
 class OSConfigTemplate(object):
@@ -104,7 +458,7 @@ class OSConfigTemplate(object):
     def context(self):
         ctxt = {}
         for context in self.contexts:
-            _ctxt = context()
+            _ctxt = cached_context(context)
             if _ctxt:
                 ctxt.update(_ctxt)
                 # track interfaces for every complete context.
@@ -204,6 +558,17 @@ class OSConfigRenderer(object):
     of generators.  When a template is rendered and written, all context
     generates are called in a chain to generate the context dictionary
     passed to the jinja2 template. See context.py for more info.
+
+    Generator results are cached for the rest of the hook and shared between
+    all registered config files, so a generator attached to several files is
+    evaluated once; use flush_context_cache() to force re-evaluation.
+
+    **Incremental rendering**
+
+    The context, template and output digest of each render are kept in the
+    unit kv store (see rendered_context()): a file whose recomputed
+    context and template match its last render, and which was not changed
+    on disk since, is not rendered again.
     """
     def __init__(self, templates_dir, openstack_release):
         if not os.path.isdir(templates_dir):
@@ -215,6 +580,8 @@ class OSConfigRenderer(object):
         self.openstack_release = openstack_release
         self.templates = {}
         self._tmpl_env = None
+        self._batch = None
+        self._batch_changes = None
 
         if None in [Environment, ChoiceLoader, FileSystemLoader]:
             # if this code is running, the object is created pre-install hook.
@@ -242,8 +609,18 @@ class OSConfigRenderer(object):
 
     def _get_tmpl_env(self):
         if not self._tmpl_env:
-            loader = get_loader(self.templates_dir, self.openstack_release)
-            self._tmpl_env = Environment(loader=loader)
+            key = (self.templates_dir, self.openstack_release)
+            if key not in _tmpl_envs:
+                loader = get_loader(self.templates_dir,
+                                    self.openstack_release)
+                cache_dir = template_cache_dir()
+                bytecode_cache = None
+                if cache_dir:
+                    bytecode_cache = _BytecodeCache(
+                        cache_dir, self.openstack_release)
+                _tmpl_envs[key] = Environment(loader=loader,
+                                              bytecode_cache=bytecode_cache)
+            self._tmpl_env = _tmpl_envs[key]
 
     def _get_template(self, template):
         self._get_tmpl_env()
@@ -264,65 +641,171 @@ class OSConfigRenderer(object):
             level=INFO)
         return template
 
-    def render(self, config_file):
+    def render(self, config_file, ctxt=None):
+        """Render config_file, from ctxt if given or its contexts if not."""
+        return self._render(config_file, ctxt)
+
+    def _load_template(self, config_file):
+        ostmpl = self.templates[config_file]
+        if ostmpl.is_string_template:
+            return self._get_template_from_string(ostmpl)
+        _tmpl = os.path.basename(config_file)
+        try:
+            return self._get_template(_tmpl)
+        except exceptions.TemplateNotFound:
+            # if no template is found with basename, try looking
+            # for it using a munged full path, eg:
+            # /etc/apache2/apache2.conf -> etc_apache2_apache2.conf
+            _tmpl = '_'.join(config_file.split('/')[1:])
+            try:
+                return self._get_template(_tmpl)
+            except exceptions.TemplateNotFound as e:
+                log('Could not load template from {} by {} or {}.'
+                    ''.format(
+                        self.templates_dir,
+                        os.path.basename(config_file),
+                        _tmpl
+                    ),
+                    level=ERROR)
+                raise e
+
+    def _render(self, config_file, ctxt=None, template=None):
         if config_file not in self.templates:
             log('Config not registered: {}'.format(config_file), level=ERROR)
             raise OSConfigException
 
         ostmpl = self.templates[config_file]
-        ctxt = ostmpl.context()
+        if ctxt is None:
+            ctxt = ostmpl.context()
+        if template is None:
+            template = self._load_template(config_file)
 
         if ostmpl.is_string_template:
-            template = self._get_template_from_string(ostmpl)
             log('Rendering from a string template: '
                 '{}'.format(config_file),
                 level=INFO)
         else:
-            _tmpl = os.path.basename(config_file)
-            try:
-                template = self._get_template(_tmpl)
-            except exceptions.TemplateNotFound:
-                # if no template is found with basename, try looking
-                # for it using a munged full path, eg:
-                # /etc/apache2/apache2.conf -> etc_apache2_apache2.conf
-                _tmpl = '_'.join(config_file.split('/')[1:])
-                try:
-                    template = self._get_template(_tmpl)
-                except exceptions.TemplateNotFound as e:
-                    log('Could not load template from {} by {} or {}.'
-                        ''.format(
-                            self.templates_dir,
-                            os.path.basename(config_file),
-                            _tmpl
-                        ),
-                        level=ERROR)
-                    raise e
-
             log('Rendering from template: {}'.format(config_file),
                 level=INFO)
         return template.render(ctxt)
 
+    def _template_identity(self, config_file, template):
+        """Identify the template source config_file is rendered from."""
+        ostmpl = self.templates[config_file]
+        if ostmpl.is_string_template:
+            return hashlib.sha256(
+                ostmpl.config_template.encode('UTF-8')).hexdigest()
+        return '{}:{}'.format(template.filename,
+                              file_digest(template.filename))
+
+    def config_services(self, config_file):
+        """
+        Return the services affected by a change to config_file.  Charms
+        may override this to annotate the ConfigChange records returned by
+        write() and write_all().
+        """
+        return []
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager collecting the writes made inside it into a single
+        generation: changed files are staged next to their targets and renamed
+        into place together when the block exits.
+        Nested batches join the outermost one.
+        """
+        if self._batch is not None:
+            yield
+            return
+        self._batch = AtomicWriteBatch()
+        self._batch_changes = {}
+        try:
+            with self._batch:
+                yield
+            unitdata.kv().flush()
+            for config_file, change in self._batch_changes.items():
+                st = os.stat(config_file)
+                _file_digests[config_file] = ((st.st_mtime_ns, st.st_size),
+                                              change.new_digest)
+                log('Wrote template %s.' % config_file, level=INFO)
+                if not _config_changes:
+                    atexit(_flush_config_changes)
+                _config_changes.append(change)
+        finally:
+            self._batch = None
+            self._batch_changes = None
+
     def write(self, config_file):
         """
         Write a single config file, raises if config file is not registered.
+
+        The file is only rewritten if the rendered content differs from what
+        is on disk, and is replaced atomically so readers never see a
+        partially written file.  Inside batch() the write is deferred until
+        the batch completes.  Rendering is skipped altogether when the
+        context and template match the last render, see rendered_context().
+
+        :returns: the change made, or None if the file was already up to date
+        :rtype: Optional[ConfigChange]
         """
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
             raise OSConfigException
 
-        _out = self.render(config_file).encode('UTF-8')
+        if self._batch is None:
+            with self.batch():
+                return self.write(config_file)
 
-        with open(config_file, 'wb') as out:
-            out.write(_out)
+        ostmpl = self.templates[config_file]
+        ctxt = ostmpl.context()
+
+        pending = self._batch_changes.get(config_file)
+        if pending is None:
+            old_digest = current_digest = file_digest(config_file)
+        else:
+            old_digest, current_digest = pending.old_digest, pending.new_digest
+        template = self._load_template(config_file)
+        rendered = {
+            'template': self._template_identity(config_file, template),
+            'context': _json_context(ctxt),
+        }
+        stored = rendered_context(config_file)
+        if (stored and current_digest == stored['digest'] and
+                all(stored[k] == v for k, v in rendered.items())):
+            log('Context and template of %s unchanged, not rendering.'
+                % config_file, level=INFO)
+            return None
+
+        _out = self._render(config_file, ctxt, template).encode('UTF-8')
+        new_digest = hashlib.sha256(_out).hexdigest()
+        rendered['digest'] = new_digest
+        _store_rendered_context(config_file, rendered, stored)
+        if old_digest == new_digest:
+            if pending is not None:
+                # Rendered back to what is on disk: drop the earlier render
+                # staged in this batch.
+                self._batch.unstage(config_file)
+                del self._batch_changes[config_file]
+            log('Template %s unchanged, not writing.' % config_file,
+                level=INFO)
+            return None
 
-        log('Wrote template %s.' % config_file, level=INFO)
+        self._batch.stage(config_file, _out)
+        change = ConfigChange(config_file, old_digest, new_digest,
+                              self.config_services(config_file))
+        self._batch_changes[config_file] = change
+        return change
 
     def write_all(self):
         """
-        Write out all registered config files.
+        Write out all registered config files as a single batch.
+
+        :returns: the changes made
+        :rtype: List[ConfigChange]
         """
-        for k in self.templates.keys():
-            self.write(k)
+        with self.batch():
+            changes = [self.write(k) for k in self.templates.keys()]
+        return [c for c in changes if c is not None]
 
     def set_release(self, openstack_release):
         """
@@ -86,7 +86,7 @@ from charmhelpers.core.host import (
     lsb_release,
     mounts,
     umount,
-    service_running,
+    services_running,
     service_pause,
     service_resume,
     service_stop,
@@ -1002,7 +1002,7 @@ def set_os_workload_status(configs, required_interfaces, charm_func=None,
 
 def _determine_os_workload_status(
         configs, required_interfaces, charm_func=None,
-        services=None, ports=None):
+        services=None, ports=None, ready_message=None):
     """Determine the state of the workload status for the charm.
 
     This function returns the new workload status for the charm based
@@ -1027,6 +1027,8 @@ def _determine_os_workload_status(
                        signature is charm_func(configs) -> (state, message)
     @param services: list of strings OR dictionary specifying services/ports
     @param ports: OPTIONAL list of port numbers.
+    @param ready_message: OPTIONAL callable returning extra detail to add to
+                          the message when the unit is ready.
     @returns state, message: the new workload status, user message
     """
     state, message = _ows_check_if_paused(services, ports)
@@ -1046,6 +1048,8 @@ def _determine_os_workload_status(
     if state is None:
         state = 'active'
         message = "Unit is ready"
+        if ready_message:
+            message = "{}, {}".format(message, ready_message())
         juju_log(message, 'INFO')
 
     try:
@@ -1311,8 +1315,24 @@ def _check_running_services(services):
     @returns [(service, boolean), ...], : results for checks
              [boolean]                  : just the result of the service checks
     """
-    services_running = [service_running(s) for s in services]
-    return list(zip(services, services_running)), services_running
+    states = services_running(services)
+    running = [states[s] for s in services]
+    return list(zip(services, running)), running
+
+
+def _ports_have_listeners(ports):
+    """Check whether each of ports is being listened to.
+
+    Reads the listening sockets in-process once for all the ports, falling
+    back to port_has_listener() where /proc/net/tcp is unavailable.
+
+    @param ports: LIST of port numbers.
+    @returns [boolean], in the order of ports
+    """
+    listening = ip.listening_ports()
+    if listening is None:
+        return [port_has_listener('0.0.0.0', p) for p in ports]
+    return [int(p) in listening for p in ports]
 
 
 def _check_listening_on_services_ports(services, test=False):
@@ -1329,7 +1349,7 @@ def _check_listening_on_services_ports(services, test=False):
     """
     test = not(not(test))  # ensure test is True or False
     all_ports = list(itertools.chain(*services.values()))
-    ports_states = [port_has_listener('0.0.0.0', p) for p in all_ports]
+    ports_states = _ports_have_listeners(all_ports)
     map_ports = OrderedDict()
     matched_ports = [p for p, opened in zip(all_ports, ports_states)
                      if opened == test]  # essentially opened xor test
@@ -1349,7 +1369,7 @@ def _check_listening_on_ports_list(ports):
     @param ports: LIST of port numbers.
     @returns [(port_num, boolean), ...], [boolean]
     """
-    ports_open = [port_has_listener('0.0.0.0', p) for p in ports]
+    ports_open = _ports_have_listeners(ports)
     return zip(ports, ports_open), ports_open
 
 
@@ -661,6 +661,29 @@ def relations_of_type(reltype=None):
     return relation_data
 
 
+@cached
+def relation_snapshot(reltype=None):
+    """Get the settings of every remote unit on every relation of a type.
+
+    The data for the whole endpoint is loaded in one pass, one relation-list
+    per relation id and one full relation-get per unit, and cached for the
+    rest of the hook so that every caller reading the endpoint is served from
+    memory.  Callers must treat the returned data as read-only.
+
+    :param reltype: Relation type to load, defaults to the relation type of
+                    the current hook.
+    :type reltype: Optional[str]
+    :returns: {relation_id: {unit: settings}}, ordered as reported by
+              relation-ids and relation-list.
+    :rtype: Dict[str, Dict[str, Dict[str, str]]]
+    """
+    reltype = reltype or relation_type()
+    return {
+        relid: {unit: relation_get(unit=unit, rid=relid) or {}
+                for unit in related_units(relid)}
+        for relid in relation_ids(reltype)}
+
+
 @cached
 def metadata():
     """Get the current charm metadata.yaml contents as a python object"""
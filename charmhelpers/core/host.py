@@ -29,12 +29,14 @@ import random
 import string
 import subprocess
 import hashlib
+import tempfile
+import time
 import functools
 import itertools
 
 from contextlib import contextmanager
 from collections import OrderedDict, defaultdict
-from .hookenv import log, INFO, DEBUG, local_unit, charm_name
+from .hookenv import log, INFO, DEBUG, WARNING, local_unit, charm_name
 from .fstab import Fstab
 from charmhelpers.osplatform import get_platform
 
@@ -285,6 +287,8 @@ def service(action, service_name=None, **kwargs):
     :param **kwargs: additional params to be passed to the service command in
                     the form of key=value.
     """
+    if action not in _QUERY_ACTIONS:
+        flush_service_probes()
     if init_is_systemd(service_name=service_name):
         cmd = ['systemctl', action]
         if service_name is not None:
@@ -300,6 +304,63 @@ def service(action, service_name=None, **kwargs):
 _UPSTART_CONF = "/etc/init/{}.conf"
 _INIT_D_CONF = "/etc/init.d/{}"
 
+# service() actions that do not change the state of a service.
+_QUERY_ACTIONS = ('status', 'is-active', 'is-enabled', 'is-failed')
+# Seconds a services_running() probe may take before it counts as stopped.
+SERVICE_PROBE_TIMEOUT = 30
+# services_running() results, kept until a service() action may change them.
+_service_probes = {}
+
+
+def flush_service_probes():
+    """Forget the results of earlier services_running() probes."""
+    _service_probes.clear()
+
+
+def services_running(service_names, timeout=SERVICE_PROBE_TIMEOUT):
+    """Determine whether several system services are running.
+
+    systemd services are probed concurrently; a probe that has not answered
+    within timeout seconds is killed and its service reported as not running,
+    so a single stuck unit cannot hang the caller. Services managed by other
+    init systems are checked one by one with service_running().
+
+    Results are cached until the next service() action that may change the
+    state of a service.
+
+    :param service_names: names of the services to check
+    :type service_names: Iterable[str]
+    :param timeout: seconds to wait for all the systemd probes
+    :type timeout: int
+    :returns: {service_name: running}
+    :rtype: Dict[str, bool]
+    """
+    results = {}
+    pending = OrderedDict()
+    for name in service_names:
+        if name in _service_probes:
+            results[name] = _service_probes[name]
+        elif init_is_systemd(service_name=name):
+            pending[name] = subprocess.Popen(
+                ['systemctl', 'is-active', '--quiet', name],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            results[name] = service_running(name)
+    deadline = time.monotonic() + timeout
+    for name, proc in pending.items():
+        try:
+            returncode = proc.wait(
+                timeout=max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            log("Timed out checking whether {} is running".format(name),
+                level=WARNING)
+            returncode = None
+        results[name] = returncode == 0
+    _service_probes.update(results)
+    return results
+
 
 def service_running(service_name, **kwargs):
     """Determine whether a system service is running.
@@ -573,6 +634,9 @@ def write_file(path, content, owner='root', group='root', perms=0o444):
     """Create or overwrite a file with the contents of a byte string."""
     uid = pwd.getpwnam(owner).pw_uid
     gid = grp.getgrnam(group).gr_gid
+    if isinstance(content, str):
+        # Compared with the bytes on disk below.
+        content = content.encode('UTF-8')
     # lets see if we can grab the file and compare the context, to avoid doing
     # a write.
     existing_content = None
@@ -592,8 +656,6 @@ def write_file(path, content, owner='root', group='root', perms=0o444):
         with open(path, 'wb') as target:
             os.fchown(target.fileno(), uid, gid)
             os.fchmod(target.fileno(), perms)
-            if isinstance(content, str):
-                content = content.encode('UTF-8')
             target.write(content)
         return
     # the contents were the same, but we might still need to change the
@@ -612,6 +674,151 @@ def write_file(path, content, owner='root', group='root', perms=0o444):
         os.chmod(path, perms)
 
 
+# Suffix of the temporary files staged by AtomicWriteBatch.
+STAGED_SUFFIX = '.staged'
+
+
+def is_staged_file(path):
+    """Whether path is a temporary file staged by an AtomicWriteBatch, e.g.
+    one left behind by an interrupted hook."""
+    name = os.path.basename(path)
+    return name.startswith('.') and name.endswith(STAGED_SUFFIX)
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AtomicWriteBatch(object):
+    """Replace a set of files together, each one atomically.
+
+    Content is staged in temporary files next to their targets, each synced
+    to disk as it is staged.  On commit every target is renamed into place,
+    then the directories holding them are synced so that the renames are
+    durable, and readers only ever see complete files from a single
+    generation.  Used as a context manager the batch commits when the block
+    exits cleanly and discards staged files otherwise::
+
+        with AtomicWriteBatch() as batch:
+            batch.stage('/etc/foo.conf', foo_content)
+            batch.stage('/etc/bar.conf', bar_content, owner='bar')
+    """
+
+    def __init__(self):
+        self._staged = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    @property
+    def staged(self):
+        """The target paths staged for replacement, in staging order."""
+        return list(self._staged.keys())
+
+    def stage(self, path, content, owner=None, group=None, perms=None):
+        """Stage content to be written to path when the batch is committed.
+
+        Ownership and permissions default to those of the existing file, or
+        the process defaults if path does not exist yet.  Staging a path
+        twice replaces the previously staged content.
+
+        :param path: the file to replace
+        :type path: str
+        :param content: the new file content
+        :type content: Union[str, bytes]
+        :param owner: user name to own the file
+        :type owner: Optional[str]
+        :param group: group name to own the file
+        :type group: Optional[str]
+        :param perms: file mode bits
+        :type perms: Optional[int]
+        """
+        target = os.path.realpath(path)
+        if isinstance(content, str):
+            content = content.encode('UTF-8')
+        uid = pwd.getpwnam(owner).pw_uid if owner is not None else -1
+        gid = grp.getgrnam(group).gr_gid if group is not None else -1
+        try:
+            stat = os.stat(target)
+        except OSError:
+            if perms is None:
+                umask = os.umask(0)
+                os.umask(umask)
+                perms = 0o666 & ~umask
+        else:
+            uid = stat.st_uid if uid == -1 else uid
+            gid = stat.st_gid if gid == -1 else gid
+            if perms is None:
+                perms = stat.st_mode & 0o7777
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target),
+                                   prefix='.{}.'.format(
+                                       os.path.basename(target)),
+                                   suffix=STAGED_SUFFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if uid != -1 or gid != -1:
+                    os.fchown(f.fileno(), uid, gid)
+                os.fchmod(f.fileno(), perms)
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception:
+            os.unlink(tmp)
+            raise
+        if target in self._staged:
+            os.unlink(self._staged[target])
+        self._staged[target] = tmp
+
+    def commit(self):
+        """Rename the staged files into place and sync their directories."""
+        if not self._staged:
+            return
+        dirs = []
+        try:
+            while self._staged:
+                target, tmp = next(iter(self._staged.items()))
+                os.rename(tmp, target)
+                del self._staged[target]
+                if os.path.dirname(target) not in dirs:
+                    dirs.append(os.path.dirname(target))
+        finally:
+            self.abort()
+            for path in dirs:
+                _fsync_dir(path)
+
+    def unstage(self, path):
+        """Discard the content staged for path, if any.
+
+        :param path: a file staged for replacement
+        :type path: str
+        """
+        tmp = self._staged.pop(os.path.realpath(path), None)
+        if tmp is not None:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def abort(self):
+        """Discard any staged files that have not been committed."""
+        for tmp in self._staged.values():
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+        self._staged.clear()
+
+
 def fstab_remove(mp):
     """Remove the given mountpoint entry from /etc/fstab"""
     return Fstab.remove_by_mountpoint(mp)
@@ -0,0 +1,114 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Apache module and site state.
+
+The enabled modules and sites are read from the mods-enabled and
+sites-enabled directories, so that a2enmod and a2ensite only run, once, for
+what actually needs enabling::
+
+    if apache.enable_modules(['ssl', 'headers']):
+        service_reload('apache2')
+"""
+
+import os
+import subprocess
+
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+    ERROR,
+)
+
+APACHE_DIR = '/etc/apache2'
+
+
+def _enabled(kind, suffix):
+    try:
+        names = os.listdir(os.path.join(APACHE_DIR, kind + '-enabled'))
+    except OSError:
+        return set()
+    return {n[:-len(suffix)] for n in names if n.endswith(suffix)}
+
+
+def enabled_modules():
+    """Return the names of the enabled Apache modules.
+
+    :rtype: Set[str]
+    """
+    return _enabled('mods', '.load')
+
+
+def enabled_sites():
+    """Return the names of the enabled Apache sites.
+
+    :rtype: Set[str]
+    """
+    return _enabled('sites', '.conf')
+
+
+def _change(cmd, names, fatal):
+    """Run cmd for names and return whether it succeeded."""
+    log('Running {}'.format(' '.join(cmd + names)), level=DEBUG)
+    if fatal:
+        subprocess.check_call(cmd + names)
+        return True
+    if subprocess.call(cmd + names):
+        log('{} failed for {}'.format(cmd[0], ', '.join(names)), level=ERROR)
+        return False
+    return True
+
+
+def enable_modules(modules, fatal=True):
+    """Enable the Apache modules that are not enabled yet.
+
+    :param modules: module names, e.g. ['ssl', 'headers']
+    :type modules: List[str]
+    :param fatal: raise if a2enmod fails, rather than log and return False
+    :type fatal: bool
+    :returns: whether anything was enabled, i.e. Apache needs a reload
+    :rtype: bool
+    """
+    enabled = enabled_modules()
+    missing = [m for m in modules if m not in enabled]
+    return bool(missing) and _change(['a2enmod'], missing, fatal)
+
+
+def disable_modules(modules, fatal=True):
+    """Disable the Apache modules that are enabled, see enable_modules()."""
+    enabled = enabled_modules()
+    present = [m for m in modules if m in enabled]
+    return bool(present) and _change(['a2dismod'], present, fatal)
+
+
+def enable_sites(sites, fatal=True):
+    """Enable the Apache sites that are not enabled yet.
+
+    :param sites: site names, e.g. ['default-ssl']
+    :type sites: List[str]
+    :param fatal: raise if a2ensite fails, rather than log and return False
+    :type fatal: bool
+    :returns: whether anything was enabled, i.e. Apache needs a reload
+    :rtype: bool
+    """
+    enabled = enabled_sites()
+    missing = [s for s in sites if s not in enabled]
+    return bool(missing) and _change(['a2ensite'], missing, fatal)
+
+
+def disable_sites(sites, fatal=True):
+    """Disable the Apache sites that are enabled, see enable_sites()."""
+    enabled = enabled_sites()
+    present = [s for s in sites if s in enabled]
+    return bool(present) and _change(['a2dissite'], present, fatal)
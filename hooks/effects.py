@@ -0,0 +1,255 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Coalescing of the side effects of a hook.
+
+Handlers that are called several times in a hook (once per related unit,
+say) tend to re-render the same config files and reload or restart the same
+services each time. Inside deferred() these effects are queued instead,
+merged, and run once when the hook completes, in dependency order:
+
+    RENDER     config files are written
+    CONFIGURE  queued callables run, e.g. enabling Apache modules, or the
+               restart_on_change() checks of what the renders changed
+    RESTART    services are restarted (or stopped and started)
+    RELOAD     services that were not restarted are reloaded
+
+Hooks registered with effects.Hooks run deferred::
+
+    hooks = effects.Hooks()
+
+    @hooks.hook('config-changed')
+    def config_changed():
+        ...
+
+Outside deferred() every effect runs immediately, so handlers behave the
+same whether or not they are deferred. Effects queued for a stage that has
+already run also run immediately.
+"""
+
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from charmhelpers.core import hookenv
+from charmhelpers.core.hookenv import (
+    log,
+    relation_type,
+    DEBUG,
+)
+from charmhelpers.core.host import (
+    service,
+    service_reload,
+)
+
+RENDER, CONFIGURE, RESTART, RELOAD = range(4)
+
+# The _Pending effects of the current deferred() block, if any.
+_pending = None
+
+
+class _Pending(object):
+
+    def __init__(self):
+        self.stage = None
+        # id(configs) -> [configs, write all, affected relations or None,
+        #                 [config files]]
+        self.renders = OrderedDict()
+        # key -> (callable, args, kwargs)
+        self.calls = OrderedDict()
+        # service -> sleep after stop, or None to restart in one go
+        self.restarts = OrderedDict()
+        self.reloads = OrderedDict()
+
+    def runs_now(self, stage):
+        return self.stage is not None and self.stage >= stage
+
+
+def active():
+    """Whether effects are currently being queued."""
+    return _pending is not None
+
+
+def _write(configs, write_all, relations, config_files):
+    if write_all:
+        configs.write_all()
+        return
+    if relations is not None:
+        configs.write_affected(relations=sorted(relations))
+    for config_file in config_files:
+        configs.write(config_file)
+
+
+def render(configs, config_files=None, affected=False, relations=None):
+    """Write config files of a renderer.
+
+    By default all the files are written, see OSConfigRenderer.write_all().
+    Queued renders of the same renderer are merged; writing all the files
+    supersedes writing some.
+
+    :param configs: the renderer
+    :type configs: HorizonOSConfigRenderer
+    :param config_files: only write these files
+    :type config_files: Optional[List[str]]
+    :param affected: only write the files affected by relations, see
+        HorizonOSConfigRenderer.write_affected()
+    :type affected: bool
+    :param relations: relations whose data changed, defaults to the relation
+        of the current hook
+    :type relations: Optional[List[str]]
+    """
+    write_all = not (config_files or affected)
+    if affected and relations is None:
+        relations = [relation_type()] if relation_type() else []
+    if affected:
+        relations = set(relations)
+    else:
+        relations = None
+    config_files = list(config_files or [])
+    if not active() or _pending.runs_now(RENDER):
+        _write(configs, write_all, relations, config_files)
+        return
+    entry = _pending.renders.setdefault(
+        id(configs), [configs, False, None, []])
+    entry[1] = entry[1] or write_all
+    if relations is not None:
+        entry[2] = relations if entry[2] is None else entry[2] | relations
+    entry[3].extend(f for f in config_files if f not in entry[3])
+
+
+def call(callback, *args, **kwargs):
+    """Call callback once the config files are rendered.
+
+    Repeated calls with the same callback and arguments are merged.
+    """
+    if not active() or _pending.runs_now(CONFIGURE):
+        callback(*args, **kwargs)
+        return
+    try:
+        key = (callback, args, tuple(sorted(kwargs.items())))
+        hash(key)
+    except TypeError:
+        key = (callback, id(args), id(kwargs))
+    _pending.calls[key] = (callback, args, kwargs)
+
+
+def _restart(services, sleep):
+    if sleep is None:
+        for service_name in services:
+            service('restart', service_name)
+        return
+    for action in ['stop', 'start']:
+        for service_name in services:
+            service(action, service_name)
+            if action == 'stop' and sleep:
+                time.sleep(sleep)
+
+
+def restart(services, stopstart=False, sleep=0):
+    """Restart services, after any reload of them was dropped.
+
+    :param services: service names
+    :type services: List[str]
+    :param stopstart: stop all the services, then start them, rather than
+        restarting them
+    :type stopstart: bool
+    :param sleep: seconds to wait after each stop
+    :type sleep: int
+    """
+    delay = sleep if stopstart else None
+    if not active() or _pending.runs_now(RESTART):
+        _restart(services, delay)
+        return
+    for service_name in services:
+        # Stopping and starting wins over restarting, with the longest sleep.
+        delays = [d for d in (delay, _pending.restarts.get(service_name))
+                  if d is not None]
+        _pending.restarts[service_name] = max(delays) if delays else None
+
+
+def reload(service_name):
+    """Reload a service, unless it is restarted in the same hook."""
+    if not active() or _pending.runs_now(RELOAD):
+        service_reload(service_name)
+        return
+    _pending.reloads[service_name] = True
+
+
+def run():
+    """Run the queued effects, see deferred()."""
+    pending = _pending
+    if pending is None or pending.stage is not None:
+        return
+    pending.stage = RENDER
+    for configs, write_all, relations, config_files in (
+            pending.renders.values()):
+        _write(configs, write_all, relations, config_files)
+    pending.stage = CONFIGURE
+    while pending.calls:
+        _, (callback, args, kwargs) = pending.calls.popitem(last=False)
+        callback(*args, **kwargs)
+    pending.stage = RESTART
+    restarted = list(pending.restarts)
+    stopstart = [s for s in restarted if pending.restarts[s] is not None]
+    if stopstart:
+        _restart(stopstart, max(pending.restarts[s] for s in stopstart))
+    _restart([s for s in restarted if s not in stopstart], None)
+    pending.stage = RELOAD
+    for service_name in pending.reloads:
+        if service_name in restarted:
+            log('{} was restarted, not reloading'.format(service_name),
+                level=DEBUG)
+            continue
+        service_reload(service_name)
+
+
+@contextmanager
+def deferred():
+    """Queue the effects of the enclosed block and run them once.
+
+    They run when the block exits, unless it raises; a SystemExit with a
+    success code counts as exiting normally, as in Hooks.execute(). Nested
+    blocks join the outermost one.
+    """
+    global _pending
+    if _pending is not None:
+        yield
+        return
+    _pending = _Pending()
+    try:
+        try:
+            yield
+        except SystemExit as e:
+            if e.code is None or e.code == 0:
+                run()
+            raise
+        run()
+    finally:
+        _pending = None
+
+
+class Hooks(hookenv.Hooks):
+    """Hooks that run with their effects deferred.
+
+    Each hook runs inside deferred(), so its effects run before the atexit()
+    callbacks, which save the config and flush the context cache that the
+    renders still need.
+    """
+
+    def register(self, name, function):
+        def deferring():
+            with deferred():
+                return function()
+        super(Hooks, self).register(name, deferring)
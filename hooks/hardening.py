@@ -0,0 +1,332 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Hardening that skips audit passes when nothing they inspect changed.
+
+``harden()`` is a drop-in for the charmhelpers.contrib.hardening decorator
+of the same name. After each pass of a hardening module the inputs of its
+audits (the files and directory trees, packages and sysctl keys they
+inspect) are recorded in the unit kv store together with a fingerprint of
+their current state. A later pass of the module is skipped if that
+fingerprint, the module settings and the set of installed packages are
+unchanged, until the 'harden-audit-interval' config option expires.
+
+A module is only skipped if the inputs of all of its audits are known; one
+that runs an audit of another kind is audited on every hook.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import subprocess
+import time
+from collections import OrderedDict
+
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import (
+    config,
+    log,
+    DEBUG,
+    WARNING,
+)
+from charmhelpers.contrib.hardening import utils
+from charmhelpers.contrib.hardening.apache.checks import (
+    config as apache_config,
+)
+from charmhelpers.contrib.hardening.audits.apache import DisabledModuleAudit
+from charmhelpers.contrib.hardening.audits.apt import (
+    AptConfig,
+    RestrictedPackages,
+)
+from charmhelpers.contrib.hardening.audits.file import BaseFileAudit
+from charmhelpers.contrib.hardening.host.checks import (
+    apt,
+    limits,
+    login,
+    minimize_access,
+    pam,
+    profile,
+    securetty,
+    suid_sgid,
+    sysctl,
+)
+from charmhelpers.contrib.hardening.mysql.checks import (
+    config as mysql_config,
+)
+from charmhelpers.contrib.hardening.ssh.checks import config as ssh_config
+
+from hooks.packages import package_index
+
+AUDIT_CACHE_KEY = 'hardening-audit-cache'
+
+# The audits of each hardening module, as run by the charmhelpers
+# run_<module>_checks() functions, in the order they run in.
+RUN_CATALOG = OrderedDict([
+    ('os', [apt, limits, login, minimize_access, pam, profile, securetty,
+            suid_sgid, sysctl]),
+    ('ssh', [ssh_config]),
+    ('mysql', [mysql_config]),
+    ('apache', [apache_config]),
+])
+
+_DISABLE_HARDENING_FOR_UNIT_TEST = False
+
+
+def audit_interval():
+    """Seconds after which a full audit runs even if nothing changed.
+
+    A negative interval disables the cache.
+    """
+    interval = config('harden-audit-interval')
+    if interval is None:
+        return -1
+    return int(interval)
+
+
+def audit_inputs(check):
+    """Describe the system state inspected by an audit.
+
+    :param check: a hardening audit
+    :type check: BaseAudit
+    :returns: dict with optional 'files', 'packages' and 'sysctl' lists, or
+              None if the inputs of this kind of audit are not known
+    :rtype: Optional[Dict[str, List[str]]]
+    """
+    if isinstance(check, sysctl.SysctlConf):
+        return {
+            'files': [str(p) for p in check.paths],
+            'sysctl': [line.partition('=')[0].strip()
+                       for line in sysctl.SYSCTL_DEFAULTS.split()],
+        }
+    if isinstance(check, BaseFileAudit):
+        return {'files': [str(p) for p in check.paths]}
+    if isinstance(check, AptConfig):
+        return {'files': ['/etc/apt/apt.conf', '/etc/apt/apt.conf.d']}
+    if isinstance(check, RestrictedPackages):
+        return {'packages': list(check.pkgs)}
+    if isinstance(check, DisabledModuleAudit):
+        return {'files': ['/etc/apache2/mods-enabled']}
+    return None
+
+
+def collect_inputs(module, checks):
+    """Merge the inputs of the audits run by a hardening module.
+
+    The unknown-SUID/SGID audit of the 'os' module inspects every file
+    below the root path rather than a fixed list, so its input is the root
+    path, which is searched again for every fingerprint.
+
+    :param module: hardening module name, e.g. 'os'
+    :type module: str
+    :param checks: audits run by the module
+    :type checks: List[BaseAudit]
+    :returns: {'files': [...], 'packages': [...], 'sysctl': [...],
+              'suid': [...]}, or None if an audit has unknown inputs
+    :rtype: Optional[Dict[str, List[str]]]
+    """
+    merged = {'files': set(), 'packages': set(), 'sysctl': set(),
+              'suid': set()}
+    for check in checks:
+        inputs = audit_inputs(check)
+        if inputs is None:
+            log("Hardening audit '%s' has unknown inputs, module '%s' is "
+                "audited on every hook" % (check.__class__.__name__, module),
+                level=DEBUG)
+            return None
+        for kind, values in inputs.items():
+            merged[kind].update(values)
+    if module == 'os':
+        settings = utils.get_settings('os')
+        security = settings['security']
+        if (security['suid_sgid_enforce'] and
+                (security['suid_sgid_remove_from_unknown'] or
+                 security['suid_sgid_dry_run_on_unknown'])):
+            merged['suid'].add(settings['environment']['root_path'])
+    return {kind: sorted(values) for kind, values in merged.items()}
+
+
+def _stat(path):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size, st.st_mode, st.st_uid, st.st_gid]
+
+
+def _file_state(path):
+    """State of path and, for a directory, of the whole tree below it."""
+    state = {path: _stat(path)}
+    if os.path.isdir(path) and not os.path.islink(path):
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                child = os.path.join(root, name)
+                state[child] = _stat(child)
+    return state
+
+
+def _sysctl_state(key):
+    try:
+        with open(os.path.join('/proc/sys', key.replace('.', '/'))) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _suid_sgid_paths(root_path):
+    """Files below root_path with the suid or sgid bit, as the audit finds."""
+    result = subprocess.run(
+        ['find', root_path, '-perm', '-4000', '-o', '-perm', '-2000',
+         '-type', 'f', '!', '-path', '/proc/*', '-print'],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        universal_newlines=True)
+    return sorted(p for p in result.stdout.split('\n') if p)
+
+
+def fingerprint(module, inputs):
+    """Fingerprint the current state of a hardening module's inputs.
+
+    :param module: hardening module name, e.g. 'os'
+    :type module: str
+    :param inputs: as returned by collect_inputs()
+    :type inputs: Dict[str, List[str]]
+    :returns: hex digest
+    :rtype: str
+    """
+    state = {
+        'settings': utils.get_settings(module),
+        'installed': sorted(package_index().installed.items()),
+        'files': {},
+        'sysctl': {k: _sysctl_state(k) for k in inputs.get('sysctl', [])},
+        'suid': {root: _suid_sgid_paths(root)
+                 for root in inputs.get('suid', [])},
+    }
+    for path in inputs.get('files', []):
+        state['files'].update(_file_state(path))
+    return hashlib.sha256(json.dumps(
+        state, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def is_current(module):
+    """Whether the last pass of module is still valid.
+
+    :param module: hardening module name, e.g. 'os'
+    :type module: str
+    :rtype: bool
+    """
+    interval = audit_interval()
+    if interval < 0:
+        return False
+    entry = unitdata.kv().get(AUDIT_CACHE_KEY, {}).get(module)
+    if not entry:
+        return False
+    if time.time() - entry['audited_at'] >= interval:
+        log("Full re-audit of hardening module '%s' is due" % module,
+            level=DEBUG)
+        return False
+    return entry['fingerprint'] == fingerprint(module, entry['inputs'])
+
+
+def record(module, checks):
+    """Record a completed pass of module and the audits it ran.
+
+    :param module: hardening module name, e.g. 'os'
+    :type module: str
+    :param checks: audits run by the module
+    :type checks: List[BaseAudit]
+    """
+    if audit_interval() < 0:
+        return
+    db = unitdata.kv()
+    cache = db.get(AUDIT_CACHE_KEY, {})
+    inputs = collect_inputs(module, checks)
+    if inputs is None:
+        cache.pop(module, None)
+    else:
+        cache[module] = {
+            'inputs': inputs,
+            'fingerprint': fingerprint(module, inputs),
+            'audited_at': time.time(),
+        }
+    db.set(AUDIT_CACHE_KEY, cache)
+    db.flush()
+
+
+def clear():
+    """Forget all recorded passes so the next one is a full audit."""
+    db = unitdata.kv()
+    db.unset(AUDIT_CACHE_KEY)
+    db.flush()
+
+
+def run_checks(module):
+    """Run the audits of a hardening module.
+
+    :param module: hardening module name, e.g. 'os'
+    :type module: str
+    :returns: the audits run
+    :rtype: List[BaseAudit]
+    """
+    log("Starting %s hardening checks." % module, level=DEBUG)
+    checks = []
+    for audits in RUN_CATALOG[module]:
+        checks.extend(audits.get_audits())
+    for check in checks:
+        log("Running '%s' check" % (check.__class__.__name__), level=DEBUG)
+        check.ensure_compliance()
+    log("%s hardening checks complete." % module, level=DEBUG)
+    return checks
+
+
+def harden(overrides=None):
+    """Hardening decorator.
+
+    Runs the hardening modules enabled by the 'harden' config option, or
+    overrides, before the decorated hook, skipping those whose last pass is
+    still current.
+
+    :param overrides: Optional list of stack modules used to override those
+                      provided with 'harden' config.
+    :returns: Returns value returned by decorated function once executed.
+    """
+    if overrides is None:
+        overrides = []
+
+    def _harden_inner1(f):
+        @functools.wraps(f)
+        def _harden_inner2(*args, **kwargs):
+            if _DISABLE_HARDENING_FOR_UNIT_TEST:
+                return f(*args, **kwargs)
+            enabled = overrides[:] or (config("harden") or "").split()
+            if not enabled:
+                log("No hardening applied to '%s'" % (f.__name__),
+                    level=DEBUG)
+                return f(*args, **kwargs)
+            unknown = [m for m in enabled if m not in RUN_CATALOG]
+            if unknown:
+                log("Unknown hardening modules '%s' - ignoring" %
+                    (', '.join(unknown)), level=WARNING)
+            for module in RUN_CATALOG:
+                if module not in enabled:
+                    continue
+                if is_current(module):
+                    log("Skipping hardening module '%s', nothing changed "
+                        "since the last audit" % module, level=DEBUG)
+                    continue
+                log("Executing hardening module '%s'" % module, level=DEBUG)
+                record(module, run_checks(module))
+            return f(*args, **kwargs)
+        return _harden_inner2
+
+    return _harden_inner1
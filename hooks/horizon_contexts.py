@@ -14,13 +14,14 @@
 
 # vim: set ts=4:et
 
+import hashlib
 import json
+import os
 
 from charmhelpers.core.hookenv import (
+    charm_dir,
     config,
-    relation_ids,
-    related_units,
-    relation_get,
+    relation_snapshot,
     local_unit,
     log,
     ERROR,
@@ -32,17 +33,28 @@ from charmhelpers.contrib.openstack.context import (
     OSContextGenerator,
     context_complete
 )
+from charmhelpers.contrib.openstack.utils import (
+    CompareOpenStackReleases,
+    os_release,
+)
 from charmhelpers.contrib.hahelpers.cluster import (
     https,
 )
 from charmhelpers.contrib.network.ip import (
     get_ipv6_addr,
     format_ipv6_addr,
-    get_relation_ip,
 )
 import charmhelpers.contrib.openstack.policyd as policyd
 
-from charmhelpers.core.host import pwgen
+from charmhelpers.core.host import (
+    get_total_ram,
+    pwgen,
+    write_file,
+)
+
+from hooks import apache
+from hooks.network_bindings import get_relation_ip
+from hooks.render_inputs import ANY
 
 VALID_ENDPOINT_TYPES = {
     'PUBLICURL': 'publicURL',
@@ -52,6 +64,35 @@ VALID_ENDPOINT_TYPES = {
 
 SSL_CERT_FILE = '/etc/apache2/ssl/horizon/cert_dashboard'
 SSL_KEY_FILE = '/etc/apache2/ssl/horizon/key_dashboard'
+APACHE_SSL_DIR = '/etc/apache2/ssl/horizon'
+# Combined certificate and key files for TLS termination in haproxy
+HAPROXY_CERT_DIR = '/etc/haproxy/horizon-certs'
+HAPROXY_BALANCE_ALGORITHMS = ('leastconn', 'roundrobin', 'source')
+
+# Static assets shipped by the package, and the charm-owned directory the
+# offline compressed builds go into. STATIC_ROOT and the Apache aliases
+# refer to the live build through the STATIC_ROOT_LINK symlink.
+STATIC_DIR = '/var/lib/openstack-dashboard/static'
+CHARM_STATIC_DIR = '/var/lib/charm/openstack-dashboard'
+STATIC_BUILD_DIR = os.path.join(CHARM_STATIC_DIR, 'builds')
+STATIC_ROOT_LINK = os.path.join(CHARM_STATIC_DIR, 'static')
+
+# Share of system RAM the WSGI daemon processes may use when sizing them.
+WSGI_RAM_FRACTION = 0.5
+
+MEMCACHE_PORT = 11211
+# Django cache backends usable for a shared memcached cluster, with the
+# client library package each one needs.
+MEMCACHE_BACKENDS = {
+    'pymemcache': {
+        'backend': 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'package': 'python3-pymemcache',
+    },
+    'pylibmc': {
+        'backend': 'django.core.cache.backends.memcached.PyLibMCCache',
+        'package': 'python3-pylibmc',
+    },
+}
 
 
 class HorizonHAProxyContext(OSContextGenerator):
@@ -68,11 +109,10 @@ class HorizonHAProxyContext(OSContextGenerator):
         else:
             cluster_hosts[l_unit] = get_relation_ip('cluster')
 
-        for rid in relation_ids('cluster'):
-            for unit in related_units(rid):
+        for units in relation_snapshot('cluster').values():
+            for unit, rdata in units.items():
                 _unit = unit.replace('/', '-')
-                addr = relation_get('private-address', rid=rid, unit=unit)
-                cluster_hosts[_unit] = addr
+                cluster_hosts[_unit] = rdata.get('private-address')
 
         log('Ensuring haproxy enabled in /etc/default/haproxy.')
         with open('/etc/default/haproxy', 'w') as out:
@@ -95,11 +135,90 @@ class HorizonHAProxyContext(OSContextGenerator):
                 config('haproxy-max-bytes-in-rate')
             ctxt['haproxy_limit_period'] = config('haproxy-limit-period')
 
+        if config('haproxy-server-maxconn'):
+            ctxt['haproxy_server_maxconn'] = config('haproxy-server-maxconn')
+
+        if config('haproxy-mode') == 'http':
+            ctxt.update(self.http_mode())
+
+        return ctxt
+
+    def http_mode(self):
+        '''
+        Settings for HTTP mode load balancing; dash_secure is only
+        terminated in haproxy when there are certificates to serve, and is
+        otherwise passed through in TCP mode.
+        '''
+        balance = config('haproxy-balance')
+        if balance not in HAPROXY_BALANCE_ALGORITHMS:
+            log("Unknown haproxy-balance '{}', using leastconn"
+                .format(balance), level=WARNING)
+            balance = 'leastconn'
+        webroot = (config('webroot') or '/').rstrip('/')
+        ctxt = {
+            'haproxy_service_modes': {'dash_insecure': 'http'},
+            'haproxy_balance': balance,
+            'haproxy_sticky_sessions': config('haproxy-sticky-sessions'),
+            'haproxy_check_url': '{}/auth/login/'.format(webroot),
+        }
+        if https():
+            digest = write_haproxy_certs()
+            if digest:
+                ctxt['haproxy_service_modes']['dash_secure'] = 'http'
+                ctxt['haproxy_ssl_crt'] = HAPROXY_CERT_DIR
+                ctxt['haproxy_ssl_crt_digest'] = digest
         return ctxt
 
 
+def write_haproxy_certs():
+    '''
+    Combine each certificate and key pair configured for Apache into the
+    PEM files haproxy serves for TLS termination.
+
+    :returns: digest of the certificates written, so that haproxy.cfg (and
+              the restart of haproxy) follows certificate changes, or None
+              if there are no certificates.
+    :rtype: Optional[str]
+    '''
+    try:
+        names = sorted(os.listdir(APACHE_SSL_DIR))
+    except OSError:
+        return None
+    digest = hashlib.sha256()
+    pems = []
+    for name in names:
+        if not name.startswith('cert'):
+            continue
+        key = 'key' + name[len('cert'):]
+        if key not in names:
+            continue
+        content = b''
+        for part in (name, key):
+            with open(os.path.join(APACHE_SSL_DIR, part), 'rb') as f:
+                content += f.read().rstrip(b'\n') + b'\n'
+        pem = '{}.pem'.format(name[len('cert_'):] or 'default')
+        pems.append((pem, content))
+        digest.update(content)
+    if not pems:
+        return None
+    os.makedirs(HAPROXY_CERT_DIR, mode=0o700, exist_ok=True)
+    for pem, content in pems:
+        path = os.path.join(HAPROXY_CERT_DIR, pem)
+        try:
+            with open(path, 'rb') as f:
+                if f.read() == content:
+                    continue
+        except OSError:
+            pass
+        write_file(path, content, perms=0o600)
+    for stale in set(os.listdir(HAPROXY_CERT_DIR)) - {p for p, _ in pems}:
+        os.remove(os.path.join(HAPROXY_CERT_DIR, stale))
+    return digest.hexdigest()
+
+
 class IdentityServiceContext(OSContextGenerator):
     interfaces = ['identity-service']
+    inputs = {'config': ANY, 'relations': ['identity-service']}
 
     def normalize(self, endpoint_type):
         """Normalizes the endpoint type values.
@@ -122,9 +241,8 @@ class IdentityServiceContext(OSContextGenerator):
         ctxt = {}
         regions = set()
 
-        for rid in relation_ids('identity-service'):
-            for unit in related_units(rid):
-                rdata = relation_get(rid=rid, unit=unit)
+        for units in relation_snapshot('identity-service').values():
+            for rdata in units.values():
                 default_role = config('default-role')
                 lc_default_role = config('default-role').lower()
                 for role in rdata.get('created_roles', '').split(','):
@@ -226,6 +344,8 @@ class IdentityServiceContext(OSContextGenerator):
 
 
 class HorizonContext(OSContextGenerator):
+    inputs = {'config': ANY}
+
     def __call__(self):
         ''' Provide all configuration for Horizon '''
         ctxt = {
@@ -285,6 +405,15 @@ class PolicydContext(OSContextGenerator):
     def __init__(self, policyd_extract_policy_dirs_fn):
         self.policyd_extract_policy_dirs_fn = policyd_extract_policy_dirs_fn
 
+    @property
+    def inputs(self):
+        return {
+            'config': ANY,
+            'files': [
+                os.path.join(charm_dir(), policyd.POLICYD_SUCCESS_FILENAME),
+                policyd.policyd_dir_for('openstack-dashboard')],
+        }
+
     def __call__(self):
         """Policyd variables for the local_settings.py configuration file.
 
@@ -306,6 +435,10 @@ class PolicydContext(OSContextGenerator):
 
 
 class ApacheContext(OSContextGenerator):
+    # https() reads the certificates and identity-service relations.
+    inputs = {'config': ANY,
+              'relations': ['certificates', 'identity-service']}
+
     def __call__(self):
         ''' Grab cert and key from configuraton for SSL config '''
         ctxt = {
@@ -326,6 +459,23 @@ class ApacheContext(OSContextGenerator):
         return ctxt
 
 
+class StaticAssetsContext(OSContextGenerator):
+    inputs = {'config': ANY}
+
+    def __call__(self):
+        ''' Serving of the dashboard static assets and HTTP/2 '''
+        if bool_from_string(config('offline-compression')):
+            static_root = STATIC_ROOT_LINK
+        else:
+            static_root = STATIC_DIR
+        return {
+            'static_root': static_root,
+            'static_precompression': config('static-precompression'),
+            'static_max_age': config('static-max-age'),
+            'http2': config('http2'),
+        }
+
+
 class ApacheSSLContext(context.ApacheSSLContext):
 
     interfaces = ['https']
@@ -335,8 +485,15 @@ class ApacheSSLContext(context.ApacheSSLContext):
     def __call__(self):
         return super(ApacheSSLContext, self).__call__()
 
+    def enable_modules(self):
+        # a2enmod only runs for the modules that are not enabled yet
+        return apache.enable_modules(['ssl', 'proxy', 'proxy_http',
+                                      'headers'])
+
 
 class RouterSettingContext(OSContextGenerator):
+    inputs = {'config': ['profile']}
+
     def __call__(self):
         ''' Enable/Disable Router Tab on horizon '''
         ctxt = {
@@ -346,6 +503,8 @@ class RouterSettingContext(OSContextGenerator):
 
 
 class LocalSettingsContext(OSContextGenerator):
+    inputs = {'relations': ['dashboard-plugin']}
+
     def __call__(self):
         ''' Additional config stanzas to be appended to local_settings.py '''
 
@@ -358,13 +517,12 @@ class LocalSettingsContext(OSContextGenerator):
             'priority',
             'conflicting-packages',
             'install-packages']
-        for rid in relation_ids("dashboard-plugin"):
+        for units in relation_snapshot("dashboard-plugin").values():
             try:
-                unit = related_units(rid)[0]
-            except IndexError:
+                unit, rdata = next(iter(units.items()))
+            except StopIteration:
                 pass
             else:
-                rdata = relation_get(unit=unit, rid=rid)
                 if set(('local-settings', 'priority')) <= set(rdata.keys()):
                     # Classic dashboard plugins may send non-json data but
                     # reactive charms send json. Attempt to json decode the
@@ -392,22 +550,22 @@ class LocalSettingsContext(OSContextGenerator):
 
 class WebSSOFIDServiceProviderContext(OSContextGenerator):
     interfaces = ['websso-fid-service-provider']
+    inputs = {'relations': ['websso-fid-service-provider']}
 
     def __call__(self):
         websso_keys = ['protocol-name', 'idp-name', 'user-facing-name']
 
         relations = []
-        for rid in relation_ids("websso-fid-service-provider"):
+        for units in relation_snapshot("websso-fid-service-provider").values():
             try:
                 # the first unit will do - the assumption is that all
                 # of them should advertise the same data. This needs
                 # refactoring if juju gets per-application relation data
                 # support
-                unit = related_units(rid)[0]
-            except IndexError:
+                rdata = next(iter(units.values()))
+            except StopIteration:
                 pass
             else:
-                rdata = relation_get(unit=unit, rid=rid)
                 if set(rdata).issuperset(set(websso_keys)):
                     relations.append({k: json.loads(rdata[k])
                                       for k in websso_keys})
@@ -415,3 +573,156 @@ class WebSSOFIDServiceProviderContext(OSContextGenerator):
         # service providers
         ctxt = {'websso_data': relations} if relations else {}
         return ctxt
+
+
+def memcache_cluster_backend():
+    """Return the memcached cluster client backend in use, if any.
+
+    Cluster mode needs a python3 Horizon (rocky or later), and the pymemcache
+    backend needs Django 3.2 (yoga or later); pylibmc is used instead on
+    older releases.
+
+    :returns: 'pymemcache', 'pylibmc' or None when cluster mode is disabled
+    :rtype: Optional[str]
+    """
+    if not config('memcache-cluster'):
+        return None
+    release = CompareOpenStackReleases(os_release('openstack-dashboard'))
+    if release < 'rocky':
+        log("memcache-cluster requires rocky or later, using local memcached",
+            level=WARNING)
+        return None
+    backend = config('memcache-backend')
+    if backend not in MEMCACHE_BACKENDS:
+        log("Unknown memcache-backend '{}', using pylibmc".format(backend),
+            level=WARNING)
+        backend = 'pylibmc'
+    if backend == 'pymemcache' and release < 'yoga':
+        log("pymemcache backend requires yoga or later, using pylibmc",
+            level=WARNING)
+        backend = 'pylibmc'
+    return backend
+
+
+def wsgi_tuning():
+    """Size the Horizon mod_wsgi daemon processes.
+
+    Processes follow the CPU count (see worker-multiplier) unless
+    wsgi-processes is set, but are capped so that they fit in
+    WSGI_RAM_FRACTION of the system RAM at wsgi-process-memory MB each.
+    A wsgi-process-memory of 0 or less sets no RAM cap.
+
+    :returns: processes, threads, maximum_requests, inactivity_timeout and
+              queue_timeout settings; 0 disables the last three.
+    :rtype: Dict[str, int]
+    """
+    processes = config('wsgi-processes')
+    if not processes:
+        processes = context._calculate_workers()
+        process_memory = config('wsgi-process-memory') or 0
+        if process_memory > 0:
+            by_ram = int(get_total_ram() * WSGI_RAM_FRACTION //
+                         (process_memory * 1024 * 1024))
+            processes = min(processes, by_ram)
+        processes = max(1, processes)
+    return {
+        'processes': processes,
+        'threads': config('wsgi-threads'),
+        'maximum_requests': config('wsgi-maximum-requests'),
+        'inactivity_timeout': config('wsgi-inactivity-timeout'),
+        'queue_timeout': config('wsgi-queue-timeout'),
+    }
+
+
+def wsgi_status_message():
+    """Summarise the WSGI sizing for the unit status message."""
+    tuning = wsgi_tuning()
+    return 'wsgi {} processes x {} threads'.format(
+        tuning['processes'], tuning['threads'])
+
+
+class HorizonWSGIWorkerConfigContext(context.WSGIWorkerConfigContext):
+    inputs = {
+        'config': ANY,
+        'state': [lambda: context._calculate_workers(),
+                  lambda: get_total_ram()],
+    }
+
+    def __call__(self):
+        ''' mod_wsgi daemon process sizing, see wsgi_tuning() '''
+        ctxt = super(HorizonWSGIWorkerConfigContext, self).__call__()
+        ctxt.update(wsgi_tuning())
+        return ctxt
+
+
+def memcache_cluster_address():
+    """Return the address memcached listens on in cluster mode, if any."""
+    if memcache_cluster_backend() is None:
+        return None
+    return get_relation_ip('cluster')
+
+
+class MemcacheClusterContext(OSContextGenerator):
+    inputs = {
+        'config': ANY,
+        'relations': ['cluster'],
+        'state': [lambda: memcache_cluster_backend(),
+                  lambda: memcache_cluster_address()],
+    }
+
+    def __call__(self):
+        '''
+        memcached server and Django cache client configuration.
+
+        In cluster mode every unit's memcached listens on its cluster address
+        and all units share the same sorted server list, so the client's
+        consistent hashing maps a key to the same server on every unit and
+        sessions survive the loss of the unit that created them.
+        '''
+        backend = memcache_cluster_backend()
+        if backend is None:
+            return {
+                'memcache_server': '127.0.0.1',
+                'memcache_port': MEMCACHE_PORT,
+            }
+
+        local_addr = get_relation_ip('cluster')
+        addrs = {local_addr}
+        for units in relation_snapshot('cluster').values():
+            for rdata in units.values():
+                if rdata.get('private-address'):
+                    addrs.add(rdata['private-address'])
+
+        servers = sorted(
+            '{}:{}'.format(format_ipv6_addr(addr) or addr, MEMCACHE_PORT)
+            for addr in addrs)
+
+        if backend == 'pymemcache':
+            options = {
+                'use_pooling': True,
+                'max_pool_size': config('memcache-pool-size'),
+                'connect_timeout': 1,
+                'timeout': 1,
+                'retry_attempts': 2,
+                'dead_timeout': 30,
+                'ignore_exc': True,
+            }
+        else:
+            options = {
+                'binary': True,
+                'behaviors': {
+                    'ketama': True,
+                    'tcp_nodelay': True,
+                    'remove_failed': 2,
+                    'retry_timeout': 30,
+                    'dead_timeout': 30,
+                },
+            }
+
+        return {
+            'memcache_server': local_addr,
+            'memcache_port': MEMCACHE_PORT,
+            'memcache_servers': servers,
+            'memcache_backend': MEMCACHE_BACKENDS[backend]['backend'],
+            'memcache_options': options,
+        }
@@ -32,9 +32,15 @@ def _add_path(path):
 
 _add_path(_root)
 
+from hooks import import_profile  # noqa: E402
+
+if import_profile.enabled():
+    import_profile.start()
+
 from charmhelpers.core.hookenv import (
     config,
-    Hooks,
+    INFO,
+    hook_name,
     is_leader,
     local_unit,
     log,
@@ -49,17 +55,9 @@ from charmhelpers.core.hookenv import (
     unit_get,
     UnregisteredHookError,
 )
-from charmhelpers.fetch import (
-    apt_autoremove,
-    apt_install,
-    apt_purge,
-    apt_update,
-    filter_installed_packages,
-    filter_missing_packages,
-)
 from charmhelpers.core.host import (
+    init_is_systemd,
     lsb_release,
-    service_reload,
     service_restart,
 )
 from charmhelpers.contrib.openstack.ip import (
@@ -80,30 +78,42 @@ from charmhelpers.contrib.openstack.utils import (
 from charmhelpers.contrib.openstack.ha.utils import (
     generate_ha_relation_data,
 )
-from charmhelpers.contrib.network.ip import (
-    get_relation_ip,
-)
 from charmhelpers.contrib.openstack.cert_utils import (
     get_certificate_request,
     process_certificates,
 )
+from charmhelpers.contrib.openstack.templating import flush_context_cache
+from charmhelpers.core import unitdata
 from charmhelpers.contrib.hahelpers.apache import install_ca_cert
 
 from charmhelpers.payload.execd import execd_preinstall
 from charmhelpers.contrib.charmsupport import nrpe
-from charmhelpers.contrib.hardening.harden import harden
 
+from hooks import effects, tracing, unit_state
+from hooks.hardening import harden
+from hooks.network_bindings import get_relation_ip
+from hooks.packages import (
+    apt_autoremove,
+    apt_install,
+    apt_purge,
+    apt_update,
+    filter_installed_packages,
+    filter_missing_packages,
+)
 from hooks.horizon_utils import (
     assess_status,
+    assess_status_fast,
     check_custom_theme,
     db_migration,
+    determine_memcache_packages,
     determine_packages,
     do_openstack_upgrade,
     enable_ssl,
     get_plugin_packages_from_kv,
     INSTALL_DIR,
-    LOCAL_SETTINGS, HAPROXY_CONF,
+    NRPE,
     pause_unit_helper,
+    refresh_static_assets,
     register_configs,
     remove_old_packages,
     restart_map,
@@ -115,7 +125,7 @@ from hooks.horizon_utils import (
 )
 
 
-hooks = Hooks()
+hooks = effects.Hooks()
 # Note that CONFIGS is now set up via resolve_CONFIGS so that it is not a
 # module load time constraint.
 CONFIGS = None
@@ -126,12 +136,15 @@ def resolve_CONFIGS(force_update=False):
     at module load time.  Note that it also returns the CONFIGS so that it can
     be used in other, module loadtime, functions.
 
-    :param force_update: Force a refresh of CONFIGS
+    :param force_update: Force a refresh of CONFIGS and flush any cached
+        context generator results.
     :type force_update: bool
     :returns: CONFIGS variable
     :rtype: `:class:templating.OSConfigRenderer`
     """
     global CONFIGS
+    if force_update:
+        flush_context_cache()
     if CONFIGS is None or force_update:
         CONFIGS = register_configs()
     return CONFIGS
@@ -167,6 +180,8 @@ def upgrade_charm():
     packages_removed = remove_old_packages()
     update_nrpe_config()
     CONFIGS.write_all()
+    if refresh_static_assets() and not packages_removed:
+        service_restart('apache2')
     if packages_removed:
         log("Package purge detected, restarting services", "INFO")
         for s in services():
@@ -190,10 +205,16 @@ def config_changed():
         apt_install(filter_installed_packages(['python-lesscpy']),
                     fatal=True)
 
+    memcache_packages = filter_installed_packages(
+        determine_memcache_packages())
+    if memcache_packages:
+        apt_install(memcache_packages, fatal=True)
+
     # Ensure default role changes are propagated to keystone
     for relid in relation_ids('identity-service'):
         keystone_joined(relid)
-    enable_ssl()
+    if enable_ssl():
+        effects.reload('apache2')
 
     if not config('action-managed-upgrade'):
         if openstack_upgrade_available('openstack-dashboard'):
@@ -215,6 +236,8 @@ def config_changed():
     update_nrpe_config()
     CONFIGS.write_all()
     check_custom_theme()
+    if refresh_static_assets():
+        effects.restart(['apache2'])
     open_port(80)
     open_port(443)
     for relid in relation_ids('certificates'):
@@ -242,7 +265,7 @@ def keystone_joined(rel_id=None):
 @restart_on_change(restart_map(), stopstart=True, sleep=3)
 def keystone_changed():
     resolve_CONFIGS()
-    CONFIGS.write_all()
+    CONFIGS.write_affected()
     if relation_get('ca_cert'):
         install_ca_cert(b64decode(relation_get('ca_cert')))
 
@@ -259,7 +282,9 @@ def cluster_joined(relation_id=None):
 @restart_on_change(restart_map(), stopstart=True, sleep=3)
 def cluster_relation():
     resolve_CONFIGS()
-    CONFIGS.write(HAPROXY_CONF)
+    # haproxy.cfg, the memcache-cluster server list and local_settings.py
+    # follow the cluster peers.
+    CONFIGS.write_affected()
 
 
 @hooks.hook('ha-relation-joined')
@@ -283,11 +308,15 @@ def website_relation_joined():
 @hooks.hook('nrpe-external-master-relation-joined',
             'nrpe-external-master-relation-changed')
 def update_nrpe_config():
-    # python-dbus is used by check_upstart_job
-    apt_install('python-dbus')
+    # python-dbus is used by check_upstart_job, which is only needed for
+    # services that are not managed by systemd.
+    if not all(init_is_systemd(service_name=svc) for svc in services()):
+        missing = filter_installed_packages(['python-dbus'])
+        if missing:
+            apt_install(missing)
     hostname = nrpe.get_nagios_hostname()
     current_unit = nrpe.get_nagios_unit_name()
-    nrpe_setup = nrpe.NRPE(hostname=hostname)
+    nrpe_setup = NRPE(hostname=hostname)
     nrpe.copy_nrpe_checks()
     nrpe.add_init_service_checks(nrpe_setup, services(), current_unit)
     nrpe.add_haproxy_checks(nrpe_setup, current_unit)
@@ -331,10 +360,11 @@ def update_plugin_config():
         status_set('maintenance', 'Installing packages')
         apt_install(add_packages, fatal=True)
     if remove_packages or add_packages:
+        refresh_static_assets()
         log("Package installation/purge detected, restarting services", "INFO")
         for s in services():
             service_restart(s)
-    CONFIGS.write(LOCAL_SETTINGS)
+    CONFIGS.write_affected()
 
 
 @hooks.hook('dashboard-plugin-relation-departed')
@@ -367,10 +397,11 @@ def remove_plugin_config():
             apt_install(install_packages, fatal=True)
             changed = True
     if changed:
+        refresh_static_assets()
         log("Package installation/purge detected, restarting services", "INFO")
         for s in services():
             service_restart(s)
-    CONFIGS.write(LOCAL_SETTINGS)
+    CONFIGS.write_affected()
 
 
 @hooks.hook('update-status')
@@ -428,7 +459,7 @@ def db_changed():
 @restart_on_change(restart_map(), stopstart=True, sleep=3)
 def websso_sp_changed():
     resolve_CONFIGS()
-    CONFIGS.write_all()
+    CONFIGS.write_affected()
 
 
 @hooks.hook('websso-trusted-dashboard-relation-joined',
@@ -465,12 +496,26 @@ def websso_trusted_dashboard_changed():
 
 
 def main():
-    try:
-        hooks.execute(sys.argv)
-    except UnregisteredHookError as e:
-        log('Unknown hook {} - skipping.'.format(e))
-    resolve_CONFIGS()
-    assess_status(CONFIGS)
+    if import_profile.enabled():
+        import_profile.stop()
+        log(import_profile.format_report(import_profile.report()),
+            level=INFO)
+    db = unitdata.kv()
+    unit_state.use_wal(db)
+    with tracing.trace_hook(hook_name(), enable=config('hook-tracing'),
+                            keep=config('hook-tracing-keep')):
+        # The kv flushes of the hook and of the status assessment are
+        # committed once.
+        with unit_state.deferred_commit(db):
+            try:
+                hooks.execute(sys.argv)
+            except UnregisteredHookError as e:
+                log('Unknown hook {} - skipping.'.format(e))
+            if not (hook_name() == 'update-status' and assess_status_fast()):
+                resolve_CONFIGS()
+                assess_status(CONFIGS)
+        # Keeps the unit state db bounded over years of update-status hooks.
+        unit_state.maintain(db)
 
 
 @hooks.hook('certificates-relation-joined')
@@ -481,12 +526,17 @@ def certs_joined(relation_id=None):
 
 
 @hooks.hook('certificates-relation-changed')
+@restart_on_change(restart_map(), stopstart=True, sleep=3)
 def certs_changed(relation_id=None, unit=None):
     resolve_CONFIGS()
     process_certificates('horizon', relation_id, unit)
-    CONFIGS.write_all()
-    service_reload('apache2')
-    enable_ssl()
+    # The SSL contexts read the certificates just written to disk.
+    flush_context_cache()
+    # Called for every certificates unit from config-changed; the render and
+    # reload are done once for all of them.
+    effects.render(CONFIGS, affected=True, relations=['certificates'])
+    effects.call(enable_ssl)
+    effects.reload('apache2')
 
 
 @hooks.hook('pre-series-upgrade')
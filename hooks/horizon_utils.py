@@ -16,13 +16,21 @@
 
 from collections import OrderedDict
 from copy import deepcopy
+import glob
+import grp
+import gzip
+import hashlib
+import io
 import json
 import os
+import pwd
 import shutil
 import subprocess
 import time
 import tarfile
+import yaml
 
+import charmhelpers.contrib.charmsupport.nrpe as nrpe
 import charmhelpers.contrib.hahelpers.cluster as ch_cluster
 import charmhelpers.contrib.openstack.context as context
 import charmhelpers.contrib.openstack.templating as templating
@@ -37,6 +45,7 @@ from charmhelpers.contrib.openstack.utils import (
     make_assess_status_func,
     is_unit_paused_set,
     os_application_version_set,
+    ows_check_services_running,
     CompareOpenStackReleases,
     reset_os_release,
 )
@@ -46,33 +55,45 @@ from charmhelpers.core.hookenv import (
     ERROR,
     hook_name,
     INFO,
+    local_unit,
     log,
-    related_units,
     relation_get,
     relation_ids,
+    relation_set,
+    relation_snapshot,
+    relation_type,
     resource_get,
+    status_get,
+    status_set,
 )
 from charmhelpers.core.host import (
+    AtomicWriteBatch,
     cmp_pkgrevno,
     CompareHostReleases,
+    file_hash,
+    is_staged_file,
     lsb_release,
     mkdir,
-    path_hash,
     service,
     write_file,
 )
-from charmhelpers.fetch import (
+from charmhelpers.core.strutils import bool_from_string
+from charmhelpers.fetch import add_source
+import charmhelpers.core.unitdata as unitdata
+
+import hooks.apache as apache
+import hooks.effects as effects
+import hooks.horizon_contexts as horizon_contexts
+import hooks.render_inputs as render_inputs
+from hooks.packages import (
+    package_index,
     apt_upgrade,
     apt_update,
-    add_source,
     apt_install,
     apt_purge,
     apt_autoremove,
     filter_missing_packages,
 )
-import charmhelpers.core.unitdata as unitdata
-
-import hooks.horizon_contexts as horizon_contexts
 
 BASE_PACKAGES = [
     'haproxy',
@@ -94,6 +115,7 @@ PY3_PACKAGES = [
     'python3-novaclient',
     'python3-memcache',
     'python3-pymysql',
+    'python3-brotli',
     'libapache2-mod-wsgi-py3',
 ]
 
@@ -117,6 +139,7 @@ LOCAL_SETTINGS = "/etc/openstack-dashboard/local_settings.py"
 DASHBOARD_CONF_DIR = "/etc/openstack-dashboard/"
 DASHBOARD_PKG_DIR = "/usr/share/openstack-dashboard/openstack_dashboard"
 HAPROXY_CONF = "/etc/haproxy/haproxy.cfg"
+MEMCACHED_CONF = "/etc/memcached.conf"
 APACHE_CONF = os.path.join(APACHE_CONF_DIR, "conf.d/openstack-dashboard.conf")
 APACHE_24_CONF = os.path.join(APACHE_CONF_DIR,
                               "conf-available/openstack-dashboard.conf")
@@ -136,6 +159,28 @@ CONSISTENCY_GROUP_POLICY = os.path.join(
 TEMPLATES = 'templates'
 CUSTOM_THEME_DIR = os.path.join(DASHBOARD_PKG_DIR, "themes/custom")
 LOCAL_DIR = os.path.join(DASHBOARD_PKG_DIR, 'local/local_settings.d')
+STATIC_DIR = horizon_contexts.STATIC_DIR
+# Static assets worth serving precompressed, and the smallest one to bother
+PRECOMPRESS_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.html', '.txt',
+                          '.map', '.eot', '.ttf')
+PRECOMPRESS_MIN_SIZE = 1024
+# Variants written by precompress_static_assets(), with their asset's stamp
+PRECOMPRESSED_KV_KEY = 'static-precompressed'
+MANAGE_PY = "/usr/share/openstack-dashboard/manage.py"
+# local_settings.d snippet pointing STATIC_ROOT at the live offline compressed
+# build, or at the staging directory of build_static_assets() while it runs.
+STATIC_ROOT_SETTING = os.path.join(LOCAL_DIR, '_99_juju_static_root.py')
+STATIC_ROOT_SETTING_CONTENT = """\
+# Managed by juju: the static assets are served from the offline compressed
+# build {link} points at. build_static_assets() sets
+# HORIZON_STATIC_ROOT to build the next one beside it.
+import os as _os
+STATIC_ROOT = _os.environ.get('HORIZON_STATIC_ROOT', '{link}')
+COMPRESS_ROOT = STATIC_ROOT
+""".format(link=horizon_contexts.STATIC_ROOT_LINK)
+STATIC_ASSETS_KV_KEY = 'static-assets-digest'
+# Outcome of the last full assess_status(), see assess_status_fast()
+STATUS_SNAPSHOT_KV_KEY = 'status-snapshot'
 
 CONFIG_FILES = OrderedDict([
     (LOCAL_SETTINGS, {
@@ -145,6 +190,7 @@ CONFIG_FILES = OrderedDict([
                           horizon_contexts.LocalSettingsContext(),
                           horizon_contexts.ApacheSSLContext(),
                           horizon_contexts.WebSSOFIDServiceProviderContext(),
+                          horizon_contexts.MemcacheClusterContext(),
                           horizon_contexts.PolicydContext(
                               lambda: read_policyd_dirs())],
         'services': ['apache2', 'memcached']
@@ -152,23 +198,27 @@ CONFIG_FILES = OrderedDict([
     (APACHE_CONF, {
         'hook_contexts': [horizon_contexts.HorizonContext(),
                           context.SyslogContext(),
-                          context.WSGIWorkerConfigContext()],
+                          horizon_contexts.HorizonWSGIWorkerConfigContext(),
+                          horizon_contexts.StaticAssetsContext()],
         'services': ['apache2', 'memcached'],
     }),
     (APACHE_24_CONF, {
         'hook_contexts': [horizon_contexts.HorizonContext(),
                           context.SyslogContext(),
-                          context.WSGIWorkerConfigContext()],
+                          horizon_contexts.HorizonWSGIWorkerConfigContext(),
+                          horizon_contexts.StaticAssetsContext()],
         'services': ['apache2', 'memcached'],
     }),
     (APACHE_SSL, {
         'hook_contexts': [horizon_contexts.ApacheSSLContext(),
-                          horizon_contexts.ApacheContext()],
+                          horizon_contexts.ApacheContext(),
+                          horizon_contexts.StaticAssetsContext()],
         'services': ['apache2', 'memcached'],
     }),
     (APACHE_24_SSL, {
         'hook_contexts': [horizon_contexts.ApacheSSLContext(),
-                          horizon_contexts.ApacheContext()],
+                          horizon_contexts.ApacheContext(),
+                          horizon_contexts.StaticAssetsContext()],
         'services': ['apache2', 'memcached'],
     }),
     (APACHE_DEFAULT, {
@@ -191,6 +241,10 @@ CONFIG_FILES = OrderedDict([
         ],
         'services': ['haproxy'],
     }),
+    (MEMCACHED_CONF, {
+        'hook_contexts': [horizon_contexts.MemcacheClusterContext()],
+        'services': ['memcached'],
+    }),
     (ROUTER_SETTING, {
         'hook_contexts': [horizon_contexts.RouterSettingContext()],
         'services': ['apache2', 'memcached'],
@@ -216,6 +270,9 @@ def register_configs():
              HAPROXY_CONF,
              PORTS_CONF]
 
+    if memcached_conf_managed():
+        confs.append(MEMCACHED_CONF)
+
     if (CompareOpenStackReleases(release) >= 'queens' and
             CompareOpenStackReleases(release) <= 'stein'):
         configs.register(
@@ -249,27 +306,96 @@ def register_configs():
     return configs
 
 
+def memcached_conf_managed():
+    """Whether the charm renders MEMCACHED_CONF.
+
+    It does in memcache-cluster mode, and keeps doing so once it has, so that
+    disabling cluster mode renders the local settings back. Otherwise the
+    package's memcached.conf is left alone.
+
+    :rtype: bool
+    """
+    return (horizon_contexts.memcache_cluster_backend() is not None or
+            templating.rendered_context(MEMCACHED_CONF) is not None)
+
+
 class HorizonOSConfigRenderer(templating.OSConfigRenderer):
 
+    def config_services(self, config_file):
+        """Return the services to restart when config_file changes."""
+        try:
+            return list(CONFIG_FILES[config_file]['services'])
+        except KeyError:
+            return []
+
+    def write(self, config_file):
+        """Write a single config file, see OSConfigRenderer.write(), and
+        record the inputs it was rendered from for write_affected().
+
+        :returns: the change made, or None if the file was already up to date
+        :rtype: Optional[templating.ConfigChange]
+        """
+        if self._batch is None:
+            with self.batch():
+                return self.write(config_file)
+        change = super(HorizonOSConfigRenderer, self).write(config_file)
+        render_inputs.record(config_file,
+                             self.templates[config_file].contexts,
+                             self.openstack_release)
+        return change
+
+    def write_affected(self, relations=None):
+        """Write the registered config files affected by the changes of
+        this hook as a single batch, see render_inputs.is_affected().
+
+        :param relations: names of the relations whose data changed, defaults
+            to the relation of the current hook
+        :type relations: Optional[Iterable[str]]
+        :returns: the changes made
+        :rtype: List[templating.ConfigChange]
+        """
+        if relations is None:
+            relations = [relation_type()] if relation_type() else []
+        changes = []
+        with self.batch():
+            for config_file, ostmpl in self.templates.items():
+                # Checked as we go: generators evaluated for earlier files
+                # may update the input files of later ones (certificates).
+                if not render_inputs.is_affected(config_file, ostmpl.contexts,
+                                                 self.openstack_release,
+                                                 relations):
+                    log('Template %s not affected, skipping.' % config_file,
+                        level=DEBUG)
+                    continue
+                changes.append(self.write(config_file))
+        return [c for c in changes if c is not None]
+
     def write_all(self):
         """Write all of the config files.
 
         This function subclasses the parent version of the function such that
         if the hook is config-changed or upgrade-charm then it defers writing
         the LOCAL_SETTINGS file until after processing the policyd stuff.
+
+        :returns: the changes made
+        :rtype: List[templating.ConfigChange]
         """
         _hook = hook_name()
         if _hook not in ('upgrade-charm.real', 'config-changed'):
             return super(HorizonOSConfigRenderer, self).write_all()
-        # Otherwise, first do all the other templates
-        for k in self.templates.keys():
-            if k != LOCAL_SETTINGS:
-                self.write(k)
+        # Otherwise, first do all the other templates, as one batch that is
+        # in place before the policyd override copies the templated policies.
+        with self.batch():
+            changes = [self.write(k) for k in self.templates.keys()
+                       if k != LOCAL_SETTINGS]
         # Now do the policy overrides thing
         maybe_handle_policyd_override(os_release('openstack-dashboard'),
                                       _hook)
+        # The policyd context depends on the outcome of the override.
+        templating.flush_context_cache(horizon_contexts.PolicydContext)
         # Finally, let's do the LOCAL_SETTINGS if the policyd worked.
-        self.write(LOCAL_SETTINGS)
+        changes.append(self.write(LOCAL_SETTINGS))
+        return [c for c in changes if c is not None]
 
 
 def maybe_handle_policyd_override(openstack_release, hook):
@@ -362,27 +488,37 @@ def copy_conf_to_policyd():
     This is used after processing the policy.d resource file to put the package
     and templated policy files in DASHBOARD_PKG_DIR/conf/ into the
     /etc/openstack-dashboard/policy.d/
+
+    Changed files are replaced together, in one batch, once every file has
+    been read.
     """
     log("policyd: copy files from conf to /etc/openstack-dashboard/policy.d",
         level=INFO)
     conf_dir = os.path.join(DASHBOARD_PKG_DIR, 'conf')
     conf_parts_count = len(conf_dir.split(os.path.sep))
     policy_dir = policyd.policyd_dir_for('openstack-dashboard')
-    for root, dirs, files in os.walk(conf_dir):
-        # make _root relative to the conf_dir
-        _root = os.path.sep.join(root.split(os.path.sep)[conf_parts_count:])
-        # make any dirs necessary
-        for d in dirs:
-            _dir = os.path.join(policy_dir, _root, d)
-            if not os.path.exists(_dir):
-                mkdir(_dir, owner='horizon', group='horizon', perms=0o775)
-        # now copy the files.
-        for f in files:
-            source = os.path.join(conf_dir, _root, f)
-            dest = os.path.join(policy_dir, _root, f)
-            with open(source, 'r') as fh:
-                content = fh.read()
-            write_file(dest, content, 'horizon', 'horizon')
+    with AtomicWriteBatch() as batch:
+        for root, dirs, files in os.walk(conf_dir):
+            # make _root relative to the conf_dir
+            _root = os.path.sep.join(
+                root.split(os.path.sep)[conf_parts_count:])
+            # make any dirs necessary
+            for d in dirs:
+                _dir = os.path.join(policy_dir, _root, d)
+                if not os.path.exists(_dir):
+                    mkdir(_dir, owner='horizon', group='horizon', perms=0o775)
+            # now copy the files.
+            for f in files:
+                if is_staged_file(f):
+                    continue
+                source = os.path.join(conf_dir, _root, f)
+                dest = os.path.join(policy_dir, _root, f)
+                with open(source, 'r') as fh:
+                    content = fh.read()
+                digest = hashlib.sha256(content.encode('UTF-8')).hexdigest()
+                if file_hash(dest, hash_type='sha256') != digest:
+                    batch.stage(dest, content, owner='horizon',
+                                group='horizon', perms=0o444)
     log("...done.", level=INFO)
 
 
@@ -479,11 +615,107 @@ def services():
 
 
 def enable_ssl():
-    ''' Enable SSL support in local apache2 instance '''
-    subprocess.call(['a2ensite', 'default-ssl'])
-    subprocess.call(['a2enmod', 'ssl'])
-    subprocess.call(['a2enmod', 'rewrite'])
-    subprocess.call(['a2enmod', 'headers'])
+    ''' Enable SSL support in local apache2 instance
+
+    :returns: whether a site or module was enabled, i.e. apache2 needs a
+              reload
+    :rtype: bool
+    '''
+    modules = ['ssl', 'rewrite', 'headers']
+    if config('http2'):
+        modules.append('http2')
+    changed = apache.enable_sites(['default-ssl'], fatal=False)
+    return apache.enable_modules(modules, fatal=False) or changed
+
+
+def _gzip(data):
+    out = io.BytesIO()
+    # mtime=0 keeps the output identical for identical input
+    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=9,
+                       mtime=0) as f:
+        f.write(data)
+    return out.getvalue()
+
+
+def precompress_static_assets(static_dir=STATIC_DIR):
+    """Write precompressed variants of the dashboard static assets.
+
+    Each compressible asset gets a .gz variant, and a .br variant when the
+    brotli module is available, for Apache to serve to clients that accept
+    them. Each variant is given the mtime of its asset, which Apache checks
+    before serving it, so a variant outdated by an out-of-band package
+    upgrade is never served.
+
+    The variants written in static_dir are recorded with the mtime and size
+    of their asset, so repeated runs only rewrite variants whose asset
+    changed, and only recorded variants are removed when their asset goes
+    away. Variants shipped by the packages are left alone.
+
+    :param static_dir: directory of the collected static assets
+    :type static_dir: str
+    :returns: number of variants written
+    :rtype: int
+    """
+    encoders = [('.gz', _gzip)]
+    try:
+        import brotli
+    except ImportError:
+        log("brotli module not available, precompressing with gzip only",
+            level=DEBUG)
+    else:
+        encoders.append(('.br', brotli.compress))
+
+    db = unitdata.kv()
+    state = db.get(PRECOMPRESSED_KV_KEY) or {}
+    recorded = {}
+    if state.get('root') == static_dir:
+        recorded = state['variants']
+    created = {}
+    written = 0
+    for root, _, files in os.walk(static_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.endswith(('.gz.tmp', '.br.tmp')):
+                # Left behind by an interrupted run
+                os.remove(path)
+                continue
+            if not name.endswith(PRECOMPRESS_EXTENSIONS):
+                continue
+            st = os.stat(path)
+            if st.st_size < PRECOMPRESS_MIN_SIZE:
+                continue
+            stamp = [st.st_mtime_ns, st.st_size]
+            data = None
+            for suffix, encode in encoders:
+                variant = path + suffix
+                key = os.path.relpath(variant, static_dir)
+                if key not in recorded and os.path.exists(variant):
+                    continue
+                if recorded.get(key) == stamp and os.path.exists(variant):
+                    created[key] = stamp
+                    continue
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                compressed = encode(data)
+                if len(compressed) >= len(data):
+                    continue
+                tmp = variant + '.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(compressed)
+                os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+                os.rename(tmp, variant)
+                created[key] = stamp
+                written += 1
+    for key in set(recorded) - set(created):
+        try:
+            os.remove(os.path.join(static_dir, key))
+        except OSError:
+            pass
+    db.set(PRECOMPRESSED_KV_KEY, {'root': static_dir, 'variants': created})
+    db.flush()
+    log("Precompressed {} static asset variants".format(written), level=INFO)
+    return written
 
 
 def determine_packages():
@@ -506,6 +738,7 @@ def determine_packages():
         # NOTE(jamespage): Django in Ubuntu disco or later uses
         #                  mysqldb rather than pymysql.
         packages.append('python3-mysqldb')
+    packages.extend(determine_memcache_packages())
     packages = set(packages)
     if release >= 'train':
         packages.remove('python3-neutron-lbaas-dashboard')
@@ -522,6 +755,18 @@ def determine_packages():
     return list(packages)
 
 
+def determine_memcache_packages():
+    """Determine the memcached client packages for the cache backend.
+
+    :returns: List of packages needed by the memcache-cluster backend
+    :rtype: List[str]
+    """
+    backend = horizon_contexts.memcache_cluster_backend()
+    if backend is None:
+        return []
+    return [horizon_contexts.MEMCACHE_BACKENDS[backend]['package']]
+
+
 def determine_packages_dashboard_plugin():
     """Determine the packages to install from the 'dashboard-plugin' relation.
 
@@ -533,9 +778,8 @@ def determine_packages_dashboard_plugin():
     :rtype: List[str]
     """
     packages = []
-    for rid in relation_ids("dashboard-plugin"):
-        for unit in related_units(rid):
-            rdata = relation_get(unit=unit, rid=rid)
+    for rid, units in relation_snapshot("dashboard-plugin").items():
+        for unit, rdata in units.items():
             install_packages_json = rdata.get("install-packages", "[]")
             try:
                 packages.extend(json.loads(install_packages_json))
@@ -586,9 +830,8 @@ def determine_purge_packages_dashboard_plugin():
     :rtype: List[str]
     """
     conflict_packages = []
-    for rid in relation_ids("dashboard-plugin"):
-        for unit in related_units(rid):
-            rdata = relation_get(unit=unit, rid=rid)
+    for rid, units in relation_snapshot("dashboard-plugin").items():
+        for unit, rdata in units.items():
             conflicting_packages_json = rdata.get("conflicting-packages", "[]")
             try:
                 conflict_packages.extend(json.loads(conflicting_packages_json))
@@ -771,10 +1014,15 @@ def restart_on_change(restart_map, stopstart=False, sleep=0):
 
     In this example, the cinder-api and cinder-volume services
     would be restarted if /etc/ceph/ceph.conf is changed by the
-    ceph_client_changed function. The apache2 service would be
-    restarted if any file matching the pattern got changed, created
-    or removed. Standard wildcards are supported, see documentation
-    for the 'glob' module for more information.
+    ceph_client_changed function.
+
+    Changes are taken from the change-set recorded by the config renderer
+    (see charmhelpers.contrib.openstack.templating.config_changes()) so only
+    files written through CONFIGS are considered and nothing is re-read from
+    disk.
+
+    Inside effects.deferred() the check runs after the queued renders of
+    the hook, and the restarts are merged with the other restarts queued.
 
     param: sleep    Allow for sleep time between stop and start
                     Only used when stopstart=True
@@ -783,26 +1031,39 @@ def restart_on_change(restart_map, stopstart=False, sleep=0):
         def wrapped_f(*args, **kwargs):
             if is_unit_paused_set():
                 return f(*args, **kwargs)
-            checksums = {path: path_hash(path) for path in restart_map}
+            seen = len(templating.config_changes())
             f(*args, **kwargs)
-            restarts = []
-            for path in restart_map:
-                if path_hash(path) != checksums[path]:
-                    restarts += restart_map[path]
-            services_list = list(OrderedDict.fromkeys(restarts))
-            if not stopstart:
-                for service_name in services_list:
-                    service('restart', service_name)
-            else:
-                for action in ['stop', 'start']:
-                    for service_name in services_list:
-                        service(action, service_name)
-                        if action == 'stop' and sleep:
-                            time.sleep(sleep)
+            effects.call(_restart_changed, restart_map, seen, stopstart,
+                         sleep)
         return wrapped_f
     return wrap
 
 
+def _restart_changed(restart_map, seen, stopstart, sleep):
+    """Restart the services of the config files changed since seen."""
+    restarts = []
+    for change in templating.config_changes()[seen:]:
+        if change.config_file in restart_map:
+            log("{} changed ({} -> {}), restarting {}"
+                .format(change.config_file, change.old_digest,
+                        change.new_digest,
+                        ', '.join(restart_map[change.config_file])),
+                level=DEBUG)
+            restarts += restart_map[change.config_file]
+    services_list = list(OrderedDict.fromkeys(restarts))
+    if effects.active():
+        effects.restart(services_list, stopstart=stopstart, sleep=sleep)
+    elif not stopstart:
+        for service_name in services_list:
+            service('restart', service_name)
+    else:
+        for action in ['stop', 'start']:
+            for service_name in services_list:
+                service(action, service_name)
+                if action == 'stop' and sleep:
+                    time.sleep(sleep)
+
+
 def assess_status(configs):
     """Assess status of current unit
     Decides what the state of the unit should be based on the current
@@ -815,6 +1076,7 @@ def assess_status(configs):
     """
     assess_status_func(configs)()
     os_application_version_set(VERSION_PACKAGE)
+    _save_status_snapshot()
 
 
 def assess_status_func(configs):
@@ -834,7 +1096,75 @@ def assess_status_func(configs):
     _services, _ = ch_cluster.get_managed_services_and_ports(services(), [])
     return make_assess_status_func(
         configs, REQUIRED_INTERFACES,
-        services=_services, ports=None)
+        services=_services, ports=None,
+        ready_message=horizon_contexts.wsgi_status_message)
+
+
+def status_fingerprint():
+    """Digest of the inputs the workload status is derived from.
+
+    Covers the charm config, the data on the relations the status depends on
+    (REQUIRED_INTERFACES) and the paused flag.
+
+    :returns: hex digest
+    :rtype: str
+    """
+    relations = {}
+    for interfaces in REQUIRED_INTERFACES.values():
+        for reltype in interfaces:
+            relations[reltype] = relation_snapshot(reltype)
+    inputs = {
+        'config': dict(config()),
+        'relations': relations,
+        'paused': is_unit_paused_set(),
+    }
+    return hashlib.sha256(json.dumps(
+        inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _save_status_snapshot():
+    """Record the outcome of a full assessment for assess_status_fast()."""
+    state, message = status_get()
+    _services, _ = ch_cluster.get_managed_services_and_ports(services(), [])
+    db = unitdata.kv()
+    db.set(STATUS_SNAPSHOT_KV_KEY, {
+        'fingerprint': status_fingerprint(),
+        'state': state,
+        'message': message,
+        'services': _services,
+    })
+    db.flush()
+
+
+def assess_status_fast():
+    """Re-assess the unit from the snapshot of the last full assessment.
+
+    Used by update-status: when the unit was active and neither its config
+    nor its required relations changed since, only the liveness of the
+    services is probed, and the workload status is left untouched unless a
+    service has stopped. Building the renderer, evaluating the contexts and
+    setting the application version are skipped entirely.
+
+    :returns: whether the status was handled; if not, a full assessment is
+              required.
+    :rtype: bool
+    """
+    db = unitdata.kv()
+    snapshot = db.get(STATUS_SNAPSHOT_KV_KEY)
+    if not snapshot or snapshot.get('state') != 'active':
+        return False
+    if snapshot.get('fingerprint') != status_fingerprint():
+        log("Status inputs changed since the last assessment", level=DEBUG)
+        return False
+    state, message = ows_check_services_running(snapshot['services'], None)
+    if state is not None:
+        status_set(state, message)
+        # Any other hook runs the full assessment and records a new snapshot.
+        db.unset(STATUS_SNAPSHOT_KV_KEY)
+        db.flush()
+    else:
+        log("Status unchanged: {}".format(snapshot['message']), level=DEBUG)
+    return True
 
 
 def pause_unit_helper(configs):
@@ -872,6 +1202,270 @@ def _pause_resume_helper(f, configs):
       ports=None)
 
 
+def static_assets_digest():
+    """Digest of the inputs of the static asset build.
+
+    Covers the installed dashboard and plugin package versions, the custom
+    theme, the enabled/ panel files and the theme and webroot options.
+
+    :returns: hex digest
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    installed = package_index().installed
+    for package in sorted(installed):
+        if 'dashboard' in package or 'horizon' in package:
+            digest.update(
+                '{} {}\n'.format(package, installed[package]).encode())
+    for option in ('webroot', 'ubuntu-theme', 'default-theme',
+                   'custom-theme'):
+        digest.update('{}={}\n'.format(option, config(option)).encode())
+    for top in (CUSTOM_THEME_DIR,
+                os.path.join(DASHBOARD_PKG_DIR, 'enabled'),
+                os.path.join(DASHBOARD_PKG_DIR, 'local/enabled')):
+        for root, dirs, files in os.walk(top):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith('.pyc'):
+                    continue
+                path = os.path.join(root, name)
+                digest.update(path.encode())
+                digest.update(file_hash(path, 'sha256').encode())
+    return digest.hexdigest()
+
+
+def build_static_assets(force=False):
+    """Rebuild the offline compressed static assets if their inputs changed.
+
+    collectstatic and compress run into a new directory under
+    STATIC_BUILD_DIR, which is then made live by repointing the
+    STATIC_ROOT_LINK symlink that STATIC_ROOT and the Apache aliases refer
+    to, so the live assets are never partially built. Until the first build
+    succeeds the link points at the assets shipped by the package, which are
+    never modified. The previous build is kept.
+
+    With offline compression disabled, STATIC_ROOT is reset to the package
+    default.
+
+    :param force: rebuild even if the inputs are unchanged
+    :type force: bool
+    :returns: whether the live static assets changed
+    :rtype: bool
+    """
+    db = unitdata.kv()
+    if not bool_from_string(config('offline-compression')):
+        if not os.path.isfile(STATIC_ROOT_SETTING):
+            return False
+        os.remove(STATIC_ROOT_SETTING)
+        db.unset(STATIC_ASSETS_KV_KEY)
+        db.flush()
+        log("Offline compression disabled, serving the package static "
+            "assets", level=INFO)
+        return True
+
+    link = horizon_contexts.STATIC_ROOT_LINK
+    if not os.path.lexists(link):
+        mkdir(os.path.dirname(link))
+        os.symlink(STATIC_DIR, link)
+    if not os.path.isfile(STATIC_ROOT_SETTING):
+        write_file(STATIC_ROOT_SETTING, STATIC_ROOT_SETTING_CONTENT,
+                   perms=0o644)
+
+    digest = static_assets_digest()
+    build_dir = os.path.join(horizon_contexts.STATIC_BUILD_DIR, digest[:12])
+    if (not force and db.get(STATIC_ASSETS_KV_KEY) == digest and
+            os.path.realpath(link) == build_dir):
+        log("Static asset inputs unchanged, skipping build", level=DEBUG)
+        return False
+
+    if os.path.exists(build_dir):
+        shutil.rmtree(build_dir)
+    mkdir(horizon_contexts.STATIC_BUILD_DIR)
+    env = dict(os.environ, HORIZON_STATIC_ROOT=build_dir)
+    try:
+        for cmd in (['collectstatic', '--noinput'], ['compress', '--force']):
+            subprocess.check_call(['python3', MANAGE_PY] + cmd, env=env)
+    except subprocess.CalledProcessError as e:
+        log("Static asset build failed, keeping the current assets: {}"
+            .format(e), level=ERROR)
+        shutil.rmtree(build_dir, ignore_errors=True)
+        return False
+
+    _swap_static_root(build_dir)
+    db.set(STATIC_ASSETS_KV_KEY, digest)
+    db.flush()
+    log("Static assets rebuilt into {}".format(build_dir), level=INFO)
+    return True
+
+
+def _swap_static_root(build_dir):
+    """Point STATIC_ROOT_LINK at build_dir, keeping only the previous build."""
+    link = horizon_contexts.STATIC_ROOT_LINK
+    previous = os.path.realpath(link)
+    tmp = '{}.new'.format(link)
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(build_dir, tmp)
+    os.rename(tmp, link)
+    for name in os.listdir(horizon_contexts.STATIC_BUILD_DIR):
+        path = os.path.join(horizon_contexts.STATIC_BUILD_DIR, name)
+        if path not in (build_dir, previous):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def refresh_static_assets(force=False):
+    """Rebuild and precompress the static assets as needed.
+
+    :param force: rebuild even if the inputs are unchanged
+    :type force: bool
+    :returns: whether the live static assets changed, in which case the web
+        server needs restarting to pick up the new compressor manifest.
+    :rtype: bool
+    """
+    swapped = build_static_assets(force=force)
+    if config('static-precompression'):
+        if bool_from_string(config('offline-compression')):
+            precompress_static_assets(
+                os.path.realpath(horizon_contexts.STATIC_ROOT_LINK))
+        else:
+            precompress_static_assets()
+    return swapped
+
+
+def _read_file(path):
+    """Return the contents of path, or None if it cannot be read."""
+    try:
+        with open(path) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+class NRPE(nrpe.NRPE):
+    """An nrpe.NRPE that reconciles the checks instead of rewriting them.
+
+    write() only writes the check files and service definitions that differ
+    from the copies on disk, only restarts nagios-nrpe-server when a check
+    file was written or removed, and only sets the monitors data on the
+    relations where it differs.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(NRPE, self).__init__(*args, **kwargs)
+        # Whether remove_check() deleted a check nagios-nrpe-server had
+        # loaded.
+        self.checks_removed = False
+
+    def remove_check(self, *args, **kwargs):
+        check_file = os.path.join(
+            self.nrpe_confdir, 'check_{}.cfg'.format(kwargs.get('shortname')))
+        loaded = os.path.exists(check_file)
+        super(NRPE, self).remove_check(*args, **kwargs)
+        if loaded:
+            self.checks_removed = True
+
+    def _write_check(self, check):
+        """Write check and its service definition if they changed.
+
+        :returns: whether the check file changed
+        :rtype: bool
+        """
+        lines = ["# check {}\n".format(check.shortname)]
+        if self.nagios_servicegroups:
+            lines.extend([
+                "# The following header was added automatically by juju\n",
+                "# Modifying it will affect nagios monitoring and alerting\n",
+                "# servicegroups: {}\n".format(self.nagios_servicegroups)])
+        lines.append(
+            "command[{}]={}\n".format(check.command, check.check_cmd))
+        content = ''.join(lines)
+        check_file = check._get_check_filename()
+        changed = _read_file(check_file) != content
+        if changed:
+            with open(check_file, 'w') as f:
+                f.write(content)
+
+        if not os.path.exists(self.nagios_exportdir):
+            log('Not writing service config as {} is not accessible'.format(
+                self.nagios_exportdir))
+            return changed
+        overrides = ''
+        if check.max_check_attempts:
+            overrides = '    max_check_attempts              {}'.format(
+                check.max_check_attempts)
+        service_text = nrpe.Check.service_template.format(
+            nagios_hostname=self.hostname,
+            nagios_servicegroup=self.nagios_servicegroups,
+            description=check.description,
+            shortname=check.shortname,
+            command=check.command,
+            service_config_overrides=overrides)
+        service_file = check._get_service_filename(self.hostname)
+        service_files = glob.glob(os.path.join(
+            self.nagios_exportdir, '*_{}.cfg'.format(check.command)))
+        if (_read_file(service_file) != service_text or
+                service_files != [service_file]):
+            check._remove_service_files()
+            with open(service_file, 'w') as f:
+                f.write(service_text)
+        return changed
+
+    def write(self):
+        try:
+            nagios_uid = pwd.getpwnam('nagios').pw_uid
+            nagios_gid = grp.getgrnam('nagios').gr_gid
+        except Exception:
+            log("Nagios user not set up, nrpe checks not updated")
+            return
+
+        if not os.path.exists(self.nagios_logdir):
+            os.mkdir(self.nagios_logdir)
+            os.chown(self.nagios_logdir, nagios_uid, nagios_gid)
+
+        if not self.does_nrpe_conf_dir_exist():
+            return
+
+        nrpe_monitors = {}
+        changed = self.checks_removed
+        for check in self.checks:
+            if self._write_check(check):
+                changed = True
+            nrpe_monitors[check.shortname] = {'command': check.command}
+            if check.max_check_attempts is not None:
+                nrpe_monitors[check.shortname]['max_check_attempts'] = (
+                    check.max_check_attempts)
+
+        # Restarting nagios-nrpe-server makes nagios report the checks as
+        # failing for a moment, so only do it when a check changed, and
+        # never on update-status.
+        if not changed:
+            log("NRPE checks unchanged, not restarting nagios-nrpe-server",
+                level=DEBUG)
+        elif hook_name() != 'update-status':
+            service('restart', 'nagios-nrpe-server')
+
+        monitors = {"monitors": {"remote": {"nrpe": nrpe_monitors}}}
+        for rid in (relation_ids('local-monitors') +
+                    relation_ids('nrpe-external-master')):
+            reldata = relation_get(unit=local_unit(), rid=rid)
+            if 'monitors' in reldata:
+                old_monitors = yaml.safe_load(reldata['monitors'])
+                old_nrpe_monitors = {
+                    k: v for k, v in
+                    old_monitors['monitors']['remote']['nrpe'].items()
+                    if k not in self.remove_check_queue}
+                old_nrpe_monitors.update(nrpe_monitors)
+                old_monitors['monitors']['remote']['nrpe'] = old_nrpe_monitors
+                new_monitors = yaml.dump(old_monitors)
+            else:
+                new_monitors = yaml.dump(monitors)
+            if reldata.get('monitors') != new_monitors:
+                relation_set(relation_id=rid, monitors=new_monitors)
+
+        self.remove_check_queue.clear()
+        self.checks_removed = False
+
+
 def db_migration():
     release = CompareOpenStackReleases(os_release('openstack-dashboard'))
     if release >= 'rocky':
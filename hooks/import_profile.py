@@ -0,0 +1,99 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opt-in import time profiling for the hook entry point.
+
+Set ``CHARM_IMPORT_PROFILE=1`` in the hook environment (for example with
+``juju model-config juju-env=...`` or ``juju exec`` for a one-off run) and
+the hook will log the charmhelpers modules whose import cost the most.
+
+This module must not import anything from charmhelpers itself, as it has to
+be enabled before those imports happen.
+"""
+
+import builtins
+import os
+import sys
+import time
+
+IMPORT_PROFILE_ENV = 'CHARM_IMPORT_PROFILE'
+
+_original_import = None
+_stack = []
+# module name -> [cumulative seconds, self seconds]
+_timings = {}
+
+
+def enabled():
+    """Whether import profiling was requested for this hook execution."""
+    return os.environ.get(IMPORT_PROFILE_ENV, '').lower() in (
+        '1', 'true', 'yes')
+
+
+def _profiled_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    _stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - start
+        children = _stack.pop()
+        if _stack:
+            _stack[-1] += elapsed
+        timing = _timings.setdefault(name, [0.0, 0.0])
+        timing[0] += elapsed
+        timing[1] += elapsed - children
+
+
+def start():
+    """Start recording the time spent in first imports of modules."""
+    global _original_import
+    if _original_import is None:
+        _original_import = builtins.__import__
+        builtins.__import__ = _profiled_import
+
+
+def stop():
+    """Stop recording and restore the original import machinery."""
+    global _original_import
+    if _original_import is not None:
+        builtins.__import__ = _original_import
+        _original_import = None
+
+
+def report(prefix='charmhelpers', limit=10):
+    """Return the most expensive imports recorded so far.
+
+    :param prefix: only report modules whose name starts with this prefix
+    :type prefix: str
+    :param limit: maximum number of entries to return
+    :type limit: int
+    :returns: list of (module, cumulative_ms, self_ms) tuples, most
+              expensive (by self time) first
+    :rtype: List[Tuple[str, float, float]]
+    """
+    entries = [(name, cumulative * 1000.0, own * 1000.0)
+               for name, (cumulative, own) in _timings.items()
+               if name.startswith(prefix)]
+    entries.sort(key=lambda e: e[2], reverse=True)
+    return entries[:limit]
+
+
+def format_report(entries):
+    """Render report() output as a single log-friendly string."""
+    return 'Import profile (self/cumulative ms): {}'.format(', '.join(
+        '{} {:.1f}/{:.1f}'.format(name, own, cumulative)
+        for name, cumulative, own in entries))
@@ -0,0 +1,158 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Endpoint bindings, resolved with one network-get per hook.
+
+charmhelpers' get_relation_ip() forks ``network-get --primary-address`` on
+every call, and the hook asks for the cluster binding again and again while
+rendering. network_binding() runs ``network-get --format yaml`` once per
+endpoint and keeps the result for the rest of the hook; get_relation_ip()
+here is the charmhelpers one reading the primary address from it.
+"""
+
+from subprocess import CalledProcessError
+
+from charmhelpers.core.hookenv import (
+    cached,
+    config,
+    log,
+    network_get,
+    network_get_primary_address,
+    unit_get,
+    NoNetworkBinding,
+    WARNING,
+)
+from charmhelpers.contrib.network.ip import (
+    assert_charm_supports_ipv6,
+    get_address_in_network,
+    get_host_ip,
+    get_ipv6_addr,
+)
+
+
+class NetworkBinding(object):
+    """The network details of an endpoint binding, see network_binding()."""
+
+    def __init__(self, endpoint, info):
+        self.endpoint = endpoint
+        self.info = info or {}
+
+    @property
+    def addresses(self):
+        """The bound addresses, in network-get order.
+
+        :returns: [(address, network)] where network is the CIDR of the
+            address, or None if network-get does not report it
+        :rtype: List[Tuple[str, Optional[str]]]
+        """
+        addresses = []
+        for device in self.info.get('bind-addresses') or []:
+            for entry in device.get('addresses') or []:
+                address = entry.get('address') or entry.get('value')
+                if address:
+                    addresses.append((address, entry.get('cidr')))
+        return addresses
+
+    @property
+    def primary_address(self):
+        """The address network-get --primary-address would return.
+
+        :raises: NoNetworkBinding if the binding has no address
+        """
+        addresses = self.addresses
+        if not addresses:
+            raise NoNetworkBinding("No network binding for {}"
+                                   .format(self.endpoint))
+        return addresses[0][0]
+
+
+@cached
+def _network_get(endpoint):
+    # A Juju that cannot output YAML stays so for the hook: that answer is
+    # cached by returning it. Other failures may be transient and are raised
+    # without being cached.
+    try:
+        return network_get(endpoint)
+    except (NotImplementedError, OSError, IndexError):
+        # Juju < 2.2, no network-get, or no jujud to tell the Juju version.
+        return NotImplementedError()
+
+
+def network_binding(endpoint):
+    """Return the network details of an endpoint binding.
+
+    network-get runs once per endpoint and hook, whatever the number of
+    queries.
+
+    :param endpoint: the name of a relation endpoint or extra-binding
+    :type endpoint: str
+    :rtype: NetworkBinding
+    :raises: NotImplementedError if network-get does not support YAML
+        output, NoNetworkBinding if the endpoint is not bound
+    """
+    try:
+        info = _network_get(endpoint)
+    except CalledProcessError as e:
+        if 'no network config found for binding' in e.output.decode('UTF-8'):
+            raise NoNetworkBinding("No network binding for {}"
+                                   .format(endpoint))
+        raise
+    if isinstance(info, NotImplementedError):
+        raise NotImplementedError()
+    return NetworkBinding(endpoint, info)
+
+
+def primary_address(endpoint):
+    """Return the primary address of an endpoint binding.
+
+    It is read from network_binding(), or from network-get --primary-address
+    if network-get does not support YAML output.
+
+    :raises: NotImplementedError on Juju < 2.0, NoNetworkBinding if the
+        endpoint is not bound
+    """
+    try:
+        return network_binding(endpoint).primary_address
+    except NotImplementedError:
+        return network_get_primary_address(endpoint)
+
+
+def get_relation_ip(interface, cidr_network=None):
+    """Return this unit's IP for the given interface.
+
+    As charmhelpers.contrib.network.ip.get_relation_ip(), with the binding
+    queried once per hook.
+
+    :param interface: the name of the relation
+    :type interface: str
+    :param cidr_network: CIDR network to select an address from
+    :type cidr_network: Optional[str]
+    :raises: Exception if prefer-ipv6 is configured but IPv6 unsupported
+    :returns: IPv6 or IPv4 address
+    :rtype: str
+    """
+    try:
+        address = primary_address(interface)
+    except NotImplementedError:
+        address = get_host_ip(unit_get('private-address'))
+    except NoNetworkBinding:
+        log("No network binding for {}".format(interface), WARNING)
+        address = get_host_ip(unit_get('private-address'))
+
+    if config('prefer-ipv6'):
+        assert_charm_supports_ipv6()
+        return get_ipv6_addr()[0]
+    elif cidr_network:
+        return get_address_in_network(cidr_network, address)
+    return address
@@ -0,0 +1,182 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Package state lookups shared by the hook.
+
+charmhelpers.fetch answers "is this package installed?" by forking
+``apt-cache show`` and ``dpkg-query`` for every package asked about. The
+``PackageIndex`` here answers it for any number of packages from a single
+``dpkg-query -W`` of the whole dpkg database and a single multi-package
+``apt-cache show``, and is kept for the rest of the hook.
+
+The apt wrappers below run the charmhelpers.fetch commands and drop the
+index afterwards, so the hook must use them instead of the charmhelpers
+ones for the index to stay current. They also drop the cached
+host.services_running() probes, as package maintainer scripts start, stop
+and restart services.
+"""
+
+import functools
+import subprocess
+
+from charmhelpers.core.hookenv import log, WARNING
+from charmhelpers.core.host import flush_service_probes
+from charmhelpers.fetch import (
+    apt_autoremove as _apt_autoremove,
+    apt_install as _apt_install,
+    apt_purge as _apt_purge,
+    apt_update as _apt_update,
+    apt_upgrade as _apt_upgrade,
+    get_apt_dpkg_env,
+)
+from charmhelpers.fetch import ubuntu_apt_pkg
+
+
+class PackageIndex(object):
+    """Installed and available package state for set-based lookups."""
+
+    def __init__(self):
+        self._installed = None
+        self._available = {}
+
+    @property
+    def installed(self):
+        """Installed packages and their versions.
+
+        :returns: {package name: version}
+        :rtype: Dict[str, str]
+        """
+        if self._installed is None:
+            output = subprocess.check_output(
+                ['dpkg-query', '-W',
+                 '-f=${Package}\t${Version}\t${Status}\n'],
+                stderr=subprocess.DEVNULL, universal_newlines=True)
+            installed = {}
+            for line in output.splitlines():
+                try:
+                    name, version, status = line.split('\t')
+                except ValueError:
+                    continue
+                # Status is "<want> <flag> <state>", as in "hold ok installed"
+                if status.endswith(' installed'):
+                    installed[name] = version
+            self._installed = installed
+        return self._installed
+
+    def available(self, packages):
+        """Return those of packages that apt has an installation candidate for.
+
+        :param packages: package names
+        :type packages: Iterable[str]
+        :rtype: Set[str]
+        """
+        missing = [p for p in packages if p not in self._available]
+        if missing:
+            result = subprocess.run(
+                ['apt-cache', 'show', '--no-all-versions'] + missing,
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                universal_newlines=True, env=get_apt_dpkg_env())
+            # apt-cache skips unknown packages, and exits 100 if any was.
+            found = set()
+            for line in result.stdout.splitlines():
+                if line.startswith('Package: '):
+                    found.add(line[len('Package: '):].strip())
+            for package in missing:
+                self._available[package] = package in found
+        return {p for p in packages if self._available[p]}
+
+
+_package_index = None
+
+
+def package_index():
+    """Return the package index shared by this hook.
+
+    :rtype: PackageIndex
+    """
+    global _package_index
+    if _package_index is None:
+        _package_index = PackageIndex()
+    return _package_index
+
+
+def invalidate_package_index():
+    """Drop the package index, after the package state has changed."""
+    global _package_index
+    _package_index = None
+
+
+def filter_installed_packages(packages):
+    """Return a list of packages that require installation."""
+    index = package_index()
+    _pkgs = [p for p in packages if p not in index.installed]
+    if _pkgs:
+        available = index.available(_pkgs)
+        for package in _pkgs:
+            if package not in available:
+                log('Package {} has no installation candidate.'
+                    .format(package), level=WARNING)
+    return _pkgs
+
+
+def filter_missing_packages(packages):
+    """Return a list of packages that are installed.
+
+    :param packages: list of packages to evaluate.
+    :returns list: Packages that are installed.
+    """
+    installed = package_index().installed
+    return [p for p in packages if p in installed]
+
+
+def get_installed_version(package):
+    """Return the installed version of package.
+
+    :returns: None if not installed, or the installed version
+    :rtype: Optional[ubuntu_apt_pkg.Version]
+    """
+    installed_version = package_index().installed.get(package)
+    if not installed_version:
+        return None
+    return ubuntu_apt_pkg.Version({'ver_str': installed_version})
+
+
+def get_upstream_version(package):
+    """Return the upstream part of the installed version of package.
+
+    :returns: None if not installed, or the upstream version
+    :rtype: Optional[str]
+    """
+    installed_version = package_index().installed.get(package)
+    if not installed_version:
+        return None
+    return ubuntu_apt_pkg.upstream_version(installed_version)
+
+
+def _invalidating(apt_command):
+    @functools.wraps(apt_command)
+    def wrapper(*args, **kwargs):
+        try:
+            return apt_command(*args, **kwargs)
+        finally:
+            invalidate_package_index()
+            flush_service_probes()
+    return wrapper
+
+
+apt_install = _invalidating(_apt_install)
+apt_upgrade = _invalidating(_apt_upgrade)
+apt_update = _invalidating(_apt_update)
+apt_purge = _invalidating(_apt_purge)
+apt_autoremove = _invalidating(_apt_autoremove)
@@ -0,0 +1,221 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The inputs of rendered config files, to tell which a hook may affect.
+
+Context generators declare what they read in an ``inputs`` attribute::
+
+    class MemcacheClusterContext(OSContextGenerator):
+        inputs = {
+            'config': ANY,
+            'relations': ['cluster'],
+            'state': [lambda: memcache_cluster_address()],
+        }
+
+'config' lists the options read, or is ANY for any option; 'relations'
+the relations whose data is read; 'files' the files and directories read;
+'state' callables returning whatever else the generator depends on, such
+as network addresses, the OpenStack release or the machine size, which are
+compared by value. Inputs of charmhelpers generators are declared in
+CHARMHELPERS_INPUTS.
+
+A generator that declares nothing may read anything: the config files it
+is registered for are affected by every hook.
+"""
+
+import hashlib
+import json
+import os
+
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import config
+from charmhelpers.contrib.openstack import context
+
+# Stands for every config option in a 'config' declaration.
+ANY = '*'
+
+# Unit kv key of the inputs each config file was last rendered from.
+RENDER_INPUTS_KV_KEY = 'render-inputs'
+
+# Inputs of the charmhelpers context generators the charm uses, which do
+# not declare them.
+CHARMHELPERS_INPUTS = {
+    context.SyslogContext: {'config': ['use-syslog']},
+}
+
+
+def context_inputs(generator):
+    """Return the inputs a context generator declares.
+
+    :param generator: a context generator
+    :type generator: Callable[[], Dict]
+    :returns: the declaration, or None if it declares none
+    :rtype: Optional[Dict]
+    """
+    inputs = getattr(generator, 'inputs', None)
+    if inputs is None:
+        inputs = CHARMHELPERS_INPUTS.get(type(generator))
+    return inputs
+
+
+def template_inputs(contexts):
+    """Merge the inputs declared by the context generators of a template.
+
+    :param contexts: the context generators of the template
+    :type contexts: List[Callable[[], Dict]]
+    :returns: {'config': ANY or [...], 'relations': [...], 'files': [...],
+              'state': [...]}, or None if a generator declares none
+    :rtype: Optional[Dict]
+    """
+    merged = {'config': set(), 'relations': set(), 'files': [], 'state': []}
+    for generator in contexts:
+        inputs = context_inputs(generator)
+        if inputs is None:
+            return None
+        options = inputs.get('config', ())
+        if options == ANY or merged['config'] == ANY:
+            merged['config'] = ANY
+        else:
+            merged['config'].update(options)
+        merged['relations'].update(inputs.get('relations', ()))
+        merged['files'].extend(p for p in inputs.get('files', ())
+                               if p not in merged['files'])
+        merged['state'].extend(inputs.get('state', ()))
+    if merged['config'] != ANY:
+        merged['config'] = sorted(merged['config'])
+    merged['relations'] = sorted(merged['relations'])
+    return merged
+
+
+def _path_state(path):
+    """Return the (mtime, size) of path and, for a directory, its entries."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    state = [[st.st_mtime_ns, st.st_size]]
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            try:
+                st = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            state.append([name, st.st_mtime_ns, st.st_size])
+    return state
+
+
+def _read_state(reader):
+    try:
+        return reader()
+    except Exception as e:
+        # A failure is a value too, e.g. a binding without an address.
+        return {'error': type(e).__name__}
+
+
+def _json_value(value):
+    # Objects such as NetworkBinding are compared by their attributes.
+    return vars(value) if hasattr(value, '__dict__') else str(value)
+
+
+def state_digest(inputs):
+    """Digest the current state of the files and 'state' inputs.
+
+    :param inputs: as returned by template_inputs()
+    :type inputs: Dict
+    :rtype: str
+    """
+    state = {
+        'files': {path: _path_state(path) for path in inputs['files']},
+        'state': [_read_state(reader) for reader in inputs['state']],
+    }
+    data = json.dumps(state, sort_keys=True, default=_json_value)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def _declared(inputs):
+    return {'config': inputs['config'], 'relations': inputs['relations'],
+            'files': sorted(inputs['files'])}
+
+
+def recorded_inputs(config_file):
+    """Return the inputs config_file was last rendered from.
+
+    :returns: {'release': str, 'declared': {...}, 'state': digest}, or None
+    :rtype: Optional[Dict]
+    """
+    return unitdata.kv().get(RENDER_INPUTS_KV_KEY, {}).get(config_file)
+
+
+def record(config_file, contexts, release):
+    """Record the inputs config_file was just rendered from.
+
+    :param config_file: the rendered config file
+    :type config_file: str
+    :param contexts: the context generators of its template
+    :type contexts: List[Callable[[], Dict]]
+    :param release: the OpenStack release it was rendered for
+    :type release: str
+    """
+    db = unitdata.kv()
+    recorded = db.get(RENDER_INPUTS_KV_KEY, {})
+    inputs = template_inputs(contexts)
+    if inputs is None:
+        recorded.pop(config_file, None)
+    else:
+        recorded[config_file] = {
+            'release': release,
+            'declared': _declared(inputs),
+            'state': state_digest(inputs),
+        }
+    db.set(RENDER_INPUTS_KV_KEY, recorded)
+
+
+def config_changed(options):
+    """Whether any of options changed since the previous hook.
+
+    :param options: option names, or ANY
+    :type options: Union[str, List[str]]
+    :rtype: bool
+    """
+    cfg = config()
+    if options == ANY:
+        options = list(cfg.keys())
+    return any(cfg.changed(option) for option in options)
+
+
+def is_affected(config_file, contexts, release, relations=()):
+    """Whether config_file may render differently than when last recorded.
+
+    :param config_file: a registered config file
+    :type config_file: str
+    :param contexts: the context generators of its template
+    :type contexts: List[Callable[[], Dict]]
+    :param release: the OpenStack release it is rendered for
+    :type release: str
+    :param relations: names of the relations whose data changed
+    :type relations: Iterable[str]
+    :rtype: bool
+    """
+    inputs = template_inputs(contexts)
+    recorded = recorded_inputs(config_file)
+    if (inputs is None or recorded is None or
+            recorded['release'] != release or
+            recorded['declared'] != _declared(inputs) or
+            not os.path.exists(config_file)):
+        return True
+    if config_changed(inputs['config']):
+        return True
+    if set(relations) & set(inputs['relations']):
+        return True
+    return recorded['state'] != state_digest(inputs)
@@ -0,0 +1,330 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opt-in timing of the hot paths of a hook.
+
+A traced hook records a span for every subprocess it runs (hook tools,
+apt, systemctl, ...), for the charmhelpers calls listed in _instrumented(),
+such as context generation, template rendering and service actions, and
+for every place instrumented with span() or traced(). When the hook
+completes its spans are appended to a JSON file in the charm directory,
+which keeps the last few hooks::
+
+    with tracing.trace_hook(hook_name(), enable=config('hook-tracing')):
+        hooks.execute(sys.argv)
+
+Tracing is enabled per hook by the caller, or for any hook by setting
+CHARM_HOOK_TRACE=1 in its environment. The subprocess functions and the
+charmhelpers calls are only wrapped while a hook is traced; when it is
+not, span() costs a single global lookup.
+"""
+
+import functools
+import json
+import os
+import subprocess
+import time
+
+from contextlib import contextmanager
+
+from charmhelpers.contrib.openstack import templating
+from charmhelpers.contrib.openstack import utils as os_utils
+from charmhelpers.core import hookenv, host
+
+TRACE_ENV = 'CHARM_HOOK_TRACE'
+PROFILE_FILE = '.hook-profiles.json'
+DEFAULT_KEEP = 20
+# Longest command line recorded as the detail of an exec span.
+MAX_DETAIL = 200
+
+_TRACED_SUBPROCESS = ('call', 'check_call', 'check_output', 'run')
+
+# The _Trace of the hook being traced, if any.
+_active = None
+
+
+class _Trace(object):
+
+    def __init__(self, hook):
+        self.hook = hook
+        self.started = time.time()
+        self.t0 = time.perf_counter()
+        self.spans = []
+        self.depth = 0
+        self.in_exec = False
+        self.originals = []
+
+    def record(self):
+        return {
+            'hook': self.hook,
+            'started': self.started,
+            'duration': round((time.perf_counter() - self.t0) * 1000.0, 3),
+            'spans': self.spans,
+        }
+
+
+def active():
+    """Whether the current hook is being traced."""
+    return _active is not None
+
+
+@contextmanager
+def span(name, detail=None):
+    """Time the enclosed block as a span of the current trace.
+
+    :param name: span name; spans are aggregated by name in reports
+    :type name: str
+    :param detail: optional free form description of this instance
+    :type detail: Optional[str]
+    """
+    trace = _active
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    entry = {'name': name,
+             'start': round((start - trace.t0) * 1000.0, 3),
+             'depth': trace.depth}
+    if detail:
+        entry['detail'] = detail
+    trace.spans.append(entry)
+    trace.depth += 1
+    try:
+        yield
+    finally:
+        trace.depth -= 1
+        entry['duration'] = round((time.perf_counter() - start) * 1000.0, 3)
+
+
+def traced(name=None):
+    """Decorator recording each call of the function as a span."""
+    def wrap(f):
+        span_name = name or f.__qualname__
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return f(*args, **kwargs)
+            with span(span_name):
+                return f(*args, **kwargs)
+        return wrapper
+    return wrap
+
+
+def _command_span(cmd):
+    if isinstance(cmd, str):
+        argv = cmd.split()
+    else:
+        argv = [str(a) for a in cmd]
+    name = 'exec:{}'.format(os.path.basename(argv[0]) if argv else '?')
+    return name, ' '.join(argv)[:MAX_DETAIL]
+
+
+def _traced_subprocess(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        trace = _active
+        # check_call() and check_output() are built on call() and run().
+        if trace is None or trace.in_exec:
+            return func(*args, **kwargs)
+        cmd = args[0] if args else kwargs.get('args', '')
+        name, detail = _command_span(cmd)
+        trace.in_exec = True
+        try:
+            with span(name, detail):
+                return func(*args, **kwargs)
+        finally:
+            trace.in_exec = False
+    return wrapper
+
+
+def _traced_call(func, describe):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _active is None:
+            return func(*args, **kwargs)
+        with span(*describe(*args, **kwargs)):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _instrumented():
+    """The charmhelpers calls recorded as spans while a hook is traced.
+
+    Each is patched where the charm and charmhelpers look it up.
+
+    :returns: [(owner, attribute, describe)] where describe maps the
+              arguments of a call to its span (name, detail)
+    :rtype: List[Tuple[object, str, Callable]]
+    """
+    return [
+        (hookenv.Hooks, 'execute',
+         lambda self, args: ('hooks.execute', os.path.basename(args[0]))),
+        (templating, '_evaluate',
+         lambda context: ('context:{}'.format(context.__class__.__name__),
+                          None)),
+        (templating.OSConfigRenderer, '_render',
+         lambda self, config_file, *args, **kwargs: ('render', config_file)),
+        (host, 'service',
+         lambda action, service_name=None, **kwargs: (
+             'service:{}'.format(action), service_name)),
+        (os_utils, 'services_running',
+         lambda service_names, *args, **kwargs: (
+             'services_running', ' '.join(service_names))),
+    ]
+
+
+def _patch(trace, owner, attr, wrapper):
+    func = vars(owner)[attr]
+    trace.originals.append((owner, attr, func))
+    setattr(owner, attr, wrapper(func))
+
+
+def start(hook, enable=False):
+    """Start tracing hook if enabled, or if requested by the environment.
+
+    :param hook: name of the hook being run
+    :type hook: str
+    :param enable: trace regardless of the environment
+    :type enable: bool
+    :returns: whether tracing was started
+    :rtype: bool
+    """
+    global _active
+    if _active is not None:
+        return True
+    if not (enable or os.environ.get(TRACE_ENV, '').lower() in (
+            '1', 'true', 'yes')):
+        return False
+    _active = _Trace(hook)
+    for attr in _TRACED_SUBPROCESS:
+        _patch(_active, subprocess, attr, _traced_subprocess)
+    for owner, attr, describe in _instrumented():
+        _patch(_active, owner, attr,
+               functools.partial(_traced_call, describe=describe))
+    return True
+
+
+def profiles_path():
+    """Path of the file holding the recorded hook profiles."""
+    return os.path.join(os.environ.get('CHARM_DIR', ''), PROFILE_FILE)
+
+
+def load_profiles(path=None):
+    """Return the recorded hook profiles, oldest first.
+
+    :param path: profiles file, defaults to profiles_path()
+    :type path: Optional[str]
+    :rtype: List[Dict]
+    """
+    try:
+        with open(path or profiles_path()) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return []
+
+
+def finish(path=None, keep=DEFAULT_KEEP):
+    """Stop tracing and save the profile of the hook.
+
+    :param path: profiles file, defaults to profiles_path()
+    :type path: Optional[str]
+    :param keep: number of hook profiles to keep in the file
+    :type keep: int
+    :returns: the profile of the hook, or None if it was not traced
+    :rtype: Optional[Dict]
+    """
+    global _active
+    trace = _active
+    if trace is None:
+        return None
+    _active = None
+    for owner, attr, func in reversed(trace.originals):
+        setattr(owner, attr, func)
+    record = trace.record()
+    path = path or profiles_path()
+    profiles = load_profiles(path)
+    profiles.append(record)
+    profiles = profiles[-max(int(keep), 1):]
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        json.dump(profiles, f)
+    os.rename(tmp, path)
+    return record
+
+
+@contextmanager
+def trace_hook(hook, enable=False, path=None, keep=DEFAULT_KEEP):
+    """Trace the enclosed block as the run of hook, see start()."""
+    if not start(hook, enable=enable):
+        yield
+        return
+    try:
+        with span('hook:{}'.format(hook)):
+            yield
+    finally:
+        finish(path=path, keep=keep or DEFAULT_KEEP)
+
+
+def summarize(record, limit=10):
+    """Aggregate the spans of a profile by name.
+
+    Only the time spent in a span itself is counted, not the time of the
+    spans nested in it.
+
+    :returns: [(name, calls, total_ms, self_ms)], largest self time first
+    :rtype: List[Tuple[str, int, float, float]]
+    """
+    totals = {}
+    spans = record.get('spans', [])
+    for i, entry in enumerate(spans):
+        duration = entry.get('duration', 0.0)
+        nested = 0.0
+        for child in spans[i + 1:]:
+            if child['depth'] <= entry['depth']:
+                break
+            if child['depth'] == entry['depth'] + 1:
+                nested += child.get('duration', 0.0)
+        calls, total, own = totals.get(entry['name'], (0, 0.0, 0.0))
+        totals[entry['name']] = (calls + 1, total + duration,
+                                 own + duration - nested)
+    rows = [(name, calls, round(total, 3), round(own, 3))
+            for name, (calls, total, own) in totals.items()]
+    rows.sort(key=lambda r: r[3], reverse=True)
+    return rows[:limit]
+
+
+def format_profile(record, min_ms=1.0):
+    """Render a profile as an indented, flame graph style span tree.
+
+    :param record: a hook profile
+    :type record: Dict
+    :param min_ms: omit spans shorter than this
+    :type min_ms: float
+    :rtype: str
+    """
+    lines = ['{} at {}: {:.1f}ms'.format(
+        record['hook'],
+        time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(record['started'])),
+        record['duration'])]
+    for entry in record.get('spans', []):
+        duration = entry.get('duration', 0.0)
+        if duration < min_ms:
+            continue
+        line = '{:>10.1f}ms  {}{}'.format(
+            duration, '  ' * entry['depth'], entry['name'])
+        if entry.get('detail'):
+            line = '{}  [{}]'.format(line, entry['detail'])
+        lines.append(line)
+    return '\n'.join(lines)
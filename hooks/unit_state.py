@@ -0,0 +1,245 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Upkeep of the unit state database, charmhelpers.core.unitdata.
+
+Every hook_scope() records a hooks row and a revision of each key it
+changes, and unitdata never removes them, so .unit-state.db grows with
+every update-status. maintain() bounds that history and returns the freed
+pages to the filesystem; the hook runs it once it is done with the db.
+
+The charm helpers flush the db after each change they make, a commit, and
+so an fsync, each. Within deferred_commit() those flushes are merged into a
+single commit, and use_wal() makes that commit cheaper still.
+"""
+
+import contextlib
+import os
+
+# Retention of the history recorded by hook_scope(): revisions kept per key,
+# and hooks kept overall (revisions of older hooks are dropped with them).
+KEEP_REVISIONS = 10
+KEEP_HOOKS = 500
+
+# Compact the file once this many bytes, and this share of it, are free.
+COMPACT_MIN_FREE = 1024 * 1024
+COMPACT_FREE_RATIO = 0.25
+
+# Value of the auto_vacuum pragma for incremental auto-vacuum.
+_INCREMENTAL = 2
+
+# A commit in WAL mode with synchronous=NORMAL is durable against a crash of
+# the charm, not against a power loss, which is enough for unit state.
+SYNCHRONOUS = 'NORMAL'
+
+
+def _pragma(db, name):
+    db.cursor.execute('pragma %s' % name)
+    return db.cursor.fetchone()[0]
+
+
+def prune(db, keep_revisions=None, keep_hooks=None):
+    """Drop the history beyond the retention policy.
+
+    :param db: the unit state database
+    :type db: unitdata.Storage
+    :param keep_revisions: revisions to keep per key, defaults to
+        KEEP_REVISIONS
+    :type keep_revisions: Optional[int]
+    :param keep_hooks: hooks to keep, defaults to KEEP_HOOKS; the revisions
+        recorded by older hooks are dropped with them
+    :type keep_hooks: Optional[int]
+    :returns: (revisions removed, hooks removed)
+    :rtype: Tuple[int, int]
+    """
+    if keep_revisions is None:
+        keep_revisions = KEEP_REVISIONS
+    if keep_hooks is None:
+        keep_hooks = KEEP_HOOKS
+    db.cursor.execute(
+        '''
+        delete from hooks where version <= (
+            select version from hooks
+            order by version desc limit 1 offset ?)
+        ''', [max(keep_hooks, 1)])
+    hooks = db.cursor.rowcount
+    revisions = 0
+    if hooks:
+        db.cursor.execute(
+            '''
+            delete from kv_revisions
+            where revision < (select min(version) from hooks)
+            ''')
+        revisions += db.cursor.rowcount
+    db.cursor.execute(
+        '''
+        delete from kv_revisions where revision < (
+            select r.revision from kv_revisions r
+            where r.key = kv_revisions.key
+            order by r.revision desc limit 1 offset ?)
+        ''', [max(keep_revisions, 1) - 1])
+    revisions += db.cursor.rowcount
+    return revisions, hooks
+
+
+def compact(db, force=False):
+    """Return the free pages of the database file to the filesystem.
+
+    Only if enough of them are free, see COMPACT_MIN_FREE and
+    COMPACT_FREE_RATIO, or if forced. Pending changes are committed.
+
+    unitdata creates its database without auto-vacuum: the first compaction
+    switches it to incremental auto-vacuum, which takes one full VACUUM;
+    later ones only run an incremental vacuum.
+
+    :param db: the unit state database
+    :type db: unitdata.Storage
+    :param force: compact however few pages are free
+    :type force: bool
+    :returns: whether the database was compacted
+    :rtype: bool
+    """
+    page_size = _pragma(db, 'page_size')
+    pages = _pragma(db, 'page_count')
+    free = _pragma(db, 'freelist_count')
+    if not force and (free * page_size < COMPACT_MIN_FREE or
+                      free < pages * COMPACT_FREE_RATIO):
+        return False
+    db.conn.commit()
+    if _pragma(db, 'auto_vacuum') == _INCREMENTAL:
+        # Each step of the statement frees one page: executescript() runs
+        # it to completion, execute() would stop after the first.
+        db.cursor.executescript('pragma incremental_vacuum;')
+    else:
+        db.cursor.execute('pragma auto_vacuum = incremental')
+        db.cursor.execute('vacuum')
+    db.conn.commit()
+    return True
+
+
+def maintain(db):
+    """Apply the retention policy and compact the database when worthwhile.
+
+    Pending changes are committed. Does nothing inside a hook_scope(), whose
+    revision is still being recorded.
+
+    :param db: the unit state database
+    :type db: unitdata.Storage
+    :returns: (revisions removed, hooks removed, compacted)
+    :rtype: Tuple[int, int, bool]
+    """
+    if db.revision:
+        return 0, 0, False
+    revisions, hooks = prune(db)
+    db.conn.commit()
+    return revisions, hooks, compact(db)
+
+
+def stats(db):
+    """Report the size of the database and of its tables.
+
+    :param db: the unit state database
+    :type db: unitdata.Storage
+    :returns: {'path', 'file-size', 'page-size', 'pages', 'free-pages',
+        'tables': {name: {'rows', 'bytes'}}}, where bytes counts the stored
+        keys and data
+    :rtype: Dict
+    """
+    file_size = 0
+    for path in (db.db_path, db.db_path + '-wal'):
+        try:
+            file_size += os.path.getsize(path)
+        except OSError:
+            pass
+    tables = {}
+    for table, a, b in (('kv', 'key', 'data'),
+                        ('kv_revisions', 'key', 'data'),
+                        ('hooks', 'hook', 'date')):
+        db.cursor.execute(
+            'select count(*), coalesce(sum(length(%s) + length(%s)), 0) '
+            'from %s' % (a, b, table))
+        rows, size = db.cursor.fetchone()
+        tables[table] = {'rows': rows, 'bytes': size}
+    return {
+        'path': db.db_path,
+        'file-size': file_size,
+        'page-size': _pragma(db, 'page_size'),
+        'pages': _pragma(db, 'page_count'),
+        'free-pages': _pragma(db, 'freelist_count'),
+        'tables': tables,
+    }
+
+
+def use_wal(db, synchronous=SYNCHRONOUS):
+    """Journal the database in WAL mode.
+
+    The journal mode is kept in the database file, synchronous applies to
+    this connection only. Neither can be changed within a transaction: with
+    changes pending, the db is left as it is.
+
+    :param db: the unit state database
+    :type db: unitdata.Storage
+    :param synchronous: the synchronous pragma, e.g. 'NORMAL' or 'FULL'
+    :type synchronous: str
+    """
+    if db.conn.in_transaction:
+        return
+    db.cursor.execute('pragma journal_mode = wal')
+    db.cursor.fetchall()
+    db.cursor.execute('pragma synchronous = %s' % synchronous)
+
+
+class _DeferredFlush(object):
+    """Stands in for the flush() of a db within deferred_commit()."""
+
+    def __init__(self, db):
+        self.db = db
+        self.flushed = False
+
+    def __call__(self, save=True):
+        if save:
+            # Marks what the deferred commit covers should the block raise.
+            self.db.cursor.execute('savepoint flushed')
+            self.flushed = True
+        elif self.flushed:
+            self.db.cursor.execute('rollback to flushed')
+        else:
+            self.db.conn.rollback()
+
+
+@contextlib.contextmanager
+def deferred_commit(db):
+    """Merge the flushes of the enclosed block into a single commit.
+
+    Changes flushed in the block are committed when it exits, even if it
+    raises, as they would have been without deferral; changes made after the
+    last flush are rolled back if it raises. Blocks nest. The db must not be
+    closed within the block.
+
+    :param db: the unit state database
+    :type db: unitdata.Storage
+    """
+    if isinstance(vars(db).get('flush'), _DeferredFlush):
+        yield
+        return
+    deferred = db.flush = _DeferredFlush(db)
+    try:
+        yield
+    except BaseException:
+        deferred(False)
+        raise
+    finally:
+        del db.flush
+        if deferred.flushed:
+            db.conn.commit()
@@ -151,8 +151,14 @@ SECRET_KEY = "{{ secret }}"
 
 CACHES = {
     'default': {
+{%- if memcache_servers %}
+        'BACKEND': '{{ memcache_backend }}',
+        'LOCATION': {{ memcache_servers }},
+        'OPTIONS': {{ memcache_options }},
+{%- else %}
         'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
         'LOCATION': '127.0.0.1:11211',
+{%- endif %}
     },
 }
 {% if database_host -%}
@@ -169,7 +175,10 @@ DATABASES = {
     }
 }
 {% else -%}
-{% if api_version == "3" -%}
+{% if memcache_servers -%}
+# Sessions are held in the memcached cluster shared by all units
+SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
+{% elif api_version == "3" -%}
 # Warning: Please add DB relation for Keystone v3 + HA deployments
 SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
 {% endif -%}
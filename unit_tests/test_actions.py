@@ -76,3 +76,129 @@ class MainTestCase(CharmTestCase):
         with mock.patch.dict(actions.ACTIONS, {"foo": dummy_action}):
             actions.main(["foo"])
         self.assertEqual(dummy_calls, ["uh oh"])
+
+
+class HookProfileTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(HookProfileTestCase, self).setUp(
+            actions, ["action_get", "action_set", "tracing"])
+        self.params = {'hook': None, 'count': 1, 'min-ms': 1.0}
+        self.action_get.side_effect = self.params.get
+        self.tracing.load_profiles.return_value = [
+            {'hook': 'config-changed', 'duration': 900.0, 'spans': []},
+            {'hook': 'update-status', 'duration': 80.0, 'spans': []},
+        ]
+        self.tracing.summarize.return_value = [
+            ('exec:config-get', 2, 40.0, 40.0)]
+        self.tracing.format_profile.return_value = 'tree'
+
+    def test_latest_profile(self):
+        actions.hook_profile([])
+        self.action_set.assert_called_once_with({
+            'profile-0.hook': 'update-status',
+            'profile-0.duration-ms': 80.0,
+            'profile-0.summary':
+                '      40.0ms self       40.0ms total    2x exec:config-get',
+            'profile-0.spans': 'tree',
+        })
+
+    def test_filter_by_hook(self):
+        self.params.update({'hook': 'config-changed', 'count': 5})
+        actions.hook_profile([])
+        output = self.action_set.call_args[0][0]
+        self.assertEqual(output['profile-0.hook'], 'config-changed')
+        self.assertNotIn('profile-1.hook', output)
+
+    def test_no_profiles(self):
+        self.tracing.load_profiles.return_value = []
+        self.assertRaises(Exception, actions.hook_profile, [])
+
+
+class ContextDiffTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(ContextDiffTestCase, self).setUp(
+            actions, ["action_get", "action_set"])
+        self.params = {'file': None}
+        self.action_get.side_effect = self.params.get
+        self.records = {
+            '/etc/haproxy/haproxy.cfg': {
+                'context': {'units': {'a': '10.0.0.1', 'b': '10.0.0.2'},
+                            'stat_password': 'new'},
+                'hook': 'cluster-relation-changed',
+                'updated': 0,
+                'previous': {
+                    'context': {'units': {'a': '10.0.0.1'},
+                                'stat_password': 'old'},
+                    'hook': 'install',
+                    'updated': 0,
+                },
+            },
+            '/etc/memcached.conf': {
+                'context': {'memcache_port': 11211},
+                'hook': 'install',
+                'updated': 0,
+            },
+        }
+        patcher = patch.object(actions.templating, 'rendered_contexts')
+        self.rendered_contexts = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.rendered_contexts.side_effect = lambda: dict(self.records)
+
+    def test_context_diff(self):
+        actions.context_diff([])
+        self.action_set.assert_called_once_with({
+            'file-0.path': '/etc/haproxy/haproxy.cfg',
+            'file-0.changed-by':
+                'cluster-relation-changed at 1970-01-01 00:00:00',
+            'file-0.previous': 'install at 1970-01-01 00:00:00',
+            'file-0.diff': 'stat_password: <redacted> -> <redacted>\n'
+                           'units.b: <absent> -> "10.0.0.2"',
+        })
+
+    def test_context_diff_unchanged_file(self):
+        self.params['file'] = '/etc/memcached.conf'
+        actions.context_diff([])
+        self.action_set.assert_called_once_with(
+            {'message': 'No context changes recorded.'})
+
+    def test_context_diff_unknown_file(self):
+        self.params['file'] = '/etc/missing.conf'
+        self.assertRaises(Exception, actions.context_diff, [])
+
+
+class KVStatsTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(KVStatsTestCase, self).setUp(
+            actions, ["action_get", "action_set"])
+        self.params = {'compact': False}
+        self.action_get.side_effect = self.params.get
+        self.db = actions.unitdata.Storage(':memory:')
+        for i in range(3):
+            with self.db.hook_scope('config-changed'):
+                self.db.set('key', i)
+        patcher = patch.object(actions.unitdata, 'kv')
+        patcher.start().return_value = self.db
+        self.addCleanup(patcher.stop)
+
+    def test_kv_stats(self):
+        actions.kv_stats([])
+        output = self.action_set.call_args[0][0]
+        self.assertEqual(output['path'], ':memory:')
+        self.assertEqual(output['tables.kv.rows'], 1)
+        self.assertEqual(output['tables.kv_revisions.rows'], 3)
+        self.assertEqual(output['tables.hooks.rows'], 3)
+
+    def test_kv_stats_compact(self):
+        self.params['compact'] = True
+        with patch.multiple(actions.unit_state, KEEP_REVISIONS=1,
+                            KEEP_HOOKS=2):
+            actions.kv_stats([])
+        self.action_set.assert_any_call(
+            {'pruned.revisions': 2, 'pruned.hooks': 1})
+        output = self.action_set.call_args[0][0]
+        self.assertEqual(output['tables.kv_revisions.rows'], 1)
+        self.assertEqual(output['tables.hooks.rows'], 2)
+        self.assertEqual(self.db.get('key'), 2)
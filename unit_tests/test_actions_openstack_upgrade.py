@@ -25,7 +25,7 @@ mock_apt = MagicMock()
 sys.modules['apt'] = mock_apt
 mock_apt.apt_pkg = MagicMock()
 
-with patch('charmhelpers.contrib.hardening.harden.harden') as mock_dec:
+with patch('hooks.hardening.harden') as mock_dec:
     mock_dec.side_effect = (lambda *dargs, **dkwargs: lambda f:
                             lambda *args, **kwargs: f(*args, **kwargs))
     with patch('hooks.horizon_utils.register_configs') as register_configs:
@@ -0,0 +1,222 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest.mock import MagicMock, call, patch
+
+from charmhelpers.core import hookenv
+
+import hooks.effects as effects
+
+
+class EffectsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Every effect reports to one mock, to check the order they run in.
+        self.effects = MagicMock()
+        self.configs = self.effects.configs
+        patchers = [
+            patch.object(effects, 'service', self.effects.service),
+            patch.object(effects, 'service_reload', self.effects.reload),
+            patch.object(effects, 'relation_type', return_value='cluster'),
+            patch.object(effects, 'log'),
+            patch.object(effects.time, 'sleep', self.effects.sleep),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _enable(self, *args):
+        # Queued callables are hashed, which a mock would record.
+        self.effects.enable(*args)
+
+    def test_immediate(self):
+        self.assertFalse(effects.active())
+        effects.render(self.configs)
+        effects.reload('apache2')
+        effects.restart(['haproxy'])
+        self.assertEqual(self.effects.mock_calls, [
+            call.configs.write_all(),
+            call.reload('apache2'),
+            call.service('restart', 'haproxy'),
+        ])
+
+    def test_stage_order(self):
+        with effects.deferred():
+            self.assertTrue(effects.active())
+            effects.reload('apache2')
+            effects.restart(['haproxy'])
+            effects.call(self._enable, 'ssl')
+            effects.render(self.configs)
+            self.assertEqual(self.effects.mock_calls, [])
+        self.assertFalse(effects.active())
+        self.assertEqual(self.effects.mock_calls, [
+            call.configs.write_all(),
+            call.enable('ssl'),
+            call.service('restart', 'haproxy'),
+            call.reload('apache2'),
+        ])
+
+    def test_queued_by_a_later_stage(self):
+        def configure():
+            # The renders already ran, the restart has not yet.
+            effects.render(self.configs, ['/etc/a.conf'])
+            effects.restart(['apache2'])
+        with effects.deferred():
+            effects.call(configure)
+            effects.render(self.configs, affected=True)
+        self.assertEqual(self.effects.mock_calls, [
+            call.configs.write_affected(relations=['cluster']),
+            call.configs.write('/etc/a.conf'),
+            call.service('restart', 'apache2'),
+        ])
+
+    def test_renders_merged(self):
+        with effects.deferred():
+            effects.render(self.configs, ['/etc/a.conf'])
+            effects.render(self.configs, ['/etc/b.conf', '/etc/a.conf'])
+            effects.render(self.configs, affected=True)
+            effects.render(self.configs, affected=True, relations=['ha'])
+        self.assertEqual(self.effects.mock_calls, [
+            call.configs.write_affected(relations=['cluster', 'ha']),
+            call.configs.write('/etc/a.conf'),
+            call.configs.write('/etc/b.conf'),
+        ])
+        self.effects.reset_mock()
+        with effects.deferred():
+            effects.render(self.configs, ['/etc/a.conf'])
+            effects.render(self.configs)
+        self.assertEqual(self.effects.mock_calls,
+                         [call.configs.write_all()])
+
+    def test_calls_merged(self):
+        with effects.deferred():
+            effects.call(self._enable, 'ssl')
+            effects.call(self._enable, 'ssl')
+            effects.call(self._enable, 'headers')
+            # Unhashable arguments are never merged
+            effects.call(self._enable, ['ssl'])
+            effects.call(self._enable, ['ssl'])
+        self.assertEqual(self.effects.mock_calls, [
+            call.enable('ssl'), call.enable('headers'),
+            call.enable(['ssl']), call.enable(['ssl'])])
+
+    def test_restarts_and_reloads_merged(self):
+        with effects.deferred():
+            effects.reload('apache2')
+            effects.reload('apache2')
+            effects.reload('memcached')
+            effects.restart(['apache2', 'haproxy'])
+            effects.restart(['apache2'])
+        self.assertEqual(self.effects.mock_calls, [
+            call.service('restart', 'apache2'),
+            call.service('restart', 'haproxy'),
+            call.reload('memcached'),
+        ])
+
+    def test_stopstart_wins(self):
+        with effects.deferred():
+            effects.restart(['apache2', 'memcached'])
+            effects.restart(['haproxy'], stopstart=True, sleep=2)
+            effects.restart(['apache2'], stopstart=True, sleep=5)
+            effects.restart(['haproxy'])
+        self.assertEqual(self.effects.mock_calls, [
+            call.service('stop', 'apache2'), call.sleep(5),
+            call.service('stop', 'haproxy'), call.sleep(5),
+            call.service('start', 'apache2'),
+            call.service('start', 'haproxy'),
+            call.service('restart', 'memcached'),
+        ])
+
+    def test_nested(self):
+        with effects.deferred():
+            with effects.deferred():
+                effects.reload('apache2')
+            self.assertEqual(self.effects.mock_calls, [])
+        self.assertEqual(self.effects.mock_calls, [call.reload('apache2')])
+
+    def test_dropped_on_failure(self):
+        with self.assertRaises(ValueError):
+            with effects.deferred():
+                effects.reload('apache2')
+                raise ValueError()
+        with self.assertRaises(SystemExit):
+            with effects.deferred():
+                effects.reload('apache2')
+                raise SystemExit(1)
+        self.assertEqual(self.effects.mock_calls, [])
+        self.assertFalse(effects.active())
+
+    def test_run_on_successful_exit(self):
+        with self.assertRaises(SystemExit):
+            with effects.deferred():
+                effects.reload('apache2')
+                raise SystemExit(0)
+        self.assertEqual(self.effects.mock_calls, [call.reload('apache2')])
+
+
+class HooksTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.hooks = effects.Hooks()
+        self.calls = []
+        patcher = patch.object(effects, 'service_reload',
+                               side_effect=self._reload)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(hookenv, '_atexit', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(hookenv, '_atstart', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _reload(self, service_name):
+        self.calls.append('reload')
+
+    def _atexit(self):
+        self.calls.append('atexit')
+
+    def test_effects_run_before_atexit(self):
+        @self.hooks.hook('config-changed')
+        def config_changed():
+            hookenv.atexit(self._atexit)
+            effects.reload('apache2')
+            effects.reload('apache2')
+            self.assertEqual(self.calls, [])
+
+        self.hooks.execute(['hooks/config-changed'])
+        self.assertEqual(self.calls, ['reload', 'atexit'])
+
+    def test_successful_exit(self):
+        @self.hooks.hook('config-changed')
+        def config_changed():
+            hookenv.atexit(self._atexit)
+            effects.reload('apache2')
+            raise SystemExit(0)
+
+        with self.assertRaises(SystemExit):
+            self.hooks.execute(['hooks/config-changed'])
+        self.assertEqual(self.calls, ['reload', 'atexit'])
+
+    def test_failed_hook(self):
+        @self.hooks.hook('config-changed')
+        def config_changed():
+            hookenv.atexit(self._atexit)
+            effects.reload('apache2')
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            self.hooks.execute(['hooks/config-changed'])
+        self.assertEqual(self.calls, [])
@@ -0,0 +1,151 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from charmhelpers.core import unitdata
+from charmhelpers.contrib.hardening.audits import BaseAudit
+from charmhelpers.contrib.hardening.audits.file import (
+    DirectoryPermissionAudit,
+    NoSUIDSGIDAudit,
+)
+
+import hooks.hardening as hardening
+
+OS_SETTINGS = {
+    'environment': {'root_path': '/'},
+    'security': {
+        'suid_sgid_enforce': True,
+        'suid_sgid_remove_from_unknown': False,
+        'suid_sgid_dry_run_on_unknown': False,
+    },
+}
+
+
+class HardeningCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config = {'harden': 'os', 'harden-audit-interval': 3600}
+        self.settings = {'os': dict(OS_SETTINGS, security=dict(
+            OS_SETTINGS['security']))}
+        self.installed = {'apache2': '2.4.52-1ubuntu4.6'}
+        patchers = [
+            patch.object(hardening, 'config', side_effect=self.config.get),
+            patch.object(hardening, 'log'),
+            patch.object(hardening.unitdata, 'kv',
+                         return_value=unitdata.Storage(':memory:')),
+            patch.object(hardening.utils, 'get_settings',
+                         side_effect=lambda m: self.settings[m]),
+            patch.object(hardening, 'package_index'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        hardening.package_index.return_value.installed = self.installed
+
+    def _audit_dir(self):
+        top = os.path.join(self.tmpdir, 'etc')
+        os.makedirs(os.path.join(top, 'sub', 'deeper'))
+        with open(os.path.join(top, 'sub', 'deeper', 'conf'), 'w') as f:
+            f.write('x')
+        return top
+
+    def test_record_and_skip(self):
+        top = self._audit_dir()
+        checks = [DirectoryPermissionAudit(top, user='root')]
+        self.assertFalse(hardening.is_current('os'))
+        hardening.record('os', checks)
+        self.assertTrue(hardening.is_current('os'))
+
+    def test_nested_change_reruns(self):
+        top = self._audit_dir()
+        hardening.record('os', [DirectoryPermissionAudit(top, user='root')])
+        # A change two levels below the audited directory is noticed
+        os.chmod(os.path.join(top, 'sub', 'deeper', 'conf'), 0o777)
+        self.assertFalse(hardening.is_current('os'))
+        hardening.record('os', [DirectoryPermissionAudit(top, user='root')])
+        with open(os.path.join(top, 'sub', 'deeper', 'new'), 'w'):
+            pass
+        self.assertFalse(hardening.is_current('os'))
+
+    def test_settings_and_packages_rerun(self):
+        top = self._audit_dir()
+        hardening.record('os', [DirectoryPermissionAudit(top, user='root')])
+        self.installed['haproxy'] = '2.4.22'
+        self.assertFalse(hardening.is_current('os'))
+        hardening.record('os', [DirectoryPermissionAudit(top, user='root')])
+        self.settings['os']['environment'] = {'root_path': '/srv'}
+        self.assertFalse(hardening.is_current('os'))
+
+    @patch.object(hardening, '_suid_sgid_paths')
+    def test_unknown_suid_relisted(self, _suid_sgid_paths):
+        self.settings['os']['security']['suid_sgid_remove_from_unknown'] = (
+            True)
+        _suid_sgid_paths.return_value = ['/usr/bin/sudo']
+        hardening.record('os', [NoSUIDSGIDAudit(['/usr/bin/sudo'])])
+        self.assertTrue(hardening.is_current('os'))
+        # A new suid file anywhere below the root path is noticed
+        _suid_sgid_paths.return_value = ['/tmp/evil', '/usr/bin/sudo']
+        self.assertFalse(hardening.is_current('os'))
+        _suid_sgid_paths.assert_called_with('/')
+
+    def test_interval(self):
+        top = self._audit_dir()
+        hardening.record('os', [DirectoryPermissionAudit(top, user='root')])
+        with patch.object(hardening.time, 'time',
+                          return_value=hardening.time.time() + 3600):
+            self.assertFalse(hardening.is_current('os'))
+        self.config['harden-audit-interval'] = -1
+        self.assertFalse(hardening.is_current('os'))
+
+    def test_unknown_audit(self):
+        top = self._audit_dir()
+        hardening.record('os', [DirectoryPermissionAudit(top, user='root')])
+        hardening.record('os', [DirectoryPermissionAudit(top, user='root'),
+                                BaseAudit()])
+        self.assertFalse(hardening.is_current('os'))
+
+    def test_harden(self):
+        top = self._audit_dir()
+        audits = MagicMock()
+        audits.get_audits.side_effect = lambda: [
+            DirectoryPermissionAudit(top, user='root')]
+        hook = MagicMock(__name__='config_changed', return_value='done')
+        with patch.dict(hardening.RUN_CATALOG, {'os': [audits]}), \
+                patch.object(DirectoryPermissionAudit,
+                             'ensure_compliance') as _ensure_compliance:
+            decorated = hardening.harden()(hook)
+            self.assertEqual(decorated(), 'done')
+            self.assertEqual(_ensure_compliance.call_count, 1)
+            # Nothing changed: the audit pass is skipped
+            self.assertEqual(decorated(), 'done')
+            self.assertEqual(_ensure_compliance.call_count, 1)
+            os.chmod(os.path.join(top, 'sub'), 0o700)
+            decorated()
+            self.assertEqual(_ensure_compliance.call_count, 2)
+        self.assertEqual(hook.call_count, 3)
+
+    def test_harden_disabled(self):
+        self.config['harden'] = None
+        hook = MagicMock(__name__='config_changed')
+        with patch.object(hardening, 'run_checks') as _run_checks:
+            hardening.harden()(hook)()
+        _run_checks.assert_not_called()
+        hook.assert_called_once_with()
@@ -23,15 +23,15 @@ from operator import itemgetter
 
 TO_PATCH = [
     'config',
-    'relation_get',
-    'relation_ids',
-    'related_units',
+    'relation_snapshot',
     'log',
     'https',
     'context_complete',
     'local_unit',
     'get_relation_ip',
     'pwgen',
+    'os_release',
+    'get_total_ram',
 ]
 
 
@@ -73,6 +73,12 @@ class TestHorizonContexts(CharmTestCase):
         self.config.side_effect = self.test_config.get
         self.pwgen.return_value = "secret"
 
+    def _relation_units(self, rids, units):
+        """Give every unit on every relation the data in test_relation."""
+        self.relation_snapshot.side_effect = lambda reltype: {
+            rid: {unit: self.test_relation.get() for unit in units}
+            for rid in rids}
+
     def test_Apachecontext(self):
         self.assertEqual(horizon_contexts.ApacheContext()(),
                          {'http_port': 70, 'https_port': 433,
@@ -962,23 +968,20 @@ class TestHorizonContexts(CharmTestCase):
                         .HorizonContext()()['disable_instance_snapshot'])
 
     def test_IdentityServiceContext_not_related(self):
-        self.relation_ids.return_value = []
+        self.relation_snapshot.return_value = {}
         self.context_complete.return_value = False
         self.assertEqual(horizon_contexts.IdentityServiceContext()(),
                          {})
 
     def test_IdentityServiceContext_no_units(self):
-        self.relation_ids.return_value = ['foo']
-        self.related_units.return_value = []
+        self.relation_snapshot.return_value = {'foo': {}}
         self.context_complete.return_value = False
         self.assertEqual(horizon_contexts.IdentityServiceContext()(),
                          {})
 
     @patch("hooks.horizon_contexts.format_ipv6_addr")
     def test_IdentityServiceContext_no_data(self, mock_format_ipv6_addr):
-        self.relation_ids.return_value = ['foo']
-        self.related_units.return_value = ['bar']
-        self.relation_get.side_effect = self.test_relation.get
+        self._relation_units(['foo'], ['bar'])
         self.context_complete.return_value = False
         self.assertEqual(horizon_contexts.IdentityServiceContext()(),
                          {})
@@ -986,9 +989,7 @@ class TestHorizonContexts(CharmTestCase):
     @patch("hooks.horizon_contexts.format_ipv6_addr")
     def test_IdentityServiceContext_data(self, mock_format_ipv6_addr):
         mock_format_ipv6_addr.side_effect = lambda x: x
-        self.relation_ids.return_value = ['foo']
-        self.related_units.return_value = ['bar', 'baz']
-        self.relation_get.side_effect = self.test_relation.get
+        self._relation_units(['foo'], ['bar', 'baz'])
         self.test_relation.set({'service_host': 'foo', 'service_port': 5000,
                                 'internal_host': 'bar', 'internal_port': 5001})
         self.test_config.set('use-internal-endpoints', False)
@@ -1006,9 +1007,7 @@ class TestHorizonContexts(CharmTestCase):
     @patch("hooks.horizon_contexts.format_ipv6_addr")
     def test_IdentityServiceContext_single_region(self, mock_format_ipv6_addr):
         mock_format_ipv6_addr.side_effect = lambda x: x
-        self.relation_ids.return_value = ['foo']
-        self.related_units.return_value = ['bar', 'baz']
-        self.relation_get.side_effect = self.test_relation.get
+        self._relation_units(['foo'], ['bar', 'baz'])
         self.test_relation.set({'service_host': 'foo', 'service_port': 5000,
                                 'internal_host': 'bar', 'internal_port': 5001,
                                 'region': 'regionOne'})
@@ -1026,9 +1025,7 @@ class TestHorizonContexts(CharmTestCase):
     @patch("hooks.horizon_contexts.format_ipv6_addr")
     def test_IdentityServiceContext_multi_region(self, mock_format_ipv6_addr):
         mock_format_ipv6_addr.side_effect = lambda x: x
-        self.relation_ids.return_value = ['foo']
-        self.related_units.return_value = ['bar', 'baz']
-        self.relation_get.side_effect = self.test_relation.get
+        self._relation_units(['foo'], ['bar', 'baz'])
         self.test_relation.set({'service_host': 'foo', 'service_port': 5000,
                                 'internal_host': 'bar', 'internal_port': 5001,
                                 'region': 'regionOne regionTwo'})
@@ -1052,9 +1049,7 @@ class TestHorizonContexts(CharmTestCase):
     def test_IdentityServiceContext_multi_region_v3(self,
                                                     mock_format_ipv6_addr):
         mock_format_ipv6_addr.side_effect = lambda x: x
-        self.relation_ids.return_value = ['foo']
-        self.related_units.return_value = ['bar', 'baz']
-        self.relation_get.side_effect = self.test_relation.get
+        self._relation_units(['foo'], ['bar', 'baz'])
         self.test_relation.set({'service_host': 'foo', 'service_port': 5000,
                                 'internal_host': 'bar', 'internal_port': 5001,
                                 'region': 'regionOne regionTwo',
@@ -1080,9 +1075,7 @@ class TestHorizonContexts(CharmTestCase):
     @patch("hooks.horizon_contexts.format_ipv6_addr")
     def test_IdentityServiceContext_api3(self, mock_format_ipv6_addr):
         mock_format_ipv6_addr.side_effect = lambda x: x
-        self.relation_ids.return_value = ['foo']
-        self.related_units.return_value = ['bar', 'baz']
-        self.relation_get.side_effect = self.test_relation.get
+        self._relation_units(['foo'], ['bar', 'baz'])
         self.test_relation.set({
             'service_host': 'foo',
             'service_port': 5000,
@@ -1110,9 +1103,7 @@ class TestHorizonContexts(CharmTestCase):
     @patch("hooks.horizon_contexts.format_ipv6_addr")
     def test_IdentityServiceContext_api3_missing(self, mock_format_ipv6_addr):
         mock_format_ipv6_addr.return_value = "foo"
-        self.relation_ids.return_value = ['foo']
-        self.related_units.return_value = ['bar', 'baz']
-        self.relation_get.side_effect = self.test_relation.get
+        self._relation_units(['foo'], ['bar', 'baz'])
         self.test_relation.set({
             'service_host': 'foo',
             'service_port': 5000,
@@ -1141,9 +1132,7 @@ class TestHorizonContexts(CharmTestCase):
     def test_IdentityServiceContext_default_role(self, mock_format_ipv6_addr):
         self.test_config.set('default-role', 'member')
         mock_format_ipv6_addr.side_effect = lambda x: x
-        self.relation_ids.return_value = ['foo']
-        self.related_units.return_value = ['bar', 'baz']
-        self.relation_get.side_effect = self.test_relation.get
+        self._relation_units(['foo'], ['bar', 'baz'])
         self.test_relation.set({
             'service_host': 'foo',
             'service_port': 5000,
@@ -1175,9 +1164,7 @@ class TestHorizonContexts(CharmTestCase):
                                                           mock_ipv6_addr):
         self.test_config.set('default-role', 'member')
         mock_ipv6_addr.side_effect = lambda x: x
-        self.relation_ids.return_value = ['foo']
-        self.related_units.return_value = ['bar', 'baz']
-        self.relation_get.side_effect = self.test_relation.get
+        self._relation_units(['foo'], ['bar', 'baz'])
         self.test_relation.set({
             'service_host': 'foo', 'service_port': 5000,
             'internal_host': 'bar', 'internal_port': 5001,
@@ -1201,9 +1188,7 @@ class TestHorizonContexts(CharmTestCase):
     def test_IdentityServiceContext_use_internal_endpoints(self,
                                                            mock_format_ipv6):
         mock_format_ipv6.side_effect = lambda x: x
-        self.relation_ids.return_value = ['foo']
-        self.related_units.return_value = ['bar', 'baz']
-        self.relation_get.side_effect = self.test_relation.get
+        self._relation_units(['foo'], ['bar', 'baz'])
         self.test_relation.set({'service_host': 'foo', 'service_port': 5000,
                                 'internal_host': 'bar', 'internal_port': 5001,
                                 'region': 'regionOne', 'api_version': '2'})
@@ -1225,9 +1210,7 @@ class TestHorizonContexts(CharmTestCase):
     def test_IdentityServiceContext_use_internal_endpoints_no_internal_host(
             self, mock_format_ipv6):
         mock_format_ipv6.side_effect = lambda x: x
-        self.relation_ids.return_value = ['foo']
-        self.related_units.return_value = ['bar', 'baz']
-        self.relation_get.side_effect = self.test_relation.get
+        self._relation_units(['foo'], ['bar', 'baz'])
         self.test_relation.set({'service_host': 'foo', 'service_port': 5000,
                                 'region': 'regionOne regionTwo',
                                 'api_version': '2'})
@@ -1251,7 +1234,7 @@ class TestHorizonContexts(CharmTestCase):
                           'title': 'regionTwo'}]})
 
     def test_HorizonHAProxyContext_no_cluster(self):
-        self.relation_ids.return_value = []
+        self.relation_snapshot.return_value = {}
         self.local_unit.return_value = 'openstack-dashboard/0'
         self.get_relation_ip.return_value = "10.5.0.1"
         with patch_open() as (_open, _file):
@@ -1266,11 +1249,12 @@ class TestHorizonContexts(CharmTestCase):
             self.get_relation_ip.assert_called_with('cluster')
 
     def test_HorizonHAProxyContext_clustered(self):
-        self.relation_ids.return_value = ['cluster:0']
-        self.related_units.return_value = [
-            'openstack-dashboard/1', 'openstack-dashboard/2'
-        ]
-        self.relation_get.side_effect = ['10.5.0.2', '10.5.0.3']
+        self.relation_snapshot.return_value = {
+            'cluster:0': {
+                'openstack-dashboard/1': {'private-address': '10.5.0.2'},
+                'openstack-dashboard/2': {'private-address': '10.5.0.3'},
+            }
+        }
         self.local_unit.return_value = 'openstack-dashboard/0'
         self.get_relation_ip.return_value = "10.5.0.1"
         with patch_open() as (_open, _file):
@@ -1288,7 +1272,7 @@ class TestHorizonContexts(CharmTestCase):
 
     def test_HorizonHAProxyContext_expose_stats(self):
         self.test_config.set('haproxy-expose-stats', True)
-        self.relation_ids.return_value = []
+        self.relation_snapshot.return_value = {}
         self.local_unit.return_value = 'openstack-dashboard/0'
         self.get_relation_ip.return_value = "10.5.0.1"
         with patch_open() as (_open, _file):
@@ -1308,7 +1292,7 @@ class TestHorizonContexts(CharmTestCase):
         self.test_config.set('haproxy-rate-limiting-enabled', limiting)
         self.test_config.set('haproxy-max-bytes-in-rate', max_bytes_in)
         self.test_config.set('haproxy-limit-period', limit_period)
-        self.relation_ids.return_value = []
+        self.relation_snapshot.return_value = {}
         self.local_unit.return_value = 'openstack-dashboard/0'
         self.get_relation_ip.return_value = "10.5.0.1"
         with patch_open() as (_open, _file):
@@ -1324,6 +1308,60 @@ class TestHorizonContexts(CharmTestCase):
             _open.assert_called_with('/etc/default/haproxy', 'w')
             self.assertTrue(_file.write.called)
 
+    @patch.object(horizon_contexts, 'write_haproxy_certs')
+    def test_HorizonHAProxyContext_http_mode(self, _write_haproxy_certs):
+        self.test_config.set('haproxy-mode', 'http')
+        self.test_config.set('haproxy-sticky-sessions', True)
+        self.test_config.set('haproxy-server-maxconn', 50)
+        self.relation_snapshot.return_value = {}
+        self.local_unit.return_value = 'openstack-dashboard/0'
+        self.get_relation_ip.return_value = "10.5.0.1"
+        self.https.return_value = False
+        with patch_open():
+            ctxt = horizon_contexts.HorizonHAProxyContext()()
+        self.assertEqual(ctxt['haproxy_service_modes'],
+                         {'dash_insecure': 'http'})
+        self.assertEqual(ctxt['haproxy_balance'], 'leastconn')
+        self.assertTrue(ctxt['haproxy_sticky_sessions'])
+        self.assertEqual(ctxt['haproxy_check_url'], '/horizon/auth/login/')
+        self.assertEqual(ctxt['haproxy_server_maxconn'], 50)
+        _write_haproxy_certs.assert_not_called()
+
+        self.https.return_value = True
+        _write_haproxy_certs.return_value = 'digest'
+        with patch_open():
+            ctxt = horizon_contexts.HorizonHAProxyContext()()
+        self.assertEqual(ctxt['haproxy_service_modes'],
+                         {'dash_insecure': 'http', 'dash_secure': 'http'})
+        self.assertEqual(ctxt['haproxy_ssl_crt'],
+                         horizon_contexts.HAPROXY_CERT_DIR)
+        self.assertEqual(ctxt['haproxy_ssl_crt_digest'], 'digest')
+
+    @patch.object(horizon_contexts, 'write_file')
+    @patch('os.remove')
+    @patch('os.makedirs')
+    @patch('os.listdir')
+    def test_write_haproxy_certs(self, _listdir, _makedirs, _remove,
+                                 _write_file):
+        _listdir.side_effect = [
+            ['cert_dashboard', 'key_dashboard', 'cert_orphan'],
+            ['dashboard.pem', 'old.pem'],
+        ]
+        files = {'cert_dashboard': b'CERT\n', 'key_dashboard': b'KEY'}
+
+        def _open(path, mode):
+            name = path.split('/')[-1]
+            if name not in files:
+                raise OSError
+            return io.BytesIO(files[name])
+
+        with patch('builtins.open', _open):
+            self.assertIsNotNone(horizon_contexts.write_haproxy_certs())
+        _write_file.assert_called_once_with(
+            '/etc/haproxy/horizon-certs/dashboard.pem', b'CERT\nKEY\n',
+            perms=0o600)
+        _remove.assert_called_once_with('/etc/haproxy/horizon-certs/old.pem')
+
     def test_RouterSettingContext(self):
         self.test_config.set('profile', 'cisco')
         self.assertEqual(horizon_contexts.RouterSettingContext()(),
@@ -1333,13 +1371,14 @@ class TestHorizonContexts(CharmTestCase):
                          {'disable_router': True, })
 
     def test_LocalSettingsContext(self):
-        self.relation_ids.return_value = ['plugin:0', 'plugin-too:0']
-        self.related_units.side_effect = [['horizon-plugin/0'],
-                                          ['horizon-plugin-too/0']]
-        self.relation_get.side_effect = [{'priority': 99,
-                                          'local-settings': 'FOO = True'},
-                                         {'priority': 60,
-                                          'local-settings': 'BAR = False'}]
+        self.relation_snapshot.return_value = {
+            'plugin:0': {
+                'horizon-plugin/0': {'priority': 99,
+                                     'local-settings': 'FOO = True'}},
+            'plugin-too:0': {
+                'horizon-plugin-too/0': {'priority': 60,
+                                         'local-settings': 'BAR = False'}},
+        }
 
         self.assertEqual(horizon_contexts.LocalSettingsContext()(),
                          {'settings': ['# horizon-plugin-too/0\n'
@@ -1348,14 +1387,15 @@ class TestHorizonContexts(CharmTestCase):
                                        'FOO = True']})
 
     def test_LocalSettingsContextJSON(self):
-        self.relation_ids.return_value = ['plugin:0', 'plugin-too:0']
-        self.related_units.side_effect = [['horizon-plugin/0'],
-                                          ['horizon-plugin-too/0']]
         # One JSON and one raw relation
-        self.relation_get.side_effect = [{'priority': "99",
-                                          'local-settings': '"FOO = True"'},
-                                         {'priority': 60,
-                                          'local-settings': 'BAR = False'}]
+        self.relation_snapshot.return_value = {
+            'plugin:0': {
+                'horizon-plugin/0': {'priority': "99",
+                                     'local-settings': '"FOO = True"'}},
+            'plugin-too:0': {
+                'horizon-plugin-too/0': {'priority': 60,
+                                         'local-settings': 'BAR = False'}},
+        }
 
         self.assertEqual(horizon_contexts.LocalSettingsContext()(),
                          {'settings': ['# horizon-plugin-too/0\n'
@@ -1364,60 +1404,40 @@ class TestHorizonContexts(CharmTestCase):
                                        'FOO = True']})
 
     def test_WebSSOFIDServiceProviderContext(self):
-        def relation_ids_side_effect(rname):
-            return {
-                'websso-fid-service-provider': [
-                    'websso-fid-service-provider:0',
-                    'websso-fid-service-provider:1',
-                ]
-            }[rname]
-        self.relation_ids.side_effect = relation_ids_side_effect
-
-        def related_units_side_effect(rid):
+        def relation_snapshot_side_effect(reltype):
             return {
-                'websso-fid-service-provider:0': [
-                    'keystone-saml-mellon-red/0',
-                    'keystone-saml-mellon-red/1',
-                ],
-                'websso-fid-service-provider:1': [
-                    'keystone-saml-mellon-green/0',
-                    'keystone-saml-mellon-green/1',
-                ],
-            }[rid]
-        self.related_units.side_effect = related_units_side_effect
-
-        def relation_get_side_effect(unit, rid):
-            return {
-                'websso-fid-service-provider:0': {
-                    'keystone-saml-mellon-red/0': {
-                        'ingress-address': '10.0.0.10',
-                        'protocol-name': '"saml2"',
-                        'idp-name': '"red"',
-                        'user-facing-name': '"Red IDP"',
-                    },
-                    'keystone-saml-mellon-red/1': {
-                        'ingress-address': '10.0.0.11',
-                        'protocol-name': '"saml2"',
-                        'idp-name': '"red"',
-                        'user-facing-name': '"Red IDP"',
-                    },
-                },
-                'websso-fid-service-provider:1': {
-                    'keystone-saml-mellon-green/0': {
-                        'ingress-address': '10.0.0.12',
-                        'protocol-name': '"mapped"',
-                        'idp-name': '"green"',
-                        'user-facing-name': '"Green IDP"',
+                'websso-fid-service-provider': {
+                    'websso-fid-service-provider:0': {
+                        'keystone-saml-mellon-red/0': {
+                            'ingress-address': '10.0.0.10',
+                            'protocol-name': '"saml2"',
+                            'idp-name': '"red"',
+                            'user-facing-name': '"Red IDP"',
+                        },
+                        'keystone-saml-mellon-red/1': {
+                            'ingress-address': '10.0.0.11',
+                            'protocol-name': '"saml2"',
+                            'idp-name': '"red"',
+                            'user-facing-name': '"Red IDP"',
+                        },
                     },
-                    'keystone-saml-mellon-green/1': {
-                        'ingress-address': '10.0.0.13',
-                        'protocol-name': '"mapped"',
-                        'idp-name': '"green"',
-                        'user-facing-name': '"Green IDP"',
+                    'websso-fid-service-provider:1': {
+                        'keystone-saml-mellon-green/0': {
+                            'ingress-address': '10.0.0.12',
+                            'protocol-name': '"mapped"',
+                            'idp-name': '"green"',
+                            'user-facing-name': '"Green IDP"',
+                        },
+                        'keystone-saml-mellon-green/1': {
+                            'ingress-address': '10.0.0.13',
+                            'protocol-name': '"mapped"',
+                            'idp-name': '"green"',
+                            'user-facing-name': '"Green IDP"',
+                        },
                     },
                 },
-            }[rid][unit]
-        self.relation_get.side_effect = relation_get_side_effect
+            }[reltype]
+        self.relation_snapshot.side_effect = relation_snapshot_side_effect
 
         self.assertEqual(
             horizon_contexts.WebSSOFIDServiceProviderContext()(),
@@ -1460,3 +1480,99 @@ class TestHorizonContexts(CharmTestCase):
             horizon_contexts.PolicydContext(extract_dirs_func)(), {
                 'policyd_overrides_activated': False,
             })
+
+    def test_MemcacheClusterContext_local(self):
+        self.os_release.return_value = 'yoga'
+        self.assertEqual(horizon_contexts.MemcacheClusterContext()(),
+                         {'memcache_server': '127.0.0.1',
+                          'memcache_port': 11211})
+
+    def test_MemcacheClusterContext_clustered(self):
+        self.test_config.set('memcache-cluster', True)
+        self.test_config.set('memcache-pool-size', 4)
+        self.os_release.return_value = 'yoga'
+        self.get_relation_ip.return_value = '10.5.0.2'
+        self.relation_snapshot.return_value = {
+            'cluster:0': {
+                'openstack-dashboard/1': {'private-address': '10.5.0.3'},
+                'openstack-dashboard/2': {'private-address': '10.5.0.1'},
+                'openstack-dashboard/3': {},
+            }
+        }
+        ctxt = horizon_contexts.MemcacheClusterContext()()
+        self.assertEqual(ctxt['memcache_server'], '10.5.0.2')
+        self.assertEqual(ctxt['memcache_servers'],
+                         ['10.5.0.1:11211', '10.5.0.2:11211',
+                          '10.5.0.3:11211'])
+        self.assertEqual(
+            ctxt['memcache_backend'],
+            'django.core.cache.backends.memcached.PyMemcacheCache')
+        self.assertTrue(ctxt['memcache_options']['use_pooling'])
+        self.assertEqual(ctxt['memcache_options']['max_pool_size'], 4)
+        self.relation_snapshot.assert_called_with('cluster')
+
+    def test_MemcacheClusterContext_pylibmc_before_yoga(self):
+        self.test_config.set('memcache-cluster', True)
+        self.os_release.return_value = 'ussuri'
+        self.get_relation_ip.return_value = 'fd00::1'
+        self.relation_snapshot.return_value = {}
+        ctxt = horizon_contexts.MemcacheClusterContext()()
+        self.assertEqual(ctxt['memcache_servers'], ['[fd00::1]:11211'])
+        self.assertEqual(
+            ctxt['memcache_backend'],
+            'django.core.cache.backends.memcached.PyLibMCCache')
+        self.assertTrue(ctxt['memcache_options']['behaviors']['ketama'])
+
+    def test_MemcacheClusterContext_unsupported_release(self):
+        self.test_config.set('memcache-cluster', True)
+        self.os_release.return_value = 'queens'
+        self.assertNotIn('memcache_servers',
+                         horizon_contexts.MemcacheClusterContext()())
+
+    @patch.object(horizon_contexts.context, '_calculate_workers')
+    def test_HorizonWSGIWorkerConfigContext(self, _calculate_workers):
+        _calculate_workers.return_value = 64
+        # 16GB of RAM at 512MB a process fits 16 processes in half of it
+        self.get_total_ram.return_value = 16 * 1024 ** 3
+        ctxt = horizon_contexts.HorizonWSGIWorkerConfigContext()()
+        self.assertEqual(ctxt['processes'], 16)
+        self.assertEqual(ctxt['threads'], 10)
+        self.assertEqual(ctxt['maximum_requests'], 10000)
+        self.assertEqual(ctxt['inactivity_timeout'], 300)
+        self.assertEqual(ctxt['queue_timeout'], 45)
+
+        _calculate_workers.return_value = 4
+        self.assertEqual(
+            horizon_contexts.HorizonWSGIWorkerConfigContext()()['processes'],
+            4)
+
+        self.test_config.set('wsgi-processes', 32)
+        self.assertEqual(
+            horizon_contexts.HorizonWSGIWorkerConfigContext()()['processes'],
+            32)
+
+    @patch.object(horizon_contexts.context, '_calculate_workers')
+    def test_wsgi_tuning_low_memory(self, _calculate_workers):
+        _calculate_workers.return_value = 4
+        self.get_total_ram.return_value = 512 * 1024 ** 2
+        self.assertEqual(horizon_contexts.wsgi_tuning()['processes'], 1)
+        self.assertEqual(horizon_contexts.wsgi_status_message(),
+                         'wsgi 1 processes x 10 threads')
+
+    @patch.object(horizon_contexts.context, '_calculate_workers')
+    def test_wsgi_tuning_no_memory_cap(self, _calculate_workers):
+        _calculate_workers.return_value = 64
+        self.get_total_ram.return_value = 512 * 1024 ** 2
+        for value in (0, -1):
+            self.test_config.set('wsgi-process-memory', value)
+            self.assertEqual(horizon_contexts.wsgi_tuning()['processes'], 64)
+
+    def test_StaticAssetsContext_static_root(self):
+        self.test_config.set('offline-compression', 'yes')
+        self.assertEqual(
+            horizon_contexts.StaticAssetsContext()()['static_root'],
+            '/var/lib/charm/openstack-dashboard/static')
+        self.test_config.set('offline-compression', 'no')
+        self.assertEqual(
+            horizon_contexts.StaticAssetsContext()()['static_root'],
+            '/var/lib/openstack-dashboard/static')
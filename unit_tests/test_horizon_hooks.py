@@ -23,13 +23,18 @@ sys.modules['apt'] = MagicMock()
 
 import hooks.horizon_utils as utils
 
-with patch('charmhelpers.contrib.hardening.harden.harden') as mock_dec:
+with patch('hooks.hardening.harden') as mock_dec:
     mock_dec.side_effect = (lambda *dargs, **dkwargs: lambda f:
                             lambda *args, **kwargs: f(*args, **kwargs))
 
     import hooks.horizon_hooks as hooks
 
 RESTART_MAP = utils.restart_map()
+# update_nrpe_config is patched out for the hook tests.
+update_nrpe_config = hooks.update_nrpe_config
+CONFIG_CHANGES = [
+    utils.templating.ConfigChange(f, None, 'bar', svcs)
+    for f, svcs in RESTART_MAP.items()]
 
 TO_PATCH = [
     'config',
@@ -39,6 +44,8 @@ TO_PATCH = [
     'apt_update',
     'apt_install',
     'filter_installed_packages',
+    'determine_memcache_packages',
+    'refresh_static_assets',
     'open_port',
     'CONFIGS',
     'relation_ids',
@@ -74,6 +81,9 @@ class TestHorizonHooks(CharmTestCase):
         super(TestHorizonHooks, self).setUp(hooks, TO_PATCH)
         self.config.side_effect = self.test_config.get
         self.b64decode.side_effect = passthrough
+        self.determine_memcache_packages.return_value = []
+        self.refresh_static_assets.return_value = False
+        self.enable_ssl.return_value = False
         hooks.hooks._config_save = False
         hooks.CONFIGS = None
 
@@ -106,6 +116,16 @@ class TestHorizonHooks(CharmTestCase):
             'new configs from force')
         _register_configs.assert_called_once_with()
 
+    @patch.object(hooks, 'flush_context_cache')
+    @patch.object(hooks, 'register_configs')
+    def test_resolve_CONFIGS_force_flushes_context_cache(
+            self, _register_configs, _flush_context_cache):
+        hooks.CONFIGS = 'existing stuff'
+        hooks.resolve_CONFIGS()
+        self.assertFalse(_flush_context_cache.called)
+        hooks.resolve_CONFIGS(force_update=True)
+        _flush_context_cache.assert_called_once_with()
+
     @patch.object(hooks, 'determine_packages')
     def test_install_hook(self, _determine_packages):
         _determine_packages.return_value = []
@@ -170,18 +190,15 @@ class TestHorizonHooks(CharmTestCase):
     @patch('time.sleep')
     @patch('hooks.horizon_hooks.check_custom_theme')
     @patch.object(hooks, 'determine_packages')
-    @patch.object(utils, 'path_hash')
-    @patch.object(utils, 'service')
-    def test_upgrade_charm_hook(self, _service, _hash,
+    @patch.object(utils.templating, 'config_changes')
+    @patch.object(hooks.effects, 'service')
+    def test_upgrade_charm_hook(self, _service, _config_changes,
                                 _determine_packages,
                                 _custom_theme,
                                 _sleep):
         self.remove_old_packages.return_value = False
         _determine_packages.return_value = []
-        side_effects = []
-        [side_effects.append(None) for f in RESTART_MAP.keys()]
-        [side_effects.append('bar') for f in RESTART_MAP.keys()]
-        _hash.side_effect = side_effects
+        _config_changes.side_effect = [[], CONFIG_CHANGES]
         self.filter_installed_packages.return_value = ['foo']
         self._call_hook('upgrade-charm.real')
         self.apt_install.assert_called_with(['foo'], fatal=True)
@@ -203,12 +220,12 @@ class TestHorizonHooks(CharmTestCase):
     @patch('time.sleep')
     @patch('hooks.horizon_hooks.check_custom_theme')
     @patch.object(hooks, 'determine_packages')
-    @patch.object(utils, 'path_hash')
-    @patch.object(utils, 'service')
+    @patch.object(utils.templating, 'config_changes')
+    @patch.object(hooks.effects, 'service')
     @patch('os.environ.get')
     def test_upgrade_charm_hook_purge(self, _environ_get,
                                       _service,
-                                      _hash,
+                                      _config_changes,
                                       _determine_packages,
                                       _custom_theme,
                                       _sleep):
@@ -216,10 +233,7 @@ class TestHorizonHooks(CharmTestCase):
         self.services.return_value = ['apache2']
         _determine_packages.return_value = []
         _environ_get.return_value = ''
-        side_effects = []
-        [side_effects.append(None) for f in RESTART_MAP.keys()]
-        [side_effects.append('bar') for f in RESTART_MAP.keys()]
-        _hash.side_effect = side_effects
+        _config_changes.side_effect = [[], CONFIG_CHANGES]
         self.filter_installed_packages.return_value = ['foo']
         self._call_hook('upgrade-charm.real')
         self.remove_old_packages.assert_called_once_with()
@@ -281,6 +295,7 @@ class TestHorizonHooks(CharmTestCase):
         self.assertTrue(self.register_configs().write_all.called)
         self.open_port.assert_has_calls([call(80), call(443)])
         self.assertTrue(_custom_theme.called)
+        self.refresh_static_assets.assert_called_once_with()
 
     @patch('hooks.horizon_hooks.check_custom_theme')
     @patch('hooks.horizon_hooks.is_leader')
@@ -322,24 +337,22 @@ class TestHorizonHooks(CharmTestCase):
     def test_keystone_changed_no_cert(self):
         self.relation_get.return_value = None
         self._call_hook('identity-service-relation-changed')
-        self.register_configs().write_all.assert_called_with()
+        self.register_configs().write_affected.assert_called_with()
         self.install_ca_cert.assert_not_called()
 
     def test_keystone_changed_cert(self):
         self.relation_get.return_value = 'certificate'
         self._call_hook('identity-service-relation-changed')
-        self.register_configs().write_all.assert_called_with()
+        self.register_configs().write_affected.assert_called_with()
         self.install_ca_cert.assert_called_with('certificate')
 
     def test_cluster_departed(self):
         self._call_hook('cluster-relation-departed')
-        self.register_configs().write.assert_called_with(
-            '/etc/haproxy/haproxy.cfg')
+        self.register_configs().write_affected.assert_called_once_with()
 
     def test_cluster_changed(self):
         self._call_hook('cluster-relation-changed')
-        self.register_configs().write.assert_called_with(
-            '/etc/haproxy/haproxy.cfg')
+        self.register_configs().write_affected.assert_called_once_with()
 
     def test_website_joined(self):
         self.unit_get.return_value = '192.168.1.1'
@@ -359,7 +372,7 @@ class TestHorizonHooks(CharmTestCase):
 
     def test_websso_fid_service_provider_changed(self):
         self._call_hook('websso-fid-service-provider-relation-changed')
-        self.register_configs().write_all.assert_called_with()
+        self.register_configs().write_affected.assert_called_with()
 
     def test_websso_trusted_dashboard_changed_no_tls(self):
         def relation_ids_side_effect(rname):
@@ -477,16 +490,68 @@ class TestHorizonHooks(CharmTestCase):
                  }),
         ])
 
-    @patch.object(hooks, 'service_reload')
+    @patch.object(hooks, 'flush_context_cache')
+    @patch.object(hooks.effects, 'service_reload')
     @patch.object(hooks, 'process_certificates')
-    def test_certs_changed(self, _process_certificates, _service_reload):
+    def test_certs_changed(self, _process_certificates, _service_reload,
+                           _flush_context_cache):
         self._call_hook('certificates-relation-changed')
         _process_certificates.assert_called_with(
             'horizon', None, None)
-        self.register_configs().write_all.assert_called_with()
+        _flush_context_cache.assert_called_once_with()
+        self.register_configs().write_affected.assert_called_with(
+            relations=['certificates'])
         _service_reload.assert_called_with('apache2')
         self.enable_ssl.assert_called_with()
 
+    @patch('time.sleep')
+    @patch.object(hooks, 'flush_context_cache')
+    @patch.object(hooks.effects, 'service_reload')
+    @patch.object(hooks, 'process_certificates')
+    @patch.object(utils.templating, 'config_changes')
+    @patch.object(hooks.effects, 'service')
+    def test_certs_changed_restarts_haproxy(self, _service, _config_changes,
+                                            _process_certificates,
+                                            _service_reload,
+                                            _flush_context_cache, _sleep):
+        # In HTTP mode the rotated certificate is written for haproxy, and
+        # its digest in haproxy.cfg changes.
+        _config_changes.side_effect = [[], [
+            utils.templating.ConfigChange(utils.HAPROXY_CONF, 'old', 'new',
+                                          ['haproxy'])]]
+        self._call_hook('certificates-relation-changed')
+        self.assertEqual(_service.call_args_list,
+                         [call('stop', 'haproxy'), call('start', 'haproxy')])
+        _service_reload.assert_called_with('apache2')
+
+    @patch.object(hooks, 'flush_context_cache')
+    @patch.object(hooks.effects, 'service')
+    @patch.object(hooks.effects, 'service_reload')
+    @patch.object(hooks, 'process_certificates')
+    def test_certs_changed_deferred(self, _process_certificates,
+                                    _service_reload, _service,
+                                    _flush_context_cache):
+        configs = self.register_configs()
+        with hooks.effects.deferred():
+            for unit in ('vault/0', 'vault/1', 'vault/2'):
+                hooks.certs_changed(relation_id='certificates:1', unit=unit)
+            self.assertEqual(_process_certificates.call_count, 3)
+            configs.write_affected.assert_not_called()
+            _service_reload.assert_not_called()
+        configs.write_affected.assert_called_once_with(
+            relations=['certificates'])
+        self.enable_ssl.assert_called_once_with()
+        _service_reload.assert_called_once_with('apache2')
+        _service.assert_not_called()
+        # A restart of the same service makes the reload redundant.
+        _service_reload.reset_mock()
+        with hooks.effects.deferred():
+            hooks.certs_changed(relation_id='certificates:1', unit='vault/0')
+            hooks.effects.restart(['apache2'], stopstart=True, sleep=0)
+        _service_reload.assert_not_called()
+        self.assertEqual(_service.call_args_list,
+                         [call('stop', 'apache2'), call('start', 'apache2')])
+
     @patch.object(hooks, 'is_leader')
     @patch('os.environ.get')
     def test_application_dashboard(self, _environ_get, _is_leader):
@@ -525,3 +590,92 @@ class TestHorizonHooks(CharmTestCase):
                      "group": "[local] OpenStack"
                  })
         ])
+
+    @patch.object(hooks.unit_state, 'maintain')
+    @patch.object(hooks, 'unitdata')
+    @patch.object(hooks, 'hook_name')
+    @patch.object(hooks, 'assess_status')
+    @patch.object(hooks, 'resolve_CONFIGS')
+    @patch.object(hooks.hooks, 'execute')
+    @patch.object(hooks.import_profile, 'report')
+    @patch.object(hooks.import_profile, 'stop')
+    @patch.object(hooks.import_profile, 'enabled')
+    def test_main_import_profile(self, _enabled, _stop, _report, _execute,
+                                 _resolve_CONFIGS, _assess_status,
+                                 _hook_name, _unitdata, _maintain):
+        _hook_name.return_value = 'config-changed'
+        _enabled.return_value = False
+        hooks.main()
+        _stop.assert_not_called()
+        self.log.assert_not_called()
+        _enabled.return_value = True
+        _report.return_value = [('charmhelpers.fetch', 12.5, 2.5)]
+        hooks.main()
+        _stop.assert_called_once_with()
+        self.log.assert_called_once_with(
+            'Import profile (self/cumulative ms): '
+            'charmhelpers.fetch 2.5/12.5', level='INFO')
+
+    @patch.object(hooks.unit_state, 'use_wal')
+    @patch.object(hooks.unit_state, 'deferred_commit')
+    @patch.object(hooks.unit_state, 'maintain')
+    @patch.object(hooks, 'unitdata')
+    @patch.object(hooks, 'hook_name')
+    @patch.object(hooks, 'assess_status_fast')
+    @patch.object(hooks, 'assess_status')
+    @patch.object(hooks, 'resolve_CONFIGS')
+    @patch.object(hooks.hooks, 'execute')
+    def test_main_update_status_fast_path(self, _execute, _resolve_CONFIGS,
+                                          _assess_status, _assess_status_fast,
+                                          _hook_name, _unitdata, _maintain,
+                                          _deferred_commit, _use_wal):
+        _hook_name.return_value = 'update-status'
+        _assess_status_fast.return_value = True
+        hooks.main()
+        _execute.assert_called_once_with(hooks.sys.argv)
+        _resolve_CONFIGS.assert_not_called()
+        _assess_status.assert_not_called()
+        _use_wal.assert_called_once_with(_unitdata.kv())
+        _deferred_commit.assert_called_once_with(_unitdata.kv())
+        _maintain.assert_called_once_with(_unitdata.kv())
+        # Fall back to the full assessment when the snapshot is stale.
+        _assess_status_fast.return_value = False
+        hooks.main()
+        _resolve_CONFIGS.assert_called_once_with()
+        _assess_status.assert_called_once_with(hooks.CONFIGS)
+        # Other hooks always run the full assessment.
+        _hook_name.return_value = 'config-changed'
+        _assess_status_fast.reset_mock()
+        hooks.main()
+        _assess_status_fast.assert_not_called()
+        self.assertEqual(_assess_status.call_count, 2)
+
+    @patch.object(hooks, 'NRPE')
+    @patch.object(hooks, 'nrpe')
+    @patch.object(hooks, 'init_is_systemd')
+    def test_update_nrpe_config_systemd(self, _init_is_systemd, _nrpe,
+                                        _NRPE):
+        _init_is_systemd.return_value = True
+        self.services.return_value = ['apache2', 'haproxy']
+        _NRPE.return_value.config = {}
+        update_nrpe_config()
+        self.filter_installed_packages.assert_not_called()
+        self.apt_install.assert_not_called()
+        _NRPE.return_value.write.assert_called_once_with()
+
+    @patch.object(hooks, 'NRPE')
+    @patch.object(hooks, 'nrpe')
+    @patch.object(hooks, 'init_is_systemd')
+    def test_update_nrpe_config_upstart(self, _init_is_systemd, _nrpe,
+                                        _NRPE):
+        _init_is_systemd.return_value = False
+        self.services.return_value = ['apache2']
+        _NRPE.return_value.config = {}
+        self.filter_installed_packages.return_value = []
+        update_nrpe_config()
+        self.filter_installed_packages.assert_called_once_with(
+            ['python-dbus'])
+        self.apt_install.assert_not_called()
+        self.filter_installed_packages.return_value = ['python-dbus']
+        update_nrpe_config()
+        self.apt_install.assert_called_once_with(['python-dbus'])
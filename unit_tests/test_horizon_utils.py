@@ -14,6 +14,13 @@
 
 from unittest.mock import MagicMock, patch, call
 from collections import OrderedDict
+from contextlib import contextmanager
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import tempfile
 # import charmhelpers.contrib.openstack.templating as templating
 # templating.OSConfigRenderer = MagicMock()
 
@@ -36,18 +43,23 @@ TO_PATCH = [
     'os_release',
     'os_application_version_set',
     'reset_os_release',
-    'relation_ids',
-    'related_units',
+    'relation_snapshot',
     'relation_get',
     'HorizonOSConfigRenderer',
 ]
 
+# Not patched by TO_PATCH, for the tests of the renderer itself.
+_HorizonOSConfigRenderer = horizon_utils.HorizonOSConfigRenderer
+
 
 class TestHorizonUtils(CharmTestCase):
 
     def setUp(self):
         super(TestHorizonUtils, self).setUp(horizon_utils, TO_PATCH)
         self.config.side_effect = self.test_config.get
+        _config = patch.object(horizon_utils.horizon_contexts, 'config')
+        _config.start().side_effect = self.test_config.get
+        self.addCleanup(_config.stop)
 
     def test_determine_packages(self):
         horizon_utils.os_release.return_value = 'icehouse'
@@ -104,12 +116,12 @@ class TestHorizonUtils(CharmTestCase):
     def test_determine_purge_packages(self):
         'Ensure no packages are identified for purge prior to rocky'
         horizon_utils.os_release.return_value = 'queens'
-        horizon_utils.relation_ids.return_value = []
+        horizon_utils.relation_snapshot.return_value = {}
         self.assertEqual(horizon_utils.determine_purge_packages(), [])
 
     def test_determine_purge_packages_rocky(self):
         'Ensure python packages are identified for purge at rocky'
-        horizon_utils.relation_ids.return_value = []
+        horizon_utils.relation_snapshot.return_value = {}
         horizon_utils.os_release.return_value = 'rocky'
         verify_pkgs = (
             [p for p in horizon_utils.BASE_PACKAGES
@@ -126,7 +138,7 @@ class TestHorizonUtils(CharmTestCase):
 
     def test_determine_purge_packages_victoria(self):
         'Ensure python packages are identified for purge at victoria'
-        horizon_utils.relation_ids.return_value = []
+        horizon_utils.relation_snapshot.return_value = {}
         horizon_utils.os_release.return_value = 'victoria'
         verify_pkgs = (
             [p for p in horizon_utils.BASE_PACKAGES
@@ -144,38 +156,27 @@ class TestHorizonUtils(CharmTestCase):
             sorted(verify_pkgs))
 
     def _patch_for_dashboard_plugin_packages(self):
-
-        def relation_ids_side_effect(rname):
-            return {
-                'dashboard-plugin': [
-                    'dashboard-plugin:0',
-                    'dashboard-plugin:1',
-                ],
-            }[rname]
-        horizon_utils.relation_ids.side_effect = relation_ids_side_effect
-
-        def related_units_side_effect(rid):
-            return {
-                'dashboard-plugin:0': ['r0', 'r1'],
-                'dashboard-plugin:1': ['r2'],
-            }[rid]
-        horizon_utils.related_units.side_effect = related_units_side_effect
-
-        def relation_get_side_effect(unit=None, rid=None):
-            return {
-                "dashboard-plugin:0/r0": {
+        horizon_utils.relation_snapshot.return_value = {
+            'dashboard-plugin:0': {
+                'r0': {
                     'install-packages': '["p1", "p3", "p2"]',
                     'conflicting-packages': '["n2"]',
                 },
-                "dashboard-plugin:0/r1": {
+                'r1': {
                     'install-packages': '["p5", "p6"]',
                     'conflicting-packages': "",
                 },
-                "dashboard-plugin:1/r2": {
+            },
+            'dashboard-plugin:1': {
+                'r2': {
                     'install-packages': '["p4", "p6"]',
                     'conflicting-packages': '["n1"]',
                 },
-            }["{}/{}".format(rid, unit)]
+            },
+        }
+
+        def relation_get_side_effect(unit=None, rid=None):
+            return horizon_utils.relation_snapshot.return_value[rid][unit]
         horizon_utils.relation_get.side_effect = relation_get_side_effect
 
     def test_determine_packages_dashboard_plugin(self):
@@ -307,16 +308,323 @@ class TestHorizonUtils(CharmTestCase):
         mock_store_plugin_packages_in_kv.assert_called_once_with(
             "dashboard-plugin:0", "r0", ["n2"], ["p1", "p3", "p2"])
 
+    def _apache_dir(self, mods=(), sites=()):
+        apache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, apache_dir)
+        for kind, names, suffix in (('mods', mods, '.load'),
+                                    ('sites', sites, '.conf')):
+            os.mkdir(os.path.join(apache_dir, kind + '-enabled'))
+            for name in names:
+                open(os.path.join(apache_dir, kind + '-enabled',
+                                  name + suffix), 'w').close()
+        for p in (patch.object(horizon_utils.apache, 'APACHE_DIR',
+                               apache_dir),
+                  patch.object(horizon_utils.apache, 'log')):
+            p.start()
+            self.addCleanup(p.stop)
+
     @patch('subprocess.call')
     def test_enable_ssl(self, _call):
-        horizon_utils.enable_ssl()
+        _call.return_value = 0
+        self._apache_dir(mods=['rewrite'])
+        self.assertTrue(horizon_utils.enable_ssl())
         _call.assert_has_calls([
             call(['a2ensite', 'default-ssl']),
-            call(['a2enmod', 'ssl']),
-            call(['a2enmod', 'rewrite']),
-            call(['a2enmod', 'headers'])
+            call(['a2enmod', 'ssl', 'headers']),
         ])
 
+    @patch('subprocess.call')
+    def test_enable_ssl_http2(self, _call):
+        _call.return_value = 0
+        self.test_config.set('http2', True)
+        self._apache_dir(mods=['ssl', 'rewrite', 'headers'],
+                         sites=['default-ssl'])
+        self.assertTrue(horizon_utils.enable_ssl())
+        _call.assert_called_once_with(['a2enmod', 'http2'])
+
+    @patch('subprocess.call')
+    def test_enable_ssl_failed(self, _call):
+        # A failed a2ensite or a2enmod changed nothing to reload for
+        _call.return_value = 1
+        self._apache_dir(mods=['rewrite'])
+        self.assertFalse(horizon_utils.enable_ssl())
+        self.assertEqual(_call.call_count, 2)
+        _call.side_effect = [1, 0]
+        self.assertTrue(horizon_utils.enable_ssl())
+
+    @patch('subprocess.call')
+    def test_enable_ssl_already_enabled(self, _call):
+        self._apache_dir(mods=['ssl', 'rewrite', 'headers'],
+                         sites=['default-ssl'])
+        self.assertFalse(horizon_utils.enable_ssl())
+        _call.assert_not_called()
+
+    def _precompress_dir(self):
+        static_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_dir)
+        db = horizon_utils.unitdata.Storage(':memory:')
+        patcher = patch.object(horizon_utils.unitdata, 'kv', return_value=db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return static_dir, db
+
+    def test_precompress_static_assets(self):
+        static_dir, db = self._precompress_dir()
+        css = os.path.join(static_dir, 'dashboard.css')
+        content = b'body { margin: 0; }\n' * 100
+        with open(css, 'wb') as f:
+            f.write(content)
+        with open(os.path.join(static_dir, 'tiny.js'), 'wb') as f:
+            f.write(b'x')
+        with open(os.path.join(static_dir, 'gone.js.gz'), 'wb') as f:
+            f.write(b'shipped')
+        with open(os.path.join(static_dir, 'app.js.gz.tmp'), 'wb') as f:
+            f.write(b'interrupted')
+
+        written = horizon_utils.precompress_static_assets(static_dir)
+        with gzip.open(css + '.gz') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(os.stat(css + '.gz').st_mtime_ns,
+                         os.stat(css).st_mtime_ns)
+        self.assertEqual(written, len([n for n in os.listdir(static_dir)
+                                       if n.startswith('dashboard.css.')]))
+        self.assertIn('dashboard.css.gz',
+                      db.get(horizon_utils.PRECOMPRESSED_KV_KEY)['variants'])
+        self.assertFalse(os.path.exists(
+            os.path.join(static_dir, 'tiny.js.gz')))
+        self.assertFalse(os.path.exists(
+            os.path.join(static_dir, 'app.js.gz.tmp')))
+        # Variants the charm did not write are kept
+        self.assertTrue(os.path.exists(
+            os.path.join(static_dir, 'gone.js.gz')))
+        # Variants matching their asset are not rewritten
+        self.assertEqual(
+            horizon_utils.precompress_static_assets(static_dir), 0)
+
+    def test_precompress_static_assets_asset_changed(self):
+        static_dir, db = self._precompress_dir()
+        css = os.path.join(static_dir, 'dashboard.css')
+        with open(css, 'wb') as f:
+            f.write(b'body { margin: 0; }\n' * 100)
+        horizon_utils.precompress_static_assets(static_dir)
+        # A package upgrade replaces the asset with an older mtime
+        content = b'body { margin: 1px; }\n' * 100
+        with open(css, 'wb') as f:
+            f.write(content)
+        os.utime(css, (0, 0))
+        self.assertGreater(
+            horizon_utils.precompress_static_assets(static_dir), 0)
+        with gzip.open(css + '.gz') as f:
+            self.assertEqual(f.read(), content)
+        # The asset is removed: so are the variants written for it
+        os.remove(css)
+        horizon_utils.precompress_static_assets(static_dir)
+        self.assertEqual(os.listdir(static_dir), [])
+        self.assertEqual(
+            db.get(horizon_utils.PRECOMPRESSED_KV_KEY)['variants'], {})
+
+    @patch.object(horizon_utils, 'write_file')
+    @patch.object(horizon_utils, 'static_assets_digest')
+    @patch('subprocess.check_call')
+    def test_build_static_assets(self, _check_call, _digest, _write_file):
+        var_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, var_dir)
+        static_dir = os.path.join(var_dir, 'static')
+        os.mkdir(static_dir)
+        charm_dir = os.path.join(var_dir, 'charm')
+        builds = os.path.join(charm_dir, 'builds')
+        link = os.path.join(charm_dir, 'static')
+        settings = os.path.join(var_dir, '_99_juju_static_root.py')
+        patchers = [
+            patch.object(horizon_utils, 'STATIC_DIR', static_dir),
+            patch.object(horizon_utils, 'STATIC_ROOT_SETTING', settings),
+            patch.object(horizon_utils.horizon_contexts, 'STATIC_BUILD_DIR',
+                         builds),
+            patch.object(horizon_utils.horizon_contexts, 'STATIC_ROOT_LINK',
+                         link),
+            patch.object(horizon_utils.unitdata, 'kv',
+                         return_value=horizon_utils.unitdata.Storage(
+                             ':memory:')),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        def _build(cmd, env):
+            os.makedirs(env['HORIZON_STATIC_ROOT'], exist_ok=True)
+
+        _check_call.side_effect = _build
+        _digest.return_value = 'a' * 64
+        self.assertTrue(horizon_utils.build_static_assets())
+        self.assertEqual(os.path.realpath(link),
+                         os.path.join(builds, 'aaaaaaaaaaaa'))
+        # The package's static directory is left alone
+        self.assertTrue(os.path.isdir(static_dir))
+        self.assertFalse(os.path.islink(static_dir))
+        _write_file.assert_called_once_with(
+            settings, horizon_utils.STATIC_ROOT_SETTING_CONTENT, perms=0o644)
+        _check_call.assert_has_calls([
+            call(['python3', horizon_utils.MANAGE_PY, 'collectstatic',
+                  '--noinput'], env=_check_call.call_args[1]['env']),
+            call(['python3', horizon_utils.MANAGE_PY, 'compress',
+                  '--force'], env=_check_call.call_args[1]['env'])])
+
+        # Unchanged inputs are not rebuilt
+        _check_call.reset_mock()
+        self.assertFalse(horizon_utils.build_static_assets())
+        _check_call.assert_not_called()
+
+        # A new build keeps only the previous one
+        os.mkdir(os.path.join(var_dir, 'static.sibling'))
+        _digest.return_value = 'b' * 64
+        self.assertTrue(horizon_utils.build_static_assets())
+        _digest.return_value = 'c' * 64
+        self.assertTrue(horizon_utils.build_static_assets())
+        self.assertEqual(os.path.realpath(link),
+                         os.path.join(builds, 'cccccccccccc'))
+        self.assertEqual(sorted(os.listdir(builds)),
+                         ['bbbbbbbbbbbb', 'cccccccccccc'])
+        self.assertTrue(os.path.isdir(os.path.join(var_dir,
+                                                   'static.sibling')))
+
+        # A failed build leaves the current assets in place
+        _digest.return_value = 'd' * 64
+        _check_call.side_effect = subprocess.CalledProcessError(1, 'compress')
+        self.assertFalse(horizon_utils.build_static_assets())
+        self.assertEqual(os.path.realpath(link),
+                         os.path.join(builds, 'cccccccccccc'))
+        self.assertFalse(os.path.exists(os.path.join(builds,
+                                                     'dddddddddddd')))
+
+        # Disabling offline compression resets STATIC_ROOT
+        with open(settings, 'w'):
+            pass
+        self.test_config.set('offline-compression', 'no')
+        self.assertTrue(horizon_utils.build_static_assets())
+        self.assertFalse(os.path.exists(settings))
+        self.assertFalse(horizon_utils.build_static_assets())
+
+    @patch.object(horizon_utils, 'file_hash')
+    @patch.object(horizon_utils, 'package_index')
+    def test_static_assets_digest(self, _package_index, _file_hash):
+        _package_index.return_value.installed = {
+            'openstack-dashboard': '4:23.0.0-0ubuntu1',
+            'python3-heat-dashboard': '8.0.0-0ubuntu1',
+            'apache2': '2.4.52-1ubuntu4.6',
+        }
+        with patch.object(horizon_utils, 'CUSTOM_THEME_DIR', '/nonexistent'), \
+                patch.object(horizon_utils, 'DASHBOARD_PKG_DIR',
+                             '/nonexistent'):
+            digest = horizon_utils.static_assets_digest()
+            # Unrelated packages do not change the digest
+            _package_index.return_value.installed['apache2'] = '2.4.53'
+            self.assertEqual(horizon_utils.static_assets_digest(), digest)
+            _package_index.return_value.installed[
+                'python3-heat-dashboard'] = '9.0.0-0ubuntu1'
+            self.assertNotEqual(horizon_utils.static_assets_digest(), digest)
+
+    def test_build_static_assets_online_compression(self):
+        self.test_config.set('offline-compression', 'no')
+        self.assertFalse(horizon_utils.build_static_assets())
+
+    def _nrpe_dirs(self):
+        nagios_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, nagios_dir)
+        confdir = os.path.join(nagios_dir, 'nrpe.d')
+        exportdir = os.path.join(nagios_dir, 'export')
+        os.mkdir(confdir)
+        os.mkdir(exportdir)
+        nrpe = horizon_utils.nrpe
+        patchers = [
+            patch.object(nrpe.NRPE, 'nrpe_confdir', confdir),
+            patch.object(nrpe.NRPE, 'nagios_exportdir', exportdir),
+            patch.object(nrpe.NRPE, 'nagios_logdir', nagios_dir),
+            patch.object(nrpe, 'config', return_value={
+                'nagios_context': 'juju', 'nagios_servicegroups': ''}),
+            patch.object(nrpe, 'local_unit', return_value='dashboard/0'),
+            patch.object(nrpe, 'relation_ids', return_value=[]),
+            patch.object(nrpe, 'log'),
+            patch.object(horizon_utils.pwd, 'getpwnam'),
+            patch.object(horizon_utils.grp, 'getgrnam'),
+            patch.object(horizon_utils, 'local_unit',
+                         return_value='dashboard/0'),
+            patch.object(horizon_utils, 'hook_name',
+                         return_value='config-changed'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return confdir, exportdir
+
+    @patch.object(horizon_utils, 'relation_set')
+    @patch.object(horizon_utils, 'relation_ids')
+    @patch.object(horizon_utils, 'service')
+    def test_nrpe_write_reconciles(self, _service, _relation_ids,
+                                   _relation_set):
+        confdir, exportdir = self._nrpe_dirs()
+        _relation_ids.side_effect = lambda reltype: (
+            ['nrpe-external-master:1']
+            if reltype == 'nrpe-external-master' else [])
+        self.relation_get.return_value = {}
+
+        def _write(description='Check HAProxy'):
+            nrpe_setup = horizon_utils.NRPE(hostname='juju-dashboard-0')
+            nrpe_setup.add_check(shortname='haproxy_servers',
+                                 description=description,
+                                 check_cmd='check_haproxy.sh')
+            nrpe_setup.write()
+            return nrpe_setup
+
+        _write()
+        self.assertEqual(os.listdir(confdir), ['check_haproxy_servers.cfg'])
+        self.assertEqual(
+            os.listdir(exportdir),
+            ['service__juju-dashboard-0_check_haproxy_servers.cfg'])
+        _service.assert_called_once_with('restart', 'nagios-nrpe-server')
+        monitors = _relation_set.call_args[1]['monitors']
+        _relation_set.assert_called_once_with(
+            relation_id='nrpe-external-master:1', monitors=monitors)
+
+        # Nothing changed: no restart and no relation update
+        _service.reset_mock()
+        _relation_set.reset_mock()
+        self.relation_get.return_value = {'monitors': monitors}
+        mtime = os.stat(
+            os.path.join(confdir, 'check_haproxy_servers.cfg')).st_mtime_ns
+        _write()
+        _service.assert_not_called()
+        _relation_set.assert_not_called()
+        self.assertEqual(os.stat(os.path.join(
+            confdir, 'check_haproxy_servers.cfg')).st_mtime_ns, mtime)
+
+        # Only the service definition changed: nagios-nrpe-server does not
+        # need a restart
+        _write(description='Check HAProxy servers')
+        _service.assert_not_called()
+        with open(os.path.join(
+                exportdir,
+                'service__juju-dashboard-0_check_haproxy_servers.cfg')) as f:
+            self.assertIn('Check HAProxy servers', f.read())
+
+        # Removing a loaded check restarts nagios-nrpe-server
+        nrpe_setup = horizon_utils.NRPE(hostname='juju-dashboard-0')
+        nrpe_setup.remove_check(shortname='haproxy_servers')
+        nrpe_setup.write()
+        self.assertEqual(os.listdir(confdir), [])
+        _service.assert_called_once_with('restart', 'nagios-nrpe-server')
+
+    @patch.object(horizon_utils, 'relation_ids', return_value=[])
+    @patch.object(horizon_utils, 'service')
+    def test_nrpe_write_update_status(self, _service, _relation_ids):
+        self._nrpe_dirs()
+        horizon_utils.hook_name.return_value = 'update-status'
+        nrpe_setup = horizon_utils.NRPE(hostname='juju-dashboard-0')
+        nrpe_setup.add_check(shortname='haproxy_servers',
+                             description='Check HAProxy',
+                             check_cmd='check_haproxy.sh')
+        nrpe_setup.write()
+        _service.assert_not_called()
+
     def test_restart_map(self):
         ex_map = OrderedDict([
             ('/etc/openstack-dashboard/local_settings.py',
@@ -337,6 +645,8 @@ class TestHorizonUtils(CharmTestCase):
              ['apache2', 'memcached']),
             ('/etc/haproxy/haproxy.cfg',
              ['haproxy']),
+            ('/etc/memcached.conf',
+             ['memcached']),
             ('/usr/share/openstack-dashboard/openstack_dashboard/enabled/'
              '_40_router.py',
              ['apache2', 'memcached']),
@@ -349,6 +659,177 @@ class TestHorizonUtils(CharmTestCase):
         ])
         self.assertEqual(horizon_utils.restart_map(), ex_map)
 
+    @patch.object(horizon_utils, 'is_unit_paused_set')
+    @patch.object(horizon_utils.templating, 'config_changes')
+    @patch.object(horizon_utils, 'service')
+    def test_restart_on_change(self, _service, _config_changes,
+                               _is_unit_paused_set):
+        _is_unit_paused_set.return_value = False
+        earlier = horizon_utils.templating.ConfigChange(
+            horizon_utils.LOCAL_SETTINGS, 'a', 'b', ['apache2'])
+        haproxy = horizon_utils.templating.ConfigChange(
+            horizon_utils.HAPROXY_CONF, None, 'c', ['haproxy'])
+        _config_changes.side_effect = [[earlier], [earlier, haproxy]]
+        restart_map = horizon_utils.restart_map()
+
+        @horizon_utils.restart_on_change(restart_map)
+        def _hook():
+            pass
+
+        _hook()
+        _service.assert_called_once_with('restart', 'haproxy')
+
+    def test_config_files_share_context_cache_keys(self):
+        local_settings_ctxt = (
+            horizon_utils.CONFIG_FILES[horizon_utils.LOCAL_SETTINGS]
+            ['hook_contexts'][0])
+        apache_ctxt = (
+            horizon_utils.CONFIG_FILES[horizon_utils.APACHE_24_CONF]
+            ['hook_contexts'][0])
+        self.assertIsNot(local_settings_ctxt, apache_ctxt)
+        self.assertEqual(
+            horizon_utils.templating.context_cache_key(local_settings_ctxt),
+            horizon_utils.templating.context_cache_key(apache_ctxt))
+
+    @patch.object(horizon_utils, 'maybe_handle_policyd_override')
+    @patch.object(horizon_utils, 'hook_name')
+    def test_write_all_commits_before_policyd(self, _hook_name, _policyd):
+        _hook_name.return_value = 'config-changed'
+        events = []
+
+        @contextmanager
+        def batch():
+            events.append('batch')
+            yield
+            events.append('commit')
+
+        configs = _HorizonOSConfigRenderer(templates_dir='templates',
+                                           openstack_release='zed')
+        configs.templates = OrderedDict([
+            ('/etc/apache2/ports.conf', None),
+            (horizon_utils.LOCAL_SETTINGS, None)])
+        _policyd.side_effect = lambda *args: events.append('policyd')
+        with patch.object(configs, 'batch', batch), \
+                patch.object(configs, 'write', side_effect=events.append):
+            configs.write_all()
+        self.assertEqual(events, ['batch', '/etc/apache2/ports.conf',
+                                  'commit', 'policyd',
+                                  horizon_utils.LOCAL_SETTINGS])
+
+    def test_write_skips_unchanged_context(self):
+        templating = horizon_utils.templating
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        with open(os.path.join(tmp, 'a.conf'), 'w') as f:
+            f.write('{{ value }}')
+        a_conf = os.path.join(tmp, 'out.conf')
+        value = {'value': 'x'}
+        for p in [patch.object(templating, 'atexit'),
+                  patch.object(templating, 'log'),
+                  patch.object(templating, 'hook_name',
+                               return_value='config-changed'),
+                  patch.object(templating.unitdata, 'kv',
+                               return_value=templating.unitdata.Storage(
+                                   ':memory:'))]:
+            p.start()
+            self.addCleanup(p.stop)
+        configs = templating.OSConfigRenderer(templates_dir=tmp,
+                                              openstack_release='queens')
+
+        class ValueContext(horizon_utils.context.OSContextGenerator):
+            def __call__(self):
+                return dict(value)
+
+        self.addCleanup(templating.flush_context_cache)
+        configs.register(a_conf, [ValueContext()],
+                         config_template='{{ value }}')
+        self.assertIsNotNone(configs.write(a_conf))
+        record = templating.rendered_context(a_conf)
+        self.assertEqual(record['context'], {'value': 'x'})
+        self.assertNotIn('previous', record)
+
+        with patch.object(configs, '_render') as _render:
+            self.assertIsNone(configs.write(a_conf))
+            _render.assert_not_called()
+
+        # Edited on disk: rendered again although the context is the same.
+        with open(a_conf, 'w') as f:
+            f.write('edited')
+        self.assertIsNotNone(configs.write(a_conf))
+
+        value['value'] = 'y'
+        templating.flush_context_cache()
+        templating.hook_name.return_value = 'cluster-relation-changed'
+        configs.write(a_conf)
+        record = templating.rendered_context(a_conf)
+        self.assertEqual(record['hook'], 'cluster-relation-changed')
+        self.assertEqual(record['previous']['context'], {'value': 'x'})
+        self.assertEqual(
+            templating.diff_contexts(record['previous']['context'],
+                                     record['context']),
+            [(('value',), 'x', 'y')])
+
+        # Secrets are only stored as a digest, changing one still renders.
+        value['db_password'] = 's3cret'
+        templating.flush_context_cache()
+        configs.write(a_conf)
+        record = templating.rendered_context(a_conf)
+        self.assertNotIn('s3cret', json.dumps(record))
+        self.assertTrue(record['context']['db_password'].startswith(
+            templating.REDACTED_PREFIX))
+        value['db_password'] = 'n3wsecret'
+        templating.flush_context_cache()
+        with patch.object(configs, '_render',
+                          wraps=configs._render) as _render:
+            configs.write(a_conf)
+            self.assertEqual(_render.call_count, 1)
+        record = templating.rendered_context(a_conf)
+        self.assertNotIn('n3wsecret', json.dumps(record))
+        [(path, before, after)] = templating.diff_contexts(
+            record['previous']['context'], record['context'])
+        self.assertEqual(path, ('db_password',))
+        self.assertNotEqual(before, after)
+
+    def test_write_twice_in_batch_back_to_disk(self):
+        templating = horizon_utils.templating
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        a_conf = os.path.join(tmp, 'out.conf')
+        value = {'value': 'x'}
+        for p in [patch.object(templating, 'atexit'),
+                  patch.object(templating, 'log'),
+                  patch.object(templating, 'hook_name',
+                               return_value='config-changed'),
+                  patch.object(templating.unitdata, 'kv',
+                               return_value=templating.unitdata.Storage(
+                                   ':memory:'))]:
+            p.start()
+            self.addCleanup(p.stop)
+        self.addCleanup(templating._flush_config_changes)
+        self.addCleanup(templating.flush_context_cache)
+        configs = templating.OSConfigRenderer(templates_dir=tmp,
+                                              openstack_release='queens')
+
+        class ValueContext(horizon_utils.context.OSContextGenerator):
+            def __call__(self):
+                return dict(value)
+
+        configs.register(a_conf, [ValueContext()],
+                         config_template='{{ value }}')
+        self.assertIsNotNone(configs.write(a_conf))
+        templating._flush_config_changes()
+        with configs.batch():
+            value['value'] = 'y'
+            templating.flush_context_cache()
+            self.assertIsNotNone(configs.write(a_conf))
+            value['value'] = 'x'
+            templating.flush_context_cache()
+            self.assertIsNone(configs.write(a_conf))
+        with open(a_conf) as f:
+            self.assertEqual(f.read(), 'x')
+        self.assertEqual(templating.config_changes(), [])
+        self.assertEqual(os.listdir(tmp), ['out.conf'])
+
     @patch.object(horizon_utils, 'determine_packages')
     def test_do_openstack_upgrade(self, determine_packages):
         self.test_config.set('openstack-origin', 'cloud:precise-havana')
@@ -372,11 +853,13 @@ class TestHorizonUtils(CharmTestCase):
             'cloud:precise-havana'
         )
 
+    @patch.object(horizon_utils, 'memcached_conf_managed')
     @patch('os.path.isfile')
     @patch('os.path.isdir')
-    def test_register_configs(self, _isdir, _isfile):
+    def test_register_configs(self, _isdir, _isfile, _managed):
         _isdir.return_value = True
         _isfile.return_value = True
+        _managed.return_value = False
         self.os_release.return_value = 'havana'
         configs = horizon_utils.register_configs()
         confs = [horizon_utils.LOCAL_SETTINGS,
@@ -390,15 +873,35 @@ class TestHorizonUtils(CharmTestCase):
             calls.append(
                 call(conf, horizon_utils.CONFIG_FILES[conf]['hook_contexts']))
         configs.register.assert_has_calls(calls)
+        registered = [c[0][0] for c in configs.register.call_args_list]
+        self.assertNotIn(horizon_utils.MEMCACHED_CONF, registered)
+
+    @patch.object(horizon_utils.templating, 'rendered_context')
+    @patch.object(horizon_utils.horizon_contexts, 'memcache_cluster_backend')
+    def test_memcached_conf_managed(self, _backend, _rendered_context):
+        _backend.return_value = None
+        _rendered_context.return_value = None
+        self.assertFalse(horizon_utils.memcached_conf_managed())
+        _rendered_context.assert_called_once_with(
+            horizon_utils.MEMCACHED_CONF)
+        # Rendered back to the local settings after cluster mode.
+        _rendered_context.return_value = {'context': {}}
+        self.assertTrue(horizon_utils.memcached_conf_managed())
+        _rendered_context.return_value = None
+        _backend.return_value = 'pylibmc'
+        self.assertTrue(horizon_utils.memcached_conf_managed())
 
+    @patch.object(horizon_utils, 'memcached_conf_managed')
     @patch('os.path.isdir')
-    def test_register_configs_pre_install(self, _isdir):
+    def test_register_configs_pre_install(self, _isdir, _managed):
         _isdir.return_value = False
+        _managed.return_value = True
         self.os_release.return_value = 'havana'
         configs = horizon_utils.register_configs()
         confs = [horizon_utils.LOCAL_SETTINGS,
                  horizon_utils.HAPROXY_CONF,
                  horizon_utils.PORTS_CONF,
+                 horizon_utils.MEMCACHED_CONF,
                  horizon_utils.APACHE_24_DEFAULT,
                  horizon_utils.APACHE_24_CONF,
                  horizon_utils.APACHE_24_SSL]
@@ -513,7 +1016,8 @@ class TestHorizonUtils(CharmTestCase):
 
     @patch.object(horizon_utils, 'DASHBOARD_PKG_DIR', new='/some/dir')
     @patch.object(horizon_utils, 'mkdir')
-    @patch.object(horizon_utils, 'write_file')
+    @patch.object(horizon_utils, 'file_hash')
+    @patch.object(horizon_utils, 'AtomicWriteBatch')
     @patch('os.path.exists')
     @patch('os.walk')
     @patch.object(horizon_utils.policyd, 'policyd_dir_for')
@@ -522,14 +1026,19 @@ class TestHorizonUtils(CharmTestCase):
         mock_policyd_dir_for,
         mock_os_walk,
         mock_os_path_exists,
-        mock_write_file,
+        mock_atomic_write_batch,
+        mock_file_hash,
         mock_mkdir,
     ):
+        mock_batch = (
+            mock_atomic_write_batch.return_value.__enter__.return_value)
+        mock_file_hash.return_value = None
         mock_policyd_dir_for.return_value = '/etc'
         # Note '/some/dir' below has to match the patch on DASHBOAD_PKG_DIR
         # above.
         mock_os_walk.return_value = [
-            ('/some/dir/conf', ['a-dir'], ['file1']),
+            ('/some/dir/conf', ['a-dir'],
+             ['file1', '.file1.x1y2z3.staged']),
             ('/some/dir/conf/a-dir', [], ['file2'])]
         mock_os_path_exists.return_value = False
 
@@ -541,9 +1050,14 @@ class TestHorizonUtils(CharmTestCase):
             _open.assert_has_calls([
                 call('/some/dir/conf/file1', 'r'),
                 call('/some/dir/conf/a-dir/file2', 'r')])
-            mock_write_file.assert_has_calls([
-                call('/etc/file1', 'content1', 'horizon', 'horizon'),
-                call('/etc/a-dir/file2', 'content2', 'horizon', 'horizon')])
+            mock_batch.stage.assert_has_calls([
+                call('/etc/file1', 'content1', owner='horizon',
+                     group='horizon', perms=0o444),
+                call('/etc/a-dir/file2', 'content2', owner='horizon',
+                     group='horizon', perms=0o444)])
+            mock_file_hash.assert_has_calls([
+                call('/etc/file1', hash_type='sha256'),
+                call('/etc/a-dir/file2', hash_type='sha256')])
 
     @patch.object(horizon_utils, 'POLICYD_HORIZON_SERVICE_TO_DIR',
                   new={'a': 'a-dir', 'b': 'b-dir', 'c': 'c-dir'})
@@ -575,7 +1089,8 @@ class TestHorizonUtils(CharmTestCase):
         self.assertEqual(horizon_utils.policyd_preprocess_name('b/name'),
                          "b-dir/name")
 
-    def test_assess_status(self):
+    @patch.object(horizon_utils, '_save_status_snapshot')
+    def test_assess_status(self, _save_status_snapshot):
         with patch.object(horizon_utils, 'assess_status_func') as asf:
             callee = MagicMock()
             asf.return_value = callee
@@ -585,6 +1100,73 @@ class TestHorizonUtils(CharmTestCase):
             self.os_application_version_set.assert_called_with(
                 horizon_utils.VERSION_PACKAGE
             )
+            _save_status_snapshot.assert_called_once_with()
+
+    @patch.object(horizon_utils, 'is_unit_paused_set')
+    @patch.object(horizon_utils, 'relation_snapshot')
+    def test_status_fingerprint(self, relation_snapshot, is_unit_paused_set):
+        relation_snapshot.return_value = {
+            'identity-service:1': {'keystone/0': {'service_port': '5000'}}}
+        is_unit_paused_set.return_value = False
+        fingerprint = horizon_utils.status_fingerprint()
+        relation_snapshot.assert_called_once_with('identity-service')
+        self.assertEqual(horizon_utils.status_fingerprint(), fingerprint)
+        relation_snapshot.return_value = {}
+        self.assertNotEqual(horizon_utils.status_fingerprint(), fingerprint)
+        relation_snapshot.return_value = {
+            'identity-service:1': {'keystone/0': {'service_port': '5000'}}}
+        self.test_config.set('debug', True)
+        self.assertNotEqual(horizon_utils.status_fingerprint(), fingerprint)
+
+    @patch.object(horizon_utils, 'status_set')
+    @patch.object(horizon_utils, 'ows_check_services_running')
+    @patch.object(horizon_utils, 'status_fingerprint')
+    @patch('charmhelpers.core.unitdata.kv')
+    def test_assess_status_fast(self, mock_kv, status_fingerprint,
+                                ows_check_services_running, status_set):
+        store = {}
+        mock_kv.return_value.get.side_effect = store.get
+        mock_kv.return_value.unset.side_effect = store.pop
+        status_fingerprint.return_value = 'abc'
+        # No snapshot yet.
+        self.assertFalse(horizon_utils.assess_status_fast())
+        store[horizon_utils.STATUS_SNAPSHOT_KV_KEY] = {
+            'fingerprint': 'abc', 'state': 'active',
+            'message': 'Unit is ready', 'services': ['apache2']}
+        ows_check_services_running.return_value = (None, None)
+        self.assertTrue(horizon_utils.assess_status_fast())
+        ows_check_services_running.assert_called_once_with(['apache2'], None)
+        status_set.assert_not_called()
+        # Config or relations changed.
+        status_fingerprint.return_value = 'def'
+        self.assertFalse(horizon_utils.assess_status_fast())
+        # A stopped service is reported and drops the snapshot.
+        status_fingerprint.return_value = 'abc'
+        ows_check_services_running.return_value = (
+            'blocked', 'Services not running that should be: apache2')
+        self.assertTrue(horizon_utils.assess_status_fast())
+        status_set.assert_called_once_with(
+            'blocked', 'Services not running that should be: apache2')
+        self.assertNotIn(horizon_utils.STATUS_SNAPSHOT_KV_KEY, store)
+        self.assertFalse(horizon_utils.assess_status_fast())
+
+    @patch.object(horizon_utils, 'status_fingerprint')
+    @patch.object(horizon_utils, 'services')
+    @patch.object(horizon_utils.ch_cluster, 'get_managed_services_and_ports')
+    @patch.object(horizon_utils, 'status_get')
+    @patch('charmhelpers.core.unitdata.kv')
+    def test_save_status_snapshot(self, mock_kv, status_get,
+                                  get_managed_services_and_ports, services,
+                                  status_fingerprint):
+        status_get.return_value = ('active', 'Unit is ready')
+        get_managed_services_and_ports.return_value = (['apache2'], [])
+        status_fingerprint.return_value = 'abc'
+        horizon_utils._save_status_snapshot()
+        mock_kv.return_value.set.assert_called_once_with(
+            horizon_utils.STATUS_SNAPSHOT_KV_KEY,
+            {'fingerprint': 'abc', 'state': 'active',
+             'message': 'Unit is ready', 'services': ['apache2']})
+        mock_kv.return_value.flush.assert_called_once_with()
 
     @patch.object(horizon_utils.ch_cluster, 'get_managed_services_and_ports')
     @patch.object(horizon_utils, 'REQUIRED_INTERFACES')
@@ -600,7 +1182,8 @@ class TestHorizonUtils(CharmTestCase):
         horizon_utils.assess_status_func('test-config')
         # ports=None whilst port checks are disabled.
         make_assess_status_func.assert_called_once_with(
-            'test-config', REQUIRED_INTERFACES, services=['s1'], ports=None)
+            'test-config', REQUIRED_INTERFACES, services=['s1'], ports=None,
+            ready_message=horizon_utils.horizon_contexts.wsgi_status_message)
 
     def test_pause_unit_helper(self):
         with patch.object(horizon_utils, '_pause_resume_helper') as prh:
@@ -0,0 +1,103 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import builtins
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from hooks import import_profile
+
+
+class ImportProfileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(import_profile.stop)
+        patcher = patch.object(import_profile, '_timings', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_enabled(self):
+        for value, expected in (('1', True), ('true', True), ('YES', True),
+                                ('0', False), ('', False), ('no', False)):
+            with patch.dict(os.environ,
+                            {import_profile.IMPORT_PROFILE_ENV: value}):
+                self.assertEqual(import_profile.enabled(), expected)
+
+    def test_disabled(self):
+        with patch.dict(os.environ, clear=True):
+            self.assertFalse(import_profile.enabled())
+        original = builtins.__import__
+        import_profile.stop()
+        self.assertIs(builtins.__import__, original)
+        self.assertEqual(import_profile.report(), [])
+
+    def test_start_stop(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        for name, body in (('profiled_outer', 'import profiled_inner\n'),
+                           ('profiled_inner', 'VALUE = 1\n')):
+            with open(os.path.join(tmpdir, name + '.py'), 'w') as f:
+                f.write(body)
+        sys.path.insert(0, tmpdir)
+        self.addCleanup(sys.path.remove, tmpdir)
+        for name in ('profiled_outer', 'profiled_inner'):
+            self.addCleanup(sys.modules.pop, name, None)
+
+        original = builtins.__import__
+        import_profile.start()
+        self.assertIsNot(builtins.__import__, original)
+        import profiled_outer  # noqa: F401
+        import_profile.stop()
+        self.assertIs(builtins.__import__, original)
+
+        entries = {name: (cumulative, own) for name, cumulative, own
+                   in import_profile.report(prefix='profiled_')}
+        self.assertEqual(sorted(entries), ['profiled_inner', 'profiled_outer'])
+        outer_cumulative, outer_own = entries['profiled_outer']
+        inner_cumulative, inner_own = entries['profiled_inner']
+        # The nested import counts towards the cumulative time of its parent
+        self.assertGreaterEqual(outer_cumulative, inner_cumulative)
+        self.assertAlmostEqual(outer_own, outer_cumulative - inner_cumulative,
+                               places=6)
+
+    def test_report(self):
+        import_profile._timings.update({
+            'charmhelpers.core.hookenv': [0.004, 0.003],
+            'charmhelpers.fetch': [0.020, 0.001],
+            'charmhelpers.contrib.openstack.utils': [0.050, 0.010],
+            'yaml': [0.1, 0.1],
+        })
+        self.assertEqual(import_profile.report(limit=2), [
+            ('charmhelpers.contrib.openstack.utils', 50.0, 10.0),
+            ('charmhelpers.core.hookenv', 4.0, 3.0),
+        ])
+        self.assertEqual(
+            [name for name, _, _ in import_profile.report()],
+            ['charmhelpers.contrib.openstack.utils',
+             'charmhelpers.core.hookenv', 'charmhelpers.fetch'])
+
+    def test_format_report(self):
+        self.assertEqual(
+            import_profile.format_report([
+                ('charmhelpers.contrib.openstack.utils', 50.0, 10.0),
+                ('charmhelpers.fetch', 12.54, 2.5)]),
+            'Import profile (self/cumulative ms): '
+            'charmhelpers.contrib.openstack.utils 10.0/50.0, '
+            'charmhelpers.fetch 2.5/12.5')
+        self.assertEqual(import_profile.format_report([]),
+                         'Import profile (self/cumulative ms): ')
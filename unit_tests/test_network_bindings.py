@@ -0,0 +1,120 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import subprocess
+import unittest
+from unittest.mock import patch
+
+from charmhelpers.core import hookenv
+
+import hooks.network_bindings as network_bindings
+
+CLUSTER = {
+    'bind-addresses': [{
+        'interface-name': 'eth0',
+        'addresses': [{'address': '10.0.0.5', 'cidr': '10.0.0.0/24'},
+                      {'value': '10.0.0.6', 'cidr': '10.0.0.0/24'}],
+    }],
+}
+
+
+class NetworkBindingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patchers = [
+            patch.dict(hookenv.cache, clear=True),
+            patch.object(network_bindings, 'network_get'),
+            patch.object(network_bindings, 'network_get_primary_address',
+                         return_value='10.0.0.9'),
+            patch.object(network_bindings, 'config', return_value=None),
+            patch.object(network_bindings, 'unit_get',
+                         return_value='10.0.0.1'),
+            patch.object(network_bindings, 'get_host_ip',
+                         side_effect=lambda address: address),
+            patch.object(network_bindings, 'log'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.network_get = network_bindings.network_get
+        self.primary_address = network_bindings.network_get_primary_address
+
+    def _unbound(self):
+        return subprocess.CalledProcessError(
+            1, ['network-get'],
+            output=b'no network config found for binding "cluster"')
+
+    def test_queried_once(self):
+        self.network_get.return_value = CLUSTER
+        binding = network_bindings.network_binding('cluster')
+        self.assertEqual(binding.addresses, [('10.0.0.5', '10.0.0.0/24'),
+                                             ('10.0.0.6', '10.0.0.0/24')])
+        for _ in range(3):
+            self.assertEqual(network_bindings.get_relation_ip('cluster'),
+                             '10.0.0.5')
+        self.network_get.assert_called_once_with('cluster')
+        self.primary_address.assert_not_called()
+
+    def test_no_addresses(self):
+        self.network_get.return_value = {'bind-addresses': []}
+        with self.assertRaises(hookenv.NoNetworkBinding):
+            network_bindings.network_binding('cluster').primary_address
+
+    def test_unsupported_cached(self):
+        self.network_get.side_effect = NotImplementedError
+        for _ in range(2):
+            self.assertRaises(NotImplementedError,
+                              network_bindings.network_binding, 'cluster')
+            self.assertEqual(network_bindings.primary_address('cluster'),
+                             '10.0.0.9')
+        self.network_get.assert_called_once_with('cluster')
+        self.assertEqual(self.primary_address.call_count, 2)
+
+    def test_no_network_get_cached(self):
+        self.network_get.side_effect = OSError(2, 'No such file')
+        self.assertRaises(NotImplementedError,
+                          network_bindings.network_binding, 'cluster')
+        self.assertRaises(NotImplementedError,
+                          network_bindings.network_binding, 'cluster')
+        self.network_get.assert_called_once_with('cluster')
+
+    def test_unbound_not_cached(self):
+        self.network_get.side_effect = [self._unbound(), CLUSTER]
+        self.assertEqual(network_bindings.get_relation_ip('cluster'),
+                         '10.0.0.1')
+        network_bindings.log.assert_called_once_with(
+            'No network binding for cluster', network_bindings.WARNING)
+        self.assertEqual(network_bindings.get_relation_ip('cluster'),
+                         '10.0.0.5')
+        self.assertEqual(self.network_get.call_count, 2)
+
+    def test_failure_not_cached(self):
+        self.network_get.side_effect = [
+            subprocess.CalledProcessError(1, ['network-get'], output=b'busy'),
+            CLUSTER]
+        self.assertRaises(subprocess.CalledProcessError,
+                          network_bindings.network_binding, 'cluster')
+        self.assertEqual(
+            network_bindings.network_binding('cluster').primary_address,
+            '10.0.0.5')
+
+    def test_get_relation_ip_cidr_network(self):
+        self.network_get.return_value = CLUSTER
+        with patch.object(network_bindings, 'get_address_in_network',
+                          return_value='192.168.1.5') as in_network:
+            self.assertEqual(
+                network_bindings.get_relation_ip('shared-db',
+                                                 '192.168.1.0/24'),
+                '192.168.1.5')
+        in_network.assert_called_once_with('192.168.1.0/24', '10.0.0.5')
@@ -0,0 +1,153 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import subprocess
+import unittest
+from unittest.mock import MagicMock, patch
+
+from charmhelpers.core import host
+
+import hooks.packages as packages
+
+DPKG_QUERY_OUTPUT = """\
+apache2\t2.4.52-1ubuntu4.6\tinstall ok installed
+haproxy\t2.4.22-0ubuntu0.22.04.2\thold ok installed
+memcached\t1.6.14-1\tdeinstall ok config-files
+openstack-dashboard\t4:23.0.0-0ubuntu1\tinstall ok installed
+garbage line
+"""
+
+APT_CACHE_OUTPUT = """\
+Package: memcached
+Architecture: amd64
+Version: 1.6.14-1
+
+Package: python3-brotli
+Architecture: amd64
+Version: 1.0.9-2build6
+
+"""
+
+
+class PackageIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        packages.invalidate_package_index()
+        self.addCleanup(packages.invalidate_package_index)
+        patcher = patch.object(packages.subprocess, 'check_output',
+                               return_value=DPKG_QUERY_OUTPUT)
+        self.check_output = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(
+            packages.subprocess, 'run',
+            return_value=MagicMock(stdout=APT_CACHE_OUTPUT, returncode=100))
+        self.run = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(packages, 'get_apt_dpkg_env', return_value={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(packages, 'log')
+        self.log = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_installed(self):
+        self.assertEqual(packages.package_index().installed, {
+            'apache2': '2.4.52-1ubuntu4.6',
+            'haproxy': '2.4.22-0ubuntu0.22.04.2',
+            'openstack-dashboard': '4:23.0.0-0ubuntu1',
+        })
+        packages.package_index().installed
+        self.check_output.assert_called_once_with(
+            ['dpkg-query', '-W', '-f=${Package}\t${Version}\t${Status}\n'],
+            stderr=subprocess.DEVNULL, universal_newlines=True)
+
+    def test_available(self):
+        index = packages.package_index()
+        self.assertEqual(
+            index.available(['memcached', 'python3-brotli', 'unknown']),
+            {'memcached', 'python3-brotli'})
+        self.run.assert_called_once_with(
+            ['apt-cache', 'show', '--no-all-versions', 'memcached',
+             'python3-brotli', 'unknown'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True, env={})
+        # Only packages not asked about before are looked up
+        self.assertEqual(index.available(['memcached']), {'memcached'})
+        self.assertEqual(index.available(['unknown']), set())
+        self.run.assert_called_once()
+
+    def test_filter_installed_packages(self):
+        self.assertEqual(
+            packages.filter_installed_packages(
+                ['apache2', 'memcached', 'python3-brotli', 'unknown']),
+            ['memcached', 'python3-brotli', 'unknown'])
+        self.check_output.assert_called_once()
+        self.run.assert_called_once()
+        self.log.assert_called_once_with(
+            'Package unknown has no installation candidate.',
+            level=packages.WARNING)
+
+    def test_filter_installed_packages_all_installed(self):
+        self.assertEqual(
+            packages.filter_installed_packages(['apache2', 'haproxy']), [])
+        self.run.assert_not_called()
+
+    def test_filter_missing_packages(self):
+        self.assertEqual(
+            packages.filter_missing_packages(
+                ['apache2', 'memcached', 'haproxy']),
+            ['apache2', 'haproxy'])
+
+    def test_get_installed_version(self):
+        version = packages.get_installed_version('openstack-dashboard')
+        self.assertEqual(version.ver_str, '4:23.0.0-0ubuntu1')
+        self.assertIsNone(packages.get_installed_version('memcached'))
+
+    def test_get_upstream_version(self):
+        self.assertEqual(
+            packages.get_upstream_version('openstack-dashboard'), '23.0.0')
+        self.assertIsNone(packages.get_upstream_version('unknown'))
+
+    def _assert_invalidates(self, apt_command, *args, **kwargs):
+        packages.package_index().installed
+        host._service_probes['apache2'] = True
+        self.addCleanup(host.flush_service_probes)
+        with patch('charmhelpers.fetch.ubuntu._run_apt_command') as _run:
+            apt_command(*args, **kwargs)
+        _run.assert_called_once()
+        packages.package_index().installed
+        self.assertEqual(self.check_output.call_count, 2)
+        # Maintainer scripts may have started or stopped services
+        self.assertEqual(host._service_probes, {})
+
+    def test_apt_install_invalidates(self):
+        self._assert_invalidates(packages.apt_install, ['memcached'],
+                                 fatal=True)
+
+    def test_apt_upgrade_invalidates(self):
+        self._assert_invalidates(packages.apt_upgrade, options=[],
+                                 fatal=True, dist=True)
+
+    def test_apt_purge_invalidates(self):
+        self._assert_invalidates(packages.apt_purge, ['memcached'],
+                                 fatal=True)
+
+    def test_invalidates_on_failure(self):
+        packages.package_index()
+        with patch('charmhelpers.fetch.ubuntu._run_apt_command',
+                   side_effect=subprocess.CalledProcessError(100, 'apt')):
+            self.assertRaises(subprocess.CalledProcessError,
+                              packages.apt_install, ['memcached'],
+                              fatal=True)
+        self.assertIsNone(packages._package_index)
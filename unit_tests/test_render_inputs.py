@@ -0,0 +1,191 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from charmhelpers.contrib.openstack import context, templating
+from charmhelpers.core import hookenv, unitdata
+
+import hooks.horizon_utils as horizon_utils
+import hooks.render_inputs as render_inputs
+
+
+class OptionContext(context.OSContextGenerator):
+    inputs = {'config': ['opt']}
+
+    def __call__(self):
+        return {'value': hookenv.config('opt')}
+
+
+class TemplateInputsTestCase(unittest.TestCase):
+
+    def test_merged(self):
+        class PeerContext(context.OSContextGenerator):
+            inputs = {'relations': ['cluster'], 'files': ['/etc/ssl'],
+                      'state': [lambda: 'x']}
+
+        inputs = render_inputs.template_inputs(
+            [OptionContext(), PeerContext(), context.SyslogContext()])
+        self.assertEqual(inputs['config'], ['opt', 'use-syslog'])
+        self.assertEqual(inputs['relations'], ['cluster'])
+        self.assertEqual(inputs['files'], ['/etc/ssl'])
+        self.assertEqual(len(inputs['state']), 1)
+
+    def test_any_config(self):
+        class AnyContext(context.OSContextGenerator):
+            inputs = {'config': render_inputs.ANY}
+
+        inputs = render_inputs.template_inputs(
+            [OptionContext(), AnyContext(), OptionContext()])
+        self.assertEqual(inputs['config'], render_inputs.ANY)
+
+    def test_undeclared(self):
+        self.assertIsNone(render_inputs.template_inputs(
+            [OptionContext(), context.SharedDBContext()]))
+
+
+class WriteAffectedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        templates = os.path.join(self.tmp, 'templates')
+        os.mkdir(templates)
+        for name in ('a.conf', 'b.conf', 'c.conf'):
+            with open(os.path.join(templates, name), 'w') as f:
+                f.write('{{ value }}')
+        self.ssl_dir = os.path.join(self.tmp, 'ssl')
+        os.mkdir(self.ssl_dir)
+        self.state = {'peers': 1, 'address': '10.0.0.1'}
+        state = self.state
+
+        class PeerContext(context.OSContextGenerator):
+            inputs = {'relations': ['cluster'], 'files': [self.ssl_dir],
+                      'state': [lambda: state['address']]}
+
+            def __call__(self):
+                return {'value': '{peers} {address}'.format(**state)}
+
+        class UndeclaredContext(context.OSContextGenerator):
+            def __call__(self):
+                return {'value': 'anything'}
+
+        self.previous = {'opt': 'x'}
+        self.current = {'opt': 'x'}
+        patchers = [
+            patch.object(render_inputs, 'config', side_effect=self._config),
+            patch.object(hookenv, 'config',
+                         side_effect=lambda k: self.current[k]),
+            patch.object(unitdata, 'kv',
+                         return_value=unitdata.Storage(':memory:')),
+            patch.object(horizon_utils, 'relation_type', return_value=None),
+            patch.object(horizon_utils, 'log'),
+            patch.object(templating, 'atexit'),
+            patch.object(templating, 'log'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(templating.flush_context_cache)
+        self.configs = horizon_utils.HorizonOSConfigRenderer(
+            templates_dir=templates, openstack_release='yoga')
+        self.a_conf = os.path.join(self.tmp, 'a.conf')
+        self.b_conf = os.path.join(self.tmp, 'b.conf')
+        self.c_conf = os.path.join(self.tmp, 'c.conf')
+        self.configs.register(self.a_conf, [OptionContext()])
+        self.configs.register(self.b_conf, [PeerContext()])
+        self.configs.register(self.c_conf, [UndeclaredContext()])
+
+    def _config(self):
+        path = os.path.join(self.tmp, 'previous.json')
+        with open(path, 'w') as f:
+            json.dump(self.previous, f)
+        with patch.dict(os.environ, {'CHARM_DIR': self.tmp}):
+            cfg = hookenv.Config(self.current)
+            cfg.load_previous(path)
+        return cfg
+
+    def _affected(self, relations=()):
+        return [f for f in (self.a_conf, self.b_conf, self.c_conf)
+                if render_inputs.is_affected(
+                    f, self.configs.templates[f].contexts, 'yoga',
+                    relations)]
+
+    def _write_affected(self, **kwargs):
+        templating.flush_context_cache()
+        self.configs.write_affected(**kwargs)
+        with open(self.b_conf) as f:
+            return f.read()
+
+    def test_nothing_recorded(self):
+        self.assertEqual(self._affected(),
+                         [self.a_conf, self.b_conf, self.c_conf])
+        self._write_affected()
+        self.assertIsNotNone(render_inputs.recorded_inputs(self.a_conf))
+        # Files with undeclared inputs are not recorded
+        self.assertIsNone(render_inputs.recorded_inputs(self.c_conf))
+
+    def test_unrelated_changes(self):
+        self._write_affected()
+        self.current['other'] = 'y'
+        self.assertEqual(self._affected(['ha']), [self.c_conf])
+
+    def test_config_changed(self):
+        self._write_affected()
+        self.current['opt'] = 'y'
+        self.assertEqual(self._affected(), [self.a_conf, self.c_conf])
+
+    def test_first_hook(self):
+        self._write_affected()
+        self.previous = None
+        with patch.object(hookenv.Config, 'load_previous'):
+            self.assertIn(self.a_conf, self._affected())
+
+    def test_relation_changed(self):
+        self._write_affected()
+        self.assertEqual(self._affected(['cluster']),
+                         [self.b_conf, self.c_conf])
+        self.state['peers'] = 2
+        with patch.object(horizon_utils, 'relation_type',
+                          return_value='cluster'):
+            self.assertEqual(self._write_affected(), '2 10.0.0.1')
+
+    def test_state_changed(self):
+        self._write_affected()
+        self.state['address'] = '10.0.0.2'
+        self.assertEqual(self._affected(), [self.b_conf, self.c_conf])
+        self.assertEqual(self._write_affected(), '1 10.0.0.2')
+        self.assertEqual(self._affected(), [self.c_conf])
+
+    def test_input_files_changed(self):
+        self._write_affected()
+        with open(os.path.join(self.ssl_dir, 'cert'), 'w') as f:
+            f.write('cert')
+        self.assertEqual(self._affected(), [self.b_conf, self.c_conf])
+
+    def test_release_changed(self):
+        self._write_affected()
+        self.assertTrue(render_inputs.is_affected(
+            self.a_conf, self.configs.templates[self.a_conf].contexts,
+            'zed'))
+
+    def test_removed_from_disk(self):
+        self._write_affected()
+        os.remove(self.a_conf)
+        self.assertEqual(self._affected(), [self.a_conf, self.c_conf])
@@ -0,0 +1,125 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import subprocess
+import unittest
+from unittest.mock import MagicMock, mock_open, patch
+
+import charmhelpers.contrib.network.ip as ip
+import charmhelpers.core.host as host
+
+PROC_NET_TCP = """\
+  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt
+   0: 00000000:0050 00000000:0000 0A 00000000:00000000 00:00000000 00000000
+   1: 0100007F:2BCB 00000000:0000 0A 00000000:00000000 00:00000000 00000000
+   2: 0A00000B:0016 00000000:0000 0A 00000000:00000000 00:00000000 00000000
+   3: 0100007F:01BB 0100007F:D2F0 01 00000000:00000000 00:00000000 00000000
+"""
+
+PROC_NET_TCP6 = """\
+  sl  local_address                         remote_address                        st
+   0: 00000000000000000000000000000000:01BB 00000000000000000000000000000000:0000 0A
+   1: 0000000000000000FFFF00000100007F:22B8 00000000000000000000000000000000:0000 0A
+   2: 000080FE00000000FF0C29FFFE4D3A2B:1F90 00000000000000000000000000000000:0000 0A
+   3: 00000000000000000000000000000000:0CEA 00000000000000000000000000000000:0000 06
+"""  # noqa: E501
+
+
+class ServicesRunningTestCase(unittest.TestCase):
+
+    def setUp(self):
+        host.flush_service_probes()
+        self.addCleanup(host.flush_service_probes)
+        patcher = patch.object(host, 'init_is_systemd', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(host, 'log')
+        self.log = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(host.subprocess, 'Popen')
+        self.popen = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.returncodes = {}
+        self.procs = {}
+        self.popen.side_effect = self._popen
+
+    def _popen(self, cmd, **kwargs):
+        proc = self.procs[cmd[-1]] = MagicMock()
+        returncode = self.returncodes[cmd[-1]]
+        if returncode is None:
+            proc.wait.side_effect = [
+                subprocess.TimeoutExpired(cmd, 1), -9]
+        else:
+            proc.wait.return_value = returncode
+        return proc
+
+    def test_services_running(self):
+        self.returncodes.update({'apache2': 0, 'haproxy': 3})
+        self.assertEqual(host.services_running(['apache2', 'haproxy']),
+                         {'apache2': True, 'haproxy': False})
+        self.popen.assert_any_call(
+            ['systemctl', 'is-active', '--quiet', 'apache2'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def test_services_running_timeout(self):
+        self.returncodes.update({'apache2': 0, 'memcached': None})
+        with patch.object(host.time, 'monotonic', side_effect=[0, 5, 40]):
+            self.assertEqual(
+                host.services_running(['apache2', 'memcached'], timeout=30),
+                {'apache2': True, 'memcached': False})
+        # Both probes share the deadline; the stuck one is killed
+        self.procs['apache2'].wait.assert_called_once_with(timeout=25)
+        self.procs['memcached'].wait.assert_called_with()
+        self.procs['memcached'].kill.assert_called_once_with()
+        self.log.assert_called_once_with(
+            'Timed out checking whether memcached is running',
+            level=host.WARNING)
+
+    def test_services_running_cached(self):
+        self.returncodes.update({'apache2': 0})
+        host.services_running(['apache2'])
+        host.services_running(['apache2'])
+        self.assertEqual(self.popen.call_count, 1)
+        # Querying a service leaves the probes alone, changing one drops them
+        with patch.object(host.subprocess, 'call', return_value=0):
+            host.service('is-active', 'apache2')
+            host.services_running(['apache2'])
+            self.assertEqual(self.popen.call_count, 1)
+            host.service('restart', 'apache2')
+        host.services_running(['apache2'])
+        self.assertEqual(self.popen.call_count, 2)
+
+
+class ListeningPortsTestCase(unittest.TestCase):
+
+    def _open(self, files):
+        def _open(path):
+            if path not in files:
+                raise IOError(2, 'No such file or directory', path)
+            return mock_open(read_data=files[path])()
+        return patch('builtins.open', side_effect=_open)
+
+    def test_listening_ports(self):
+        with self._open({'/proc/net/tcp': PROC_NET_TCP,
+                         '/proc/net/tcp6': PROC_NET_TCP6}):
+            # Wildcard and loopback listeners only, in the LISTEN state
+            self.assertEqual(ip.listening_ports(), {80, 11211, 443, 8888})
+
+    def test_listening_ports_ipv4_only(self):
+        with self._open({'/proc/net/tcp': PROC_NET_TCP}):
+            self.assertEqual(ip.listening_ports(), {80, 11211})
+
+    def test_listening_ports_unavailable(self):
+        with self._open({}):
+            self.assertIsNone(ip.listening_ports())
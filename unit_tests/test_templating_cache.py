@@ -0,0 +1,124 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import charmhelpers.contrib.openstack.templating as templating
+
+
+class LoaderCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.templates_dir = os.path.join(self.tmpdir, 'templates')
+        os.makedirs(os.path.join(self.templates_dir, 'rocky'))
+        charm_dir = os.path.join(self.tmpdir, 'charm')
+        os.mkdir(charm_dir)
+        self.cache_file = os.path.join(
+            charm_dir, templating.TEMPLATE_CACHE_DIR,
+            templating._LOADER_PATHS_FILE)
+        patchers = [
+            patch.dict(os.environ, {'CHARM_DIR': charm_dir}),
+            patch.dict(templating._loaders, clear=True),
+            patch.dict(templating._tmpl_envs, clear=True),
+            patch.object(templating, 'log'),
+            patch.object(templating, '_search_path',
+                         wraps=templating._search_path),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self._search_path = templating._search_path
+
+    def _new_hook(self):
+        templating._loaders.clear()
+        templating._tmpl_envs.clear()
+
+    def _searchpath(self, loader):
+        return [d for fs in loader.loaders for d in fs.searchpath]
+
+    def test_memoised_for_the_hook(self):
+        loader = templating.get_loader(self.templates_dir, 'zed')
+        self.assertIs(templating.get_loader(self.templates_dir, 'zed'),
+                      loader)
+        self._search_path.assert_called_once_with(self.templates_dir, 'zed')
+
+    def test_hit(self):
+        loader = templating.get_loader(self.templates_dir, 'zed')
+        self._new_hook()
+        cached = templating.get_loader(self.templates_dir, 'zed')
+        self.assertIsNot(cached, loader)
+        self.assertEqual(self._searchpath(cached), self._searchpath(loader))
+        self._search_path.assert_called_once_with(self.templates_dir, 'zed')
+
+    def test_release_change(self):
+        templating.get_loader(self.templates_dir, 'queens')
+        self._new_hook()
+        loader = templating.get_loader(self.templates_dir, 'zed')
+        self.assertEqual(self._search_path.call_count, 2)
+        self.assertEqual(self._searchpath(loader)[0],
+                         os.path.join(self.templates_dir, 'rocky'))
+        # The entry of the release upgraded from is replaced
+        with open(self.cache_file) as f:
+            entry = json.load(f)[self.templates_dir]
+        self.assertEqual(entry['release'], 'zed')
+
+    def test_template_dir_added(self):
+        templating.get_loader(self.templates_dir, 'zed')
+        self._new_hook()
+        os.mkdir(os.path.join(self.templates_dir, 'zed'))
+        # Filesystem timestamps may be coarser than the test
+        os.utime(self.templates_dir, ns=(0, 0))
+        loader = templating.get_loader(self.templates_dir, 'zed')
+        self.assertEqual(self._search_path.call_count, 2)
+        self.assertEqual(self._searchpath(loader)[:2], [
+            os.path.join(self.templates_dir, 'zed'),
+            os.path.join(self.templates_dir, 'rocky')])
+
+    def test_helper_templates_changed(self):
+        templating.get_loader(self.templates_dir, 'zed')
+        self._new_hook()
+        state = templating._search_path_state(self.templates_dir)
+        state[os.path.dirname(templating.__file__)] += 1
+        with patch.object(templating, '_search_path_state',
+                          return_value=state):
+            templating.get_loader(self.templates_dir, 'zed')
+        self.assertEqual(self._search_path.call_count, 2)
+
+    def test_no_charm_dir(self):
+        with patch.dict(os.environ, clear=True):
+            templating.get_loader(self.templates_dir, 'zed')
+        self.assertFalse(os.path.exists(self.cache_file))
+
+    def test_missing_templates_dir(self):
+        self.assertRaises(templating.OSConfigException,
+                          templating.get_loader,
+                          os.path.join(self.tmpdir, 'missing'), 'zed')
+
+
+class BytecodeCacheTestCase(unittest.TestCase):
+
+    def test_keyed_on_release(self):
+        queens = templating._BytecodeCache('/tmp', 'queens')
+        zed = templating._BytecodeCache('/tmp', 'zed')
+        self.assertEqual(queens.get_cache_key('haproxy.cfg'),
+                         queens.get_cache_key('haproxy.cfg'))
+        self.assertNotEqual(queens.get_cache_key('haproxy.cfg'),
+                            zed.get_cache_key('haproxy.cfg'))
@@ -0,0 +1,169 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from charmhelpers.contrib.openstack import templating
+from charmhelpers.core import host
+
+import hooks.tracing as tracing
+
+
+class TracingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, tracing.PROFILE_FILE)
+        patcher = patch.dict(os.environ, {'CHARM_DIR': self.tmpdir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.environ.pop(tracing.TRACE_ENV, None)
+        # Never leave a trace, and its patches, behind a failed test
+        self.addCleanup(tracing.finish, path=self.path)
+
+    def test_disabled(self):
+        call = subprocess.call
+        with tracing.trace_hook('config-changed'):
+            self.assertFalse(tracing.active())
+            self.assertIs(subprocess.call, call)
+            with tracing.span('noop'):
+                pass
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_enabled_from_environment(self):
+        with patch.dict(os.environ, {tracing.TRACE_ENV: 'true'}):
+            self.assertTrue(tracing.start('config-changed'))
+        self.assertTrue(tracing.active())
+        self.assertEqual(tracing.finish()['hook'], 'config-changed')
+        self.assertEqual(len(tracing.load_profiles()), 1)
+
+    def test_span_tree(self):
+        with tracing.trace_hook('config-changed', enable=True):
+            with tracing.span('outer', 'detail'):
+                with tracing.span('inner'):
+                    pass
+                with tracing.span('inner'):
+                    pass
+            with tracing.span('sibling'):
+                pass
+        record = tracing.load_profiles(self.path)[0]
+        self.assertEqual(
+            [(s['name'], s['depth']) for s in record['spans']],
+            [('hook:config-changed', 0), ('outer', 1), ('inner', 2),
+             ('inner', 2), ('sibling', 1)])
+        self.assertEqual(record['spans'][1]['detail'], 'detail')
+        for entry in record['spans']:
+            self.assertGreaterEqual(entry['duration'], 0.0)
+        summary = {name: calls
+                   for name, calls, total, own in tracing.summarize(record)}
+        self.assertEqual(summary['inner'], 2)
+        tree = tracing.format_profile(record, min_ms=0.0).splitlines()
+        self.assertTrue(tree[0].startswith('config-changed at '))
+        self.assertTrue(tree[2].endswith('    outer  [detail]'))
+        self.assertTrue(tree[3].endswith('      inner'))
+
+    def test_summarize_self_time(self):
+        record = {'hook': 'config-changed', 'started': 0, 'duration': 10.0,
+                  'spans': [
+                      {'name': 'render', 'depth': 0, 'duration': 10.0},
+                      {'name': 'context:A', 'depth': 1, 'duration': 4.0},
+                      {'name': 'exec:hostname', 'depth': 2,
+                       'duration': 3.0},
+                      {'name': 'context:B', 'depth': 1, 'duration': 2.0},
+                  ]}
+        self.assertEqual(tracing.summarize(record), [
+            ('render', 1, 10.0, 4.0),
+            ('exec:hostname', 1, 3.0, 3.0),
+            ('context:B', 1, 2.0, 2.0),
+            ('context:A', 1, 4.0, 1.0),
+        ])
+        self.assertEqual(
+            tracing.format_profile(record, min_ms=2.5).count('\n'), 3)
+
+    def test_subprocess_patched_while_traced(self):
+        originals = {attr: getattr(subprocess, attr)
+                     for attr in tracing._TRACED_SUBPROCESS}
+        with tracing.trace_hook('config-changed', enable=True):
+            for attr, func in originals.items():
+                self.assertIsNot(getattr(subprocess, attr), func)
+            # check_output() runs run(): only the outer call is recorded
+            subprocess.check_output([sys.executable, '-c', 'pass'])
+            subprocess.call('true', shell=True)
+        for attr, func in originals.items():
+            self.assertIs(getattr(subprocess, attr), func)
+        spans = tracing.load_profiles(self.path)[0]['spans']
+        self.assertEqual(
+            [(s['name'], s.get('detail')) for s in spans[1:]],
+            [('exec:{}'.format(os.path.basename(sys.executable)),
+              '{} -c pass'.format(sys.executable)),
+             ('exec:true', 'true')])
+
+    def test_charmhelpers_patched_while_traced(self):
+        service = host.service
+        evaluate = templating._evaluate
+        with tracing.trace_hook('config-changed', enable=True):
+            self.assertIsNot(host.service, service)
+            with patch.object(host, 'init_is_systemd', return_value=True), \
+                    patch.object(host.subprocess, 'call', return_value=0):
+                host.service_restart('apache2')
+            self.assertEqual(templating._evaluate(lambda: {'a': 1}),
+                             {'a': 1})
+        self.assertIs(host.service, service)
+        self.assertIs(templating._evaluate, evaluate)
+        spans = tracing.load_profiles(self.path)[0]['spans']
+        self.assertEqual(
+            [(s['name'], s.get('detail')) for s in spans[1:]],
+            [('service:restart', 'apache2'), ('context:function', None)])
+
+    def test_unpatched_after_failure(self):
+        call = subprocess.call
+        with self.assertRaises(ValueError):
+            with tracing.trace_hook('config-changed', enable=True):
+                raise ValueError()
+        self.assertFalse(tracing.active())
+        self.assertIs(subprocess.call, call)
+        self.assertEqual(len(tracing.load_profiles(self.path)), 1)
+
+    def test_keep(self):
+        for i in range(4):
+            with tracing.trace_hook('hook-{}'.format(i), enable=True,
+                                    keep=3):
+                pass
+        self.assertEqual(
+            [p['hook'] for p in tracing.load_profiles(self.path)],
+            ['hook-1', 'hook-2', 'hook-3'])
+        # Lowering keep trims the older profiles
+        with tracing.trace_hook('hook-4', enable=True, keep=1):
+            pass
+        self.assertEqual(
+            [p['hook'] for p in tracing.load_profiles(self.path)],
+            ['hook-4'])
+        self.assertEqual(os.listdir(self.tmpdir), [tracing.PROFILE_FILE])
+
+    def test_corrupt_profiles_replaced(self):
+        with open(self.path, 'w') as f:
+            f.write('{not json')
+        self.assertEqual(tracing.load_profiles(), [])
+        with tracing.trace_hook('config-changed', enable=True):
+            pass
+        with open(self.path) as f:
+            self.assertEqual(len(json.load(f)), 1)
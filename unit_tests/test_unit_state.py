@@ -0,0 +1,230 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import MagicMock, call, patch
+
+from charmhelpers.core import unitdata
+
+import hooks.unit_state as unit_state
+
+
+class UnitStateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, '.unit-state.db')
+        self.db = unitdata.Storage(self.path)
+        self.addCleanup(self.db.close)
+
+    def _hooks(self, count, keys=('a',)):
+        for i in range(count):
+            with self.db.hook_scope('update-status'):
+                for key in keys:
+                    self.db.set(key, i)
+
+    def _count(self, table):
+        self.db.cursor.execute('select count(*) from %s' % table)
+        return self.db.cursor.fetchone()[0]
+
+    def _pragma(self, name):
+        # Read through another connection, as the next hook would.
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute('pragma %s' % name).fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_prune_revisions(self):
+        self._hooks(5, keys=('a', 'b'))
+        self.assertEqual(unit_state.prune(self.db, keep_revisions=2),
+                         (6, 0))
+        self.db.cursor.execute(
+            'select key, revision from kv_revisions order by key, revision')
+        self.assertEqual(self.db.cursor.fetchall(),
+                         [('a', 4), ('a', 5), ('b', 4), ('b', 5)])
+        self.assertEqual(self.db.get('a'), 4)
+
+    def test_prune_hooks(self):
+        self._hooks(3, keys=('a',))
+        # b was last written by the oldest hook, which is dropped with it
+        with self.db.hook_scope('install'):
+            self.db.set('b', 'x')
+        self._hooks(3, keys=('a',))
+        self.assertEqual(unit_state.prune(self.db, keep_hooks=3), (4, 4))
+        self.db.cursor.execute('select version from hooks order by version')
+        self.assertEqual(self.db.cursor.fetchall(), [(5,), (6,), (7,)])
+        self.db.cursor.execute(
+            'select key, revision from kv_revisions order by revision')
+        self.assertEqual(self.db.cursor.fetchall(),
+                         [('a', 5), ('a', 6), ('a', 7)])
+        self.assertEqual(self.db.get('b'), 'x')
+
+    def test_prune_bounded(self):
+        with patch.multiple(unit_state, KEEP_REVISIONS=3, KEEP_HOOKS=4):
+            for _ in range(3):
+                self._hooks(5, keys=('a', 'b'))
+                unit_state.maintain(self.db)
+                self.assertEqual(self._count('hooks'), 4)
+                self.assertEqual(self._count('kv_revisions'), 6)
+
+    def test_maintain_in_hook_scope(self):
+        self._hooks(12)
+        with self.db.hook_scope('update-status'):
+            self.assertEqual(unit_state.maintain(self.db), (0, 0, False))
+        self.assertEqual(unit_state.maintain(self.db), (2, 0, False))
+
+    def test_compact_switches_to_incremental(self):
+        # unitdata creates databases without auto-vacuum
+        self.assertEqual(self._pragma('auto_vacuum'), 0)
+        self.db.set('big', 'x' * 100000)
+        self.db.flush()
+        self.db.unset('big')
+        self.db.flush()
+        pages = self._pragma('page_count')
+        self.assertTrue(unit_state.compact(self.db, force=True))
+        self.assertEqual(self._pragma('auto_vacuum'), 2)
+        self.assertEqual(self._pragma('freelist_count'), 0)
+        self.assertLess(self._pragma('page_count'), pages)
+        # Later compactions are incremental
+        self.db.set('big', 'x' * 100000)
+        self.db.flush()
+        self.db.unset('big')
+        self.db.flush()
+        self.assertGreater(self._pragma('freelist_count'), 0)
+        with patch.object(self.db, 'cursor',
+                          MagicMock(wraps=self.db.cursor)) as cursor:
+            self.assertTrue(unit_state.compact(self.db, force=True))
+        cursor.executescript.assert_called_once_with(
+            'pragma incremental_vacuum;')
+        self.assertNotIn(call('vacuum'), cursor.execute.call_args_list)
+        self.assertEqual(self._pragma('freelist_count'), 0)
+        self.assertEqual(self.db.get('big'), None)
+
+    def test_compact_threshold(self):
+        self.db.set('big', 'x' * 100000)
+        self.db.flush()
+        self.db.unset('big')
+        self.db.flush()
+        free = self._pragma('freelist_count')
+        pages = self._pragma('page_count')
+        page_size = self._pragma('page_size')
+        self.assertGreater(free, pages * unit_state.COMPACT_FREE_RATIO)
+        # Too few free bytes
+        with patch.object(unit_state, 'COMPACT_MIN_FREE',
+                          free * page_size + 1):
+            self.assertFalse(unit_state.compact(self.db))
+        # Too small a share of the file
+        with patch.multiple(unit_state, COMPACT_MIN_FREE=page_size,
+                            COMPACT_FREE_RATIO=1.0):
+            self.assertFalse(unit_state.compact(self.db))
+        self.assertEqual(self._pragma('freelist_count'), free)
+        with patch.object(unit_state, 'COMPACT_MIN_FREE', page_size):
+            self.assertTrue(unit_state.compact(self.db))
+        self.assertEqual(self._pragma('freelist_count'), 0)
+
+    def test_stats(self):
+        self._hooks(2, keys=('a', 'b'))
+        self.db.flush()
+        stats = unit_state.stats(self.db)
+        self.assertEqual(stats['path'], self.path)
+        self.assertEqual(stats['file-size'], sum(
+            os.path.getsize(p) for p in (self.path, self.path + '-wal')
+            if os.path.exists(p)))
+        self.assertEqual(stats['tables']['kv']['rows'], 2)
+        self.assertEqual(stats['tables']['kv_revisions']['rows'], 4)
+        self.assertEqual(stats['tables']['hooks']['rows'], 2)
+        self.assertEqual(stats['tables']['kv']['bytes'], 4)
+
+
+class DeferredCommitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, '.unit-state.db')
+        self.db = unitdata.Storage(self.path)
+        self.addCleanup(self.db.close)
+
+    def committed(self, key):
+        conn = sqlite3.connect(self.path)
+        try:
+            row = conn.execute('select data from kv where key=?',
+                               [key]).fetchone()
+        finally:
+            conn.close()
+        return row and json.loads(row[0])
+
+    def test_deferred_commit(self):
+        with unit_state.deferred_commit(self.db):
+            self.db.set('a', 1)
+            self.db.flush()
+            self.db.set('b', 1)
+            self.db.flush()
+            self.assertIsNone(self.committed('a'))
+        self.assertEqual(self.committed('a'), 1)
+        self.assertEqual(self.committed('b'), 1)
+        # The db flushes as before afterwards
+        self.db.set('c', 1)
+        self.db.flush()
+        self.assertEqual(self.committed('c'), 1)
+
+    def test_deferred_commit_raises(self):
+        with self.assertRaises(KeyError):
+            with unit_state.deferred_commit(self.db):
+                self.db.set('flushed', 1)
+                self.db.flush()
+                with unit_state.deferred_commit(self.db):
+                    self.db.set('nested', 1)
+                    self.db.flush()
+                self.assertIsNone(self.committed('nested'))
+                self.db.set('unflushed', 1)
+                raise KeyError()
+        self.assertEqual(self.committed('flushed'), 1)
+        self.assertEqual(self.committed('nested'), 1)
+        self.assertIsNone(self.committed('unflushed'))
+        self.assertIsNone(self.db.get('unflushed'))
+
+    def test_deferred_commit_rollback(self):
+        with unit_state.deferred_commit(self.db):
+            self.db.set('flushed', 1)
+            self.db.flush()
+            self.db.set('discarded', 1)
+            self.db.flush(False)
+            self.assertIsNone(self.db.get('discarded'))
+            self.assertEqual(self.db.get('flushed'), 1)
+        self.assertEqual(self.committed('flushed'), 1)
+        self.assertIsNone(self.committed('discarded'))
+
+    def test_use_wal(self):
+        unit_state.use_wal(self.db)
+        self.assertEqual(unit_state._pragma(self.db, 'journal_mode'), 'wal')
+        self.assertEqual(unit_state._pragma(self.db, 'synchronous'), 1)
+        with unit_state.deferred_commit(self.db):
+            self.db.set('a', 1)
+            self.db.flush()
+        self.assertEqual(self.committed('a'), 1)
+
+    def test_use_wal_pending_changes(self):
+        self.db.set('a', 1)
+        unit_state.use_wal(self.db, synchronous='FULL')
+        self.assertEqual(unit_state._pragma(self.db, 'journal_mode'),
+                         'delete')
+        self.assertEqual(self.db.get('a'), 1)